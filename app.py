@@ -1,7 +1,10 @@
 # app.py
 from __future__ import annotations
+import hashlib
 import io
-import re
+import time
+import uuid
+from concurrent.futures import as_completed
 from pathlib import Path
 from functools import lru_cache
 from typing import List, Dict, Any, Tuple
@@ -11,6 +14,16 @@ import pandas as pd
 import streamlit as st
 from pysd import load, read_vensim
 
+from model_params import PRESETS, PARAM_SPECS
+from nies_cube import NIES_DIR_CANDIDATES, build_extdata_multi_year, clean_numeric, load_cube
+from pysd_ensemble import forcing_params, shutdown_pool, submit_ensemble
+from chart_view import CHART_POINTS, ViewCache, downsample_frame
+from flow_metrics import best_lag, skill_scores
+from jobs import JobManager
+from result_store import forcing_hash, model_hash
+from return_levels import RETURN_LEVELS_PATH, load_return_levels
+from run_cache import RunCache, run_key
+
 
 # =========================
 # 設定
@@ -22,40 +35,6 @@ DEFAULT_MODEL_MDL = Path("River_management_xls.mdl")
 INPUT_XLSX_PATH = Path("input.xlsx")
 INPUT_SHEET     = "input"
 
-# NIES 未来気候ファイルディレクトリ候補（どちらかに置いてあればOK）
-NIES_DIR_CANDIDATES = [Path("data/nies2020"), Path("data/nies")]
-
-
-# ==== 流域プリセット（代表値セット） ====
-PRESETS = {
-    "筑後川流域": {
-        "initial_dam_capacity": 74_200_000,      # m3
-        "upstream_area": 157_585,                # ha
-        "downstream_area": 143_951,              # ha
-        "forest_area_ratio": 166_000/(198_500*0.9),
-        "direct_discharge_ratio": 0.97,
-        "current_highwater_discharge": 11_500,   # m3/s
-        "paddy_field_ratio": 0.12,
-    },
-    "長良川流域": {
-        "initial_dam_capacity": 8_500_000,      # m3
-        "upstream_area": 178_650,               # ha
-        "downstream_area": 19_850,              # ha
-        "forest_area_ratio": 0.92,
-        "direct_discharge_ratio": 0.97,
-        "current_highwater_discharge": 8_900,   # m3/s
-        "paddy_field_ratio": 0.8,
-    },
-    "利根川流域（例）": {
-        "initial_dam_capacity": 200_000_000,
-        "upstream_area": 420_000,
-        "downstream_area": 600_000,
-        "forest_area_ratio": 0.65,
-        "direct_discharge_ratio": 0.96,
-        "current_highwater_discharge": 22_000,
-        "paddy_field_ratio": 0.10,
-    },
-}
 
 DEFAULT_RETURN_COLS = [
     "daily_total_gdp",
@@ -68,30 +47,6 @@ DEFAULT_RETURN_COLS = [
     "financial_damage_by_flood",
 ]
 
-PARAM_SPECS = {
-    "daily_precipitation_future_ratio": dict(label="将来降水補正（×）", min=0.5, max=2.0, step=0.01, value=1.0),
-    "dam_investment_amount":           dict(label="ダム投資額（円/年）",           min=0, max=1_000_000_000, step=1_000_000, value=0),
-    "levee_investment_amount":         dict(label="堤防投資額（円/年）",           min=0, max=100_000_000,  step=1_000_000,  value=0),
-    "drainage_investment_amount":      dict(label="排水能力投資額（円/年）",       min=0, max=10_000_000_000, step=100_000_000, value=0),
-    "annual_paddy_dam_investment":     dict(label="ため池（圃場）投資額（円/年）",   min=0, max=50_000_000,   step=1_000_000,  value=1_000_000),
-    "dam_investment_start_time":       dict(label="ダム投資 開始時期（年）",        min=0, max=11, step=1, value=0),
-    "levee_investment_start_time":     dict(label="堤防投資 開始時期（年）",        min=0, max=10, step=1, value=0),
-    "eldery_people_ratio":             dict(label="高齢者比率", min=0.0, max=1.0, step=0.01, value=0.6),
-    "capacity_building":               dict(label="防災力（避難率係数）", min=0.0, max=1.0, step=0.05, value=0.5),
-    "outflow_rate_of_residents":       dict(label="住民流出率（/日）", min=0.0, max=0.1, step=0.0001, value=0.01/365),
-    "inflow_rate_of_residents":        dict(label="住民流入率（/日）", min=0.0, max=0.1, step=0.0001, value=0.01/365),
-    "ratio_of_paddy_field_in_risky_area": dict(label="リスク域の圃場比率", min=0.0, max=1.0, step=0.01, value=0.01),
-    "paddy_field_ratio":                   dict(label="下流域における圃場比率", min=0.0, max=1.0, step=0.01, value=0.12),
-
-    # 地域パラメータ
-    "initial_dam_capacity": dict(label="初期ダム容量（m³）", min=0, max=500_000_000, step=100_000, value=74_200_000),
-    "upstream_area":        dict(label="上流域面積（ha）",  min=1_000, max=1_000_000, step=100, value=157_585),
-    "downstream_area":      dict(label="下流域面積（ha）",  min=1_000, max=1_000_000, step=100, value=143_951),
-    "forest_area_ratio":    dict(label="森林面積比（-）",   min=0.0, max=1.0, step=0.001, value=166_000/(198_500*0.9)),
-    "direct_discharge_ratio": dict(label="直接流出比（-）", min=0.0, max=1.0, step=0.001, value=1 - 40/1950),
-    "current_highwater_discharge": dict(label="計画高水流量（m³/秒）", min=0, max=30_000, step=100, value=11_500),
-}
-
 # ---- 年積算したい指標（表示名 → 候補となるモデル変数名）----
 INDICATORS_ANNUAL = {
     "Financial Damage by Flood": ["financial_damage_by_flood"],
@@ -115,19 +70,276 @@ def _load_model_from_file(model_py: str|None, model_mdl: str|None):
         return read_vensim(model_mdl)
     raise FileNotFoundError("モデルファイル（.py/.mdl）が見つかりません。")
 
-def _load_model_fresh(use_py_first: bool, model_py_path: str, model_mdl_path: str):
+def _model_file(use_py_first: bool, model_py_path: str, model_mdl_path: str) -> Path:
+    """ 実際に読み込むモデルファイル（.py 優先なら .py、無ければもう一方）"""
     py = Path(model_py_path)
     mdl = Path(model_mdl_path)
-    if use_py_first and py.exists():
-        return load(str(py))
-    if (not use_py_first) and mdl.exists():
-        return read_vensim(str(mdl))
-    if py.exists():
-        return load(str(py))
-    if mdl.exists():
-        return read_vensim(str(mdl))
+    for p in ((py, mdl) if use_py_first else (mdl, py)):
+        if p.exists():
+            return p
     raise FileNotFoundError("モデルファイルが見つかりません。")
 
+def _load_model_fresh(use_py_first: bool, model_py_path: str, model_mdl_path: str):
+    p = _model_file(use_py_first, model_py_path, model_mdl_path)
+    return load(str(p)) if p.suffix == ".py" else read_vensim(str(p))
+
+def _control_params(model_file: Path, n_days: int) -> Dict[str, Any]:
+    """ モデルにある制御変数だけ（initial_time / final_time / time_step）を返す """
+    model = _load_model_from_file(str(model_file), None) if model_file.suffix == ".py" \
+        else _load_model_from_file(None, str(model_file))
+    return {k: v for k, v in (("initial_time", 0), ("final_time", n_days - 1), ("time_step", 1))
+            if hasattr(model.components, k)}
+
+@st.cache_resource
+def _get_run_cache() -> RunCache:
+    # セッションをまたいで 1 つだけ（メモリの LRU ＋ ディスク）
+    return RunCache()
+
+def _run_fresh(use_py_first: bool, model_py_path: str, model_mdl_path: str,
+               params: Dict[str, Any], timestamps: List[float], return_cols: List[str], write_input) -> pd.DataFrame:
+    """ write_input() で input.xlsx を書いてからモデルを新規ロードして実行する（このプロセス内）"""
+    write_input()
+    model = _load_model_fresh(use_py_first, model_py_path, model_mdl_path)
+    return _run_simulation(model, params=params, timestamps=timestamps, return_cols=return_cols)
+
+def _cached_run(model_file: Path, use_py_first: bool, model_py_path: str, model_mdl_path: str,
+                params: Dict[str, Any], timestamps: List[float], return_cols: List[str],
+                input_hash: str, write_input) -> Tuple[str, pd.DataFrame]:
+    """
+    (モデルのハッシュ, パラメータ, 取得列, 時刻, 入力のハッシュ) が同じならキャッシュから返す。
+    未実行のときだけ _run_fresh で実行する。戻り値は (キャッシュのキー, 結果)。
+    """
+    key = run_key(model_hash(model_file), params, return_cols, timestamps, input_hash)
+    return key, _get_run_cache().get_or_run(
+        key, lambda: _run_fresh(use_py_first, model_py_path, model_mdl_path, params, timestamps, return_cols, write_input)
+    )
+
+@st.cache_resource
+def _pool_state() -> Dict[str, Any]:
+    # ワーカーに読み込ませたモデルのハッシュ（サーバープロセスで 1 つ）
+    return {}
+
+def _pool_model_args(model_file: Path) -> Tuple[str | None, str | None]:
+    """
+    GCM 並列実行用のウォームワーカー（pysd_ensemble のプール）に渡すモデル指定。
+    モデルファイルの中身が変わっていたらプールを作り直す。外部データは forcing_params で渡すので
+    ワーカーは input.xlsx を書き換えない。
+    """
+    state = _pool_state()
+    h = model_hash(model_file)
+    if state.get("model_hash") not in (None, h):
+        shutdown_pool()
+    state["model_hash"] = h
+    return _model_args(model_file)
+
+def _model_args(model_file: Path) -> Tuple[str | None, str | None]:
+    return (str(model_file), None) if model_file.suffix == ".py" else (None, str(model_file))
+
+@st.cache_resource
+def _get_job_manager() -> JobManager:
+    # バックグラウンドジョブ（対話用とは別のプール、セッションごとに公平に割り当て）
+    return JobManager()
+
+def _session_owner() -> str:
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+@st.cache_resource
+def _get_view_cache() -> ViewCache:
+    return ViewCache()
+
+def _frame_key(df: pd.DataFrame) -> str:
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes()).hexdigest()
+
+def _line_chart(df: pd.DataFrame, height: int, view_key: str | None = None, start: Any = None, end: Any = None) -> None:
+    """
+    グラフ幅程度の点数に間引いてから描く（方式・点数はサイドバー）。
+    間引き結果は (実行キー, 列, 期間, 点数, 方式) ごとに共有キャッシュへ。view_key がなければ表の中身で識別する。
+    """
+    n_points = int(st.session_state.get("chart_points", CHART_POINTS))
+    method = st.session_state.get("chart_method", "lttb")
+    key = (view_key or _frame_key(df), tuple(map(str, df.columns)), str(start), str(end), n_points, method)
+    view = _get_view_cache().get_or_build(key, lambda: downsample_frame(df, n_points, method, start, end))
+    st.line_chart(view, height=height, use_container_width=True)
+
+# ---- 実行後の結果表示（選んだビューの分だけ実行キャッシュから読み直して計算する）----
+def _stored_result(key: str, start: pd.Timestamp, columns: List[str] | None = None) -> pd.DataFrame | None:
+    res = _get_run_cache().peek(key, columns)
+    return None if res is None else _build_model_datetime_index(res, start)
+
+def _stored_results(view: Dict[str, Any], columns: List[str] | None = None) -> Dict[str, pd.DataFrame]:
+    out = {}
+    for gcm, key in view["gcm_keys"].items():
+        res = _stored_result(key, view["start"], columns)
+        if res is not None:
+            out[gcm] = res
+    return out
+
+def _lazy_download(label: str, build, file_name: str, key: str) -> None:
+    """ ボタンを押したときだけ CSV を作り、ダウンロードボタンを出す """
+    if st.button(f"{label} を作成", key=f"make_{key}"):
+        try:
+            data = build()
+        except Exception as e:
+            st.warning(f"{label} を作成できません（結果が実行キャッシュから消えている場合は再実行してください）: {e}")
+            return
+        st.download_button(label, data=data, file_name=file_name, mime="text/csv", key=f"dl_{key}")
+
+def _annual_sum_in_range(df: pd.DataFrame, col: str, first_year: int, last_year: int) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series(dtype=float)
+    out = df[col].groupby(df.index.year, sort=True).sum()
+    # 実データの年だけに限定し、希望範囲でクリップ
+    return out.loc[(out.index >= first_year) & (out.index <= last_year)]
+
+def _result_views(view: Dict[str, Any]) -> None:
+    """
+    前回の実行結果。時系列・年別集計・ダウンロードのうち選んだものだけを作る
+    （変数・GCM も 1 つずつ選ぶので、表示の手間は変数数・GCM 数に比例しない）。
+    """
+    gcm_keys = view["gcm_keys"]
+    first_year, last_year = int(view["start_year"]), int(view["start_year"]) + int(view["n_years"]) - 1
+    tag = f"ssp{view['ssp']}_{first_year}_{int(view['n_years'])}y"
+    st.caption(f"前回の実行結果: SSP{view['ssp']} / {first_year}〜{last_year} 年 / {len(gcm_keys)} GCM")
+    pick = st.radio("表示する結果", ["時系列", "年別集計", "ダウンロード"], horizontal=True, key="result_view")
+    target_var = "river_discharge_downstream"
+
+    if pick == "時系列" and gcm_keys:
+        first = view["start"].date()
+        last = (view["start"] + pd.Timedelta(days=int(view["n_days"]) - 1)).date()
+        start, end = first, last
+        if first < last:
+            start, end = st.slider("表示期間", min_value=first, max_value=last, value=(first, last),
+                                   format="YYYY-MM-DD", key="future_zoom")
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+
+        var = st.selectbox("変数", view["return_cols"], key="result_var")
+        overlay = "すべて（重ね描き）"
+        gcm = st.radio("GCM", [overlay] + list(gcm_keys), horizontal=True, key="result_gcm")
+        if gcm == overlay:
+            results = _stored_results(view, [var])
+            pieces = [df[var].rename(f"{var} ({g})") for g, df in results.items() if var in df.columns]
+            if pieces:
+                if var == target_var:
+                    st.subheader(f"📈 下流流量（river_discharge_downstream）— {len(pieces)} GCM 重ね描き（将来）")
+                _line_chart(pd.concat(pieces, axis=1), height=360, start=start, end=end,
+                            view_key="|".join(gcm_keys[g] for g in results))
+            else:
+                st.info(f"変数 {var} は出力に存在しません")
+        else:
+            df = _stored_result(gcm_keys[gcm], view["start"], [var])
+            if df is None:
+                st.info(f"{gcm}: 結果が実行キャッシュにありません（再実行してください）")
+            elif var in df.columns:
+                _line_chart(df[[var]], height=260, view_key=gcm_keys[gcm], start=start, end=end)
+            else:
+                st.info(f"{gcm}: 変数 {var} は出力に存在しません")
+
+    elif pick == "年別集計" and gcm_keys:
+        label = st.selectbox("指標（年別合計）", list(INDICATORS_ANNUAL), key="result_annual")
+        candidates = INDICATORS_ANNUAL[label]
+        results = _stored_results(view, candidates)
+        pieces = []
+        metric = candidates[0]
+        for gcm, df in results.items():
+            col = _pick_existing_var(df.columns, candidates)
+            if col is None:
+                continue
+            metric = col
+            s = _annual_sum_in_range(df, col, first_year, last_year)
+            if not s.empty:
+                pieces.append(s.rename(gcm))
+        if pieces:
+            yearly_wide = pd.concat(pieces, axis=1).sort_index()
+            yearly_wide.index.name = "year"
+            st.markdown(f"**{label}**（{len(pieces)} GCM）")
+            st.line_chart(yearly_wide, height=280, use_container_width=True)
+            _lazy_download(
+                f"{label}（年別合計, {len(pieces)} GCM）CSV",
+                lambda: yearly_wide.to_csv(index_label="year").encode("utf-8"),
+                f"annual_{metric}_{len(pieces)}gcm_ssp{view['ssp']}_{first_year}-{last_year}.csv",
+                key=f"annual_{metric}",
+            )
+        else:
+            st.info(f"{label} は出力に存在しません")
+
+    elif pick == "ダウンロード":
+        st.caption("ボタンを押したときに実行キャッシュから CSV を作ります。")
+        for gcm, key in gcm_keys.items():
+            _lazy_download(
+                f"{gcm} の出力CSV",
+                lambda key=key: _stored_result(key, view["start"]).to_csv(index_label="date").encode("utf-8"),
+                f"simulation_output_{gcm}_{tag}.csv",
+                key=f"gcm_{gcm}",
+            )
+        if gcm_keys:
+            def _river_csv() -> bytes:
+                results = _stored_results(view, [target_var])
+                return pd.concat([df[target_var].rename(g) for g, df in results.items() if target_var in df.columns],
+                                 axis=1).to_csv(index_label="date").encode("utf-8")
+            _lazy_download(
+                f"river_discharge_downstream（{len(gcm_keys)} GCM横持ち）",
+                _river_csv,
+                f"river_discharge_{len(gcm_keys)}gcm_{tag}.csv",
+                key="river_wide",
+            )
+        amedas = view.get("amedas")
+        if amedas is not None:
+            _lazy_download(
+                "AMeDAS 再現出力CSV",
+                lambda: _stored_result(amedas["key"], amedas["start"]).to_csv(index_label="date").encode("utf-8"),
+                "simulation_output_AMeDAS_baseline.csv",
+                key="amedas",
+            )
+            if amedas.get("obs") is not None:
+                def _amedas_obs_csv() -> bytes:
+                    obs_bytes, date_col, flow_col, unit, lag = amedas["obs"]
+                    out = _stored_result(amedas["key"], amedas["start"])
+                    obs_df = _read_observed_csv(io.BytesIO(obs_bytes), date_col, flow_col, unit)
+                    out["obs_flow"] = obs_df["obs_flow"]
+                    out["model_flow"] = out["river_discharge_downstream"]
+                    if lag != 0:
+                        out["model_flow_lag"] = out["model_flow"].shift(lag)
+                    return out.to_csv(index_label="date").encode("utf-8")
+                _lazy_download("AMeDAS再現×観測（CSV）", _amedas_obs_csv, "amedas_baseline_vs_observed.csv",
+                               key="amedas_obs")
+
+JOB_POLL_SEC = 2.0
+JOB_STATE_LABELS = {"queued": "待機中", "running": "実行中", "done": "完了", "failed": "失敗",
+                    "cancelled": "中止", "interrupted": "中断（サーバー再起動）", "unknown": "不明"}
+
+def _jobs_panel() -> None:
+    """ このセッションのジョブの進捗・中止・結果（完了したものは実行キャッシュへ入れる）"""
+    jm = _get_job_manager()
+    job_list = jm.jobs(_session_owner())
+    if not job_list:
+        return
+    st.header("⏳ バックグラウンドジョブ")
+    collected = st.session_state.setdefault("jobs_collected", set())
+    for job in reversed(job_list):
+        jid, state = job["job_id"], job.get("state", "unknown")
+        c1, c2, c3 = st.columns([3, 5, 2])
+        c1.markdown(f"**{job.get('label') or jid}**  \n`{jid}` {JOB_STATE_LABELS.get(state, state)}"
+                    + (f"（{job['position']} 番目）" if job.get("position") else ""))
+        c2.progress(min(job["fraction"], 1.0), text=f"{job['day']}/{job['total']} 日")
+        if state in ("queued", "running"):
+            if c3.button("中止", key=f"cancel_{jid}"):
+                jm.cancel(jid)
+                st.rerun()
+        elif state == "done":
+            res = jm.result(jid)
+            if res is not None and jid not in collected and job.get("meta", {}).get("key"):
+                _get_run_cache().put(job["meta"]["key"], res)
+                collected.add(jid)
+            if res is not None:
+                c3.download_button("CSV", data=res.to_csv(index_label="time").encode("utf-8"),
+                                   file_name=f"job_{jid}.csv", mime="text/csv", key=f"dl_job_{jid}")
+        elif state == "failed":
+            c3.error(job.get("error", "失敗"))
+    if any(jid in collected for jid in (j["job_id"] for j in job_list)):
+        st.caption("完了したジョブの結果は実行キャッシュに入っています。同じ条件で実行ボタンを押すとすぐに表示されます。")
+
 def _run_simulation(model, params: Dict[str, Any], timestamps: List[float], return_cols: List[str]) -> pd.DataFrame:
     """
     外部データは GET XLS DATA で 'input.xlsx' を参照している前提（data=は使わない）
@@ -144,7 +356,7 @@ def _run_simulation(model, params: Dict[str, Any], timestamps: List[float], retu
 
 def _build_model_datetime_index(res: pd.DataFrame, start_date: pd.Timestamp) -> pd.DataFrame:
     res = res.copy()
-    res.index = pd.to_datetime([start_date + pd.Timedelta(days=int(t)) for t in res.index])
+    res.index = pd.Timestamp(start_date) + pd.to_timedelta(np.asarray(res.index, dtype=float).astype(int), unit="D")
     res.index.name = "date"
     return res
 
@@ -161,30 +373,15 @@ def _read_observed_csv(file: io.BytesIO, date_col: str, flow_col: str, unit: str
 # 指標＆ラグ
 def _metrics(y_true: pd.Series, y_pred: pd.Series) -> Dict[str, float]:
     mask = ~(y_true.isna() | y_pred.isna())
-    yt = y_true[mask].astype(float)
-    yp = y_pred[mask].astype(float)
-    if len(yt) == 0:
+    if not mask.any():
         return {}
-    rmse = float(np.sqrt(np.mean((yp - yt) ** 2)))
-    mae  = float(np.mean(np.abs(yp - yt)))
-    bias = float(np.mean(yp - yt))
-    corr = float(np.corrcoef(yt, yp)[0,1]) if len(yt)>1 else np.nan
-    nse  = 1.0 - float(np.sum((yp-yt)**2) / np.sum((yt - yt.mean())**2)) if yt.nunique()>1 else np.nan
-    return {"RMSE": rmse, "MAE": mae, "Mean Bias": bias, "Pearson r": corr, "NSE": nse}
+    scores = skill_scores(y_pred.to_numpy(dtype=float)[None], y_true.to_numpy(dtype=float))
+    return {k: float(scores[k][0]) for k in ("RMSE", "MAE", "Mean Bias", "Pearson r", "NSE", "KGE", "log-NSE")}
 
 def _best_lag(y_true: pd.Series, y_pred: pd.Series, max_lag_days: int) -> Tuple[int, float]:
-    best_lag, best_r = 0, -np.inf
-    for lag in range(-max_lag_days, max_lag_days+1):
-        if lag > 0:
-            r = y_true.corr(y_pred.shift(lag))
-        elif lag < 0:
-            r = y_true.shift(-lag).corr(y_pred)
-        else:
-            r = y_true.corr(y_pred)
-        r = -1.0 if pd.isna(r) else float(r)
-        if r > best_r:
-            best_r, best_lag = r, lag
-    return best_lag, best_r
+    # 全ラグの相関を FFT でまとめて計算（y_true.corr(y_pred.shift(lag)) と同じ値）
+    lag, r, _, _ = best_lag(y_true.to_numpy(dtype=float), y_pred.to_numpy(dtype=float), max_lag_days)
+    return int(lag), float(r)
 
 def _pick_existing_var(columns: pd.Index, candidates: list[str]) -> str | None:
     """候補名のうち最初に存在する列名を返す。なければ None。"""
@@ -193,117 +390,9 @@ def _pick_existing_var(columns: pd.Index, candidates: list[str]) -> str | None:
             return c
     return None
 
-def _annual_sum(s: pd.Series) -> pd.Series:
-    """日系列を年ごと合計に集計（index: 年）。"""
-    idx = s.index
-    if not isinstance(idx, pd.DatetimeIndex):
-        raise ValueError("年集計するには DatetimeIndex が必要です。")
-    return s.groupby(idx.year).sum(min_count=1)
-
 # =========================
-# NIES SSP CSV 読み込み＆成形
+# モデル入力 Excel（input.xlsx）の読み書き
 # =========================
-def _nies_csv_path(var: str, ssp_code: str|int) -> Path:
-    fname = f"national_average_{var}_ssp{ssp_code}.csv"
-    for base in NIES_DIR_CANDIDATES:
-        p = base / fname
-        if p.exists():
-            return p
-    # 見つからなければ候補パスを列挙してエラー
-    cand = ", ".join(str((base / fname).resolve()) for base in NIES_DIR_CANDIDATES)
-    raise FileNotFoundError(f"{fname} が見つかりません。探した場所: {cand}")
-
-def _parse_nies_csv(var: str, ssp_code: str|int) -> Tuple[pd.DataFrame, list[dict], list[str], list[int]]:
-    """
-    national_average_<var>_ssp<code>.csv を読み込み、列名から model/year を抽出
-    返り値: (base_df(index=time), entries, models, years)
-    """
-    path = _nies_csv_path(var, ssp_code)
-    df = pd.read_csv(path)
-    if "time" not in df.columns:
-        df = df.rename(columns={df.columns[0]: "time"})
-    base_df = df.set_index("time")
-
-    # 例: pr_MIROC6_ssp245_r1i1p1f1_2050
-    pattern = re.compile(rf'^{re.escape(var)}_(?P<model>.+?)_ssp{ssp_code}_.+?_(?P<year>\d{{4}})$')
-    entries, models, years = [], set(), set()
-    for c in base_df.columns:
-        m = pattern.match(str(c))
-        if m:
-            model = m.group("model"); year = int(m.group("year"))
-            entries.append({"model": model, "year": year, "col": c})
-            models.add(model); years.add(year)
-    return base_df, entries, sorted(models), sorted(years)
-
-def _extract_one_year(base_df: pd.DataFrame, entries: list[dict], model: str, year: int, var: str) -> pd.Series:
-    for e in entries:
-        if e["model"] == model and e["year"] == year:
-            s = base_df[e["col"]].copy()
-            s.index.name = "doy"  # 0..364/365
-            s.name = var
-            return s
-    raise KeyError(f"{var}: {model} {year} の列がありません")
-
-def _drop_feb29_by_date_index(df: pd.DataFrame) -> pd.DataFrame:
-    if isinstance(df.index, pd.DatetimeIndex):
-        return df[~((df.index.month == 2) & (df.index.day == 29))]
-    return df
-
-def _clean_numeric(series: pd.Series, fallback: pd.Series|None=None) -> pd.Series:
-    s = pd.to_numeric(series, errors="coerce")
-    if s.isna().all() and fallback is not None:
-        s = pd.to_numeric(fallback, errors="coerce")
-    s = s.interpolate(limit_direction="both")
-    s = s.bfill().ffill().fillna(0)
-    s = s.replace([np.inf, -np.inf], 0)
-    return s.astype(float)
-
-def build_extdata_multi_year(ssp_code: str|int, model: str, start_year: int, n_years: int) -> pd.DataFrame:
-    """
-    指定SSP/モデル/開始年/年数の連結テーブル（No., precipitation, temperature, tasmax, tasmin, rsds, date）
-    - 閏日は削除して詰める（常に 365*n_years 行）
-    - 欠測は補間後に前後詰め、なお残れば 0
-    """
-    pr_base, pr_ent, _, _     = _parse_nies_csv("pr",     ssp_code)
-    tas_base, tas_ent, _, _   = _parse_nies_csv("tas",    ssp_code)
-    tmax_base, tmax_ent, _, _ = _parse_nies_csv("tasmax", ssp_code)
-    tmin_base, tmin_ent, _, _ = _parse_nies_csv("tasmin", ssp_code)
-    rsds_base, rsds_ent, _, _ = _parse_nies_csv("rsds",   ssp_code)
-
-    frames = []
-    for y in range(start_year, start_year + n_years):
-        pr    = _extract_one_year(pr_base,   pr_ent,   model, y, "precipitation")
-        tas   = _extract_one_year(tas_base,  tas_ent,  model, y, "temperature")
-        tasmx = _extract_one_year(tmax_base, tmax_ent, model, y, "tasmax")
-        tasmn = _extract_one_year(tmin_base, tmin_ent, model, y, "tasmin")
-        rsds  = _extract_one_year(rsds_base, rsds_ent, model, y, "rsds")
-
-        start = pd.Timestamp(f"{y}-01-01")
-        dates = [start + pd.Timedelta(days=int(d)) for d in pr.index]
-        dfy = pd.DataFrame({
-            "precipitation": pr.values,
-            "temperature":   tas.values,
-            "tasmax":        tasmx.values,
-            "tasmin":        tasmn.values,
-            "rsds":          rsds.values,
-        }, index=pd.to_datetime(dates))
-        frames.append(_drop_feb29_by_date_index(dfy))
-
-    df = pd.concat(frames, axis=0)
-    df.index.name = "date"
-
-    # 数値化＆埋め
-    df["temperature"]   = _clean_numeric(df["temperature"])
-    df["precipitation"] = _clean_numeric(df["precipitation"])
-    df["tasmax"]        = _clean_numeric(df["tasmax"], fallback=df["temperature"])
-    df["tasmin"]        = _clean_numeric(df["tasmin"], fallback=df["temperature"])
-    df["rsds"]          = _clean_numeric(df["rsds"])
-
-    df = df.reset_index()
-    df.insert(0, "No.", np.arange(len(df), dtype=int))
-    df = df[["No.", "precipitation", "temperature", "tasmax", "tasmin", "rsds", "date"]]
-    return df
-
 def write_input_excel_no_blank(table: pd.DataFrame, out_path: str|Path = INPUT_XLSX_PATH):
     """
     シート名 'input'、空欄なしで出力。
@@ -312,7 +401,7 @@ def write_input_excel_no_blank(table: pd.DataFrame, out_path: str|Path = INPUT_X
     for col in ["precipitation", "temperature", "tasmax", "tasmin", "rsds"]:
         if col not in tbl.columns:
             tbl[col] = 0.0
-        tbl[col] = _clean_numeric(tbl[col])
+        tbl[col] = clean_numeric(tbl[col])
     out_path = Path(out_path)
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with pd.ExcelWriter(out_path, engine="openpyxl") as xw:
@@ -330,7 +419,7 @@ def _read_input_excel_table(file_or_path: io.BytesIO | str | Path) -> pd.DataFra
         raise ValueError(f"input.xlsx に必要な列がありません: {missing}")
     df["date"] = pd.to_datetime(df["date"])
     for col in ["precipitation", "temperature", "tasmax", "tasmin", "rsds"]:
-        df[col] = _clean_numeric(df[col])
+        df[col] = clean_numeric(df[col])
     # 念のためうるう日があれば削除
     df = df.set_index("date")
     df = df[~((df.index.month == 2) & (df.index.day == 29))].reset_index()
@@ -359,6 +448,12 @@ with st.sidebar:
     ssp_code = st.selectbox("SSP 選択", options=["119", "126", "245", "585"], index=2)  # 既定: 245
     start_year = st.number_input("開始年", value=2015, step=1, min_value=1900, max_value=2100)
     n_years    = st.number_input("年数（1年以上可）", value=1, step=1, min_value=1, max_value=300)
+    n_gcms     = int(st.number_input("GCM 数（先頭から）", value=5, step=1, min_value=1, max_value=20))
+    bg_jobs    = st.toggle("将来計算をバックグラウンドジョブで実行（長期間向け）", value=False,
+                           help="画面を止めずに計算し、下の「バックグラウンドジョブ」で進捗・中止・結果を確認します")
+    st.selectbox("グラフの間引き方式", ["lttb", "minmax"], key="chart_method",
+                 help="長期間の日次系列は、グラフ幅程度の点数に間引いて描画します（lttb: 形を保つ / minmax: ピークを必ず残す）")
+    st.number_input("グラフの表示点数", value=CHART_POINTS, step=200, min_value=200, max_value=20000, key="chart_points")
 
     st.caption("※ CSV は data/nies2020/ または data/nies/ に配置。例: national_average_pr_ssp245.csv")
 
@@ -389,9 +484,10 @@ with st.sidebar:
 
 # モデル存在チェック
 try:
+    model_file = _model_file(use_py_first, str(model_py_path), str(model_mdl_path))
     _ = _load_model_from_file(
-        model_py_path if use_py_first else "",
-        model_mdl_path if not use_py_first else "",
+        str(model_file) if model_file.suffix == ".py" else "",
+        str(model_file) if model_file.suffix != ".py" else "",
     )
 except Exception as e:
     st.error(f"モデル読み込みに失敗: {e}")
@@ -421,7 +517,7 @@ with c3:
 max_lag_days = st.slider("形状比較の許容ラグ（日）", min_value=0, max_value=14, value=5)
 
 # 実行ボタン
-run_btn = st.button("▶ AMeDAS再現（観測比較）＋ 5 GCM 将来計算 を実行", type="primary")
+run_btn = st.button(f"▶ AMeDAS再現（観測比較）＋ {n_gcms} GCM 将来計算 を実行", type="primary")
 
 
 # =========================
@@ -429,37 +525,38 @@ run_btn = st.button("▶ AMeDAS再現（観測比較）＋ 5 GCM 将来計算 
 # =========================
 if run_btn:
     amedas_result: pd.DataFrame | None = None
+    amedas_key: str | None = None
+    amedas_obs: Tuple | None = None
     gcm_results: Dict[str, pd.DataFrame] = {}
     gcm_inputs:  Dict[str, pd.DataFrame] = {} 
+    gcm_keys:    Dict[str, str] = {}            # 実行キャッシュのキー（表示用の間引きキャッシュにも使う）
     start_dt = pd.Timestamp(f"{int(start_year)}-01-01")
 
     # ---------- AMeDAS 再現（観測比較） ----------
     with st.spinner("AMeDAS を用いた再現計算を実施中..."):
         if amedas_xlsx is not None:
             try:
-                # AMeDAS input.xlsx を保存してモデルに読ませる
-                with open(INPUT_XLSX_PATH, "wb") as f:
-                    f.write(amedas_xlsx.getbuffer())
-
                 # テーブル読み込み（開始日・日数を取得）
-                am_tbl = _read_input_excel_table(amedas_xlsx)
+                am_bytes = bytes(amedas_xlsx.getbuffer())
+                am_tbl = _read_input_excel_table(io.BytesIO(am_bytes))
                 start_dt_amedas = pd.to_datetime(am_tbl["date"].iloc[0])
                 n_days_amedas = len(am_tbl)
                 timestamps_amedas = list(range(n_days_amedas))
 
-                # モデルを新規ロード（毎回）
-                model_amedas = _load_model_fresh(use_py_first, str(model_py_path), str(model_mdl_path))
-
-                sim_params_amedas = params.copy()
-                for k, v in (("initial_time", 0), ("final_time", n_days_amedas - 1), ("time_step", 1)):
-                    if hasattr(model_amedas.components, k):
-                        sim_params_amedas[k] = v
+                def _write_amedas_input(data: bytes = am_bytes) -> None:
+                    # AMeDAS input.xlsx を保存してモデルに読ませる
+                    with open(INPUT_XLSX_PATH, "wb") as f:
+                        f.write(data)
 
-                res_amedas = _run_simulation(
-                    model_amedas,
+                # 同じ入力・パラメータならキャッシュから（未実行ならモデルを新規ロードして実行）
+                sim_params_amedas = {**params, **_control_params(model_file, n_days_amedas)}
+                amedas_key, res_amedas = _cached_run(
+                    model_file, use_py_first, str(model_py_path), str(model_mdl_path),
                     params=sim_params_amedas,
                     timestamps=timestamps_amedas,
-                    return_cols=list(set(return_cols))
+                    return_cols=sorted(set(return_cols)),
+                    input_hash=hashlib.sha1(am_bytes).hexdigest(),
+                    write_input=_write_amedas_input,
                 )
                 amedas_result = _build_model_datetime_index(res_amedas, start_dt_amedas)
                 st.success("AMeDAS 再現のモデル出力を得ました。")
@@ -500,37 +597,26 @@ if run_btn:
                     # 指標表示
                     scores = _metrics(merged["obs_flow"], merged[plot_target])
                     if scores:
-                        c1, c2, c3, c4, c5 = st.columns(5)
+                        c1, c2, c3, c4, c5, c6 = st.columns(6)
                         c1.metric("RMSE (m³/日)", f"{scores['RMSE']:.2f}")
                         c2.metric("MAE (m³/日)",  f"{scores['MAE']:.2f}")
                         c3.metric("Bias (m³/日)", f"{scores['Mean Bias']:.2f}")
                         c4.metric("相関 r",       f"{scores['Pearson r']:.3f}")
                         c5.metric("NSE",          f"{scores['NSE']:.3f}")
+                        c6.metric("KGE",          f"{scores['KGE']:.3f}")
 
                     # 実値重ね描き
                     st.markdown("**重ね描き（実値）**")
                     show_df = merged[[plot_target, "obs_flow"]].rename(columns={plot_target: "model(AMeDAS)", "obs_flow": "observed"})
-                    st.line_chart(show_df, height=320, use_container_width=True)
+                    _line_chart(show_df, height=320)
 
                     # 標準化（形状比較）
                     st.markdown("**形状比較（標準化：平均0・分散1）**")
                     z = show_df.apply(lambda s: (s - s.mean()) / (s.std() if s.std()!=0 else 1))
-                    st.line_chart(z, height=320, use_container_width=True)
-
-                    # ダウンロード
-                    with st.expander("📥 AMeDAS再現×観測 のCSVを保存"):
-                        out = amedas_result.copy()
-                        out["obs_flow"] = obs_df["obs_flow"]
-                        out["model_flow"] = amedas_result["river_discharge_downstream"]
-                        if lag != 0:
-                            out["model_flow_lag"] = out["model_flow"].shift(lag)
-                        csv = out.to_csv(index_label="date").encode("utf-8")
-                        st.download_button(
-                            "AMeDAS再現×観測（CSV）",
-                            data=csv,
-                            file_name="amedas_baseline_vs_observed.csv",
-                            mime="text/csv"
-                        )
+                    _line_chart(z, height=320)
+
+                    # ダウンロードは結果表示の「ダウンロード」から（押したときに作る）
+                    amedas_obs = (obs_file.getvalue(), obs_date_col, obs_flow_col, obs_unit, lag)
                 else:
                     st.info("AMeDAS 再現と観測の重なり期間がありません。日付の範囲をご確認ください。")
             else:
@@ -538,165 +624,201 @@ if run_btn:
         else:
             st.info("観測CSVをアップロードすると、AMeDAS再現との比較が表示されます。")
 
-    # ---------- NIES/SSP × 5 GCM（将来計算） ----------
-    with st.spinner("NIES/SSP 入力で 5 GCM の将来計算を実施中..."):
+    # ---------- NIES/SSP × N GCM（将来計算・ワーカープールで並列） ----------
+    st.subheader(f"🌐 NIES/SSP{ssp_code} × {n_gcms} GCM の将来計算")
+    try:
+        pr_models = load_cube("pr", ssp_code, NIES_DIR_CANDIDATES).models
+    except Exception as e:
+        st.exception(e)
+        st.stop()
+
+    if len(pr_models) < n_gcms:
+        st.warning(f"この SSP に含まれる GCM が {n_gcms} 未満です: {pr_models}")
+    models_to_run = pr_models[:n_gcms]
+
+    start_dt_nies = pd.Timestamp(f"{int(start_year)}-01-01")
+    requested_cols = sorted(set(return_cols) | REQUIRED_RETURN_COLS_FOR_ANNUAL)
+    cache = _get_run_cache()
+    progress = st.progress(0.0, text="GCM 入力を準備中...")
+    gcm_status = {gcm: st.empty() for gcm in models_to_run}
+    jobs: Dict[str, Dict[str, Any]] = {}
+
+    # 入力テーブル作成とキャッシュ確認（ヒットしたものはその場で完了）
+    for gcm in models_to_run:
         try:
-            _, pr_entries, pr_models, _ = _parse_nies_csv("pr", ssp_code)
+            in_table = build_extdata_multi_year(ssp_code, gcm, int(start_year), int(n_years))
         except Exception as e:
-            st.exception(e)
-            st.stop()
-
-        if len(pr_models) < 5:
-            st.warning(f"この SSP に含まれる GCM が 5 未満です: {pr_models}")
-        models_to_run = pr_models[:5]
+            gcm_status[gcm].error(f"{gcm} の入力作成でエラー: {e}")
+            continue
+        gcm_inputs[gcm] = in_table.copy()
+        n_days = len(in_table)
+        sim_params = {**params, **_control_params(model_file, n_days)}
+        timestamps = list(range(n_days))
+        key = run_key(model_hash(model_file), sim_params, requested_cols, timestamps, forcing_hash(in_table))
+        gcm_keys[gcm] = key
+        hit = cache.get(key)
+        if hit is not None:
+            gcm_results[gcm] = _build_model_datetime_index(hit, start_dt_nies)
+            gcm_status[gcm].success(f"{gcm}: キャッシュから取得")
+        else:
+            jobs[gcm] = {"key": key, "params": sim_params, "timestamps": timestamps, "table": in_table}
+            gcm_status[gcm].info(f"{gcm}: 実行待ち（{n_days} 日）")
 
-        start_dt_nies = pd.Timestamp(f"{int(start_year)}-01-01")
-        for gcm in models_to_run:
+    # バックグラウンドジョブの場合は投入だけして、この実行では待たない
+    if jobs and bg_jobs:
+        job_py, job_mdl = _model_args(model_file)
+        for gcm, job in jobs.items():
             try:
-                in_table = build_extdata_multi_year(ssp_code, gcm, int(start_year), int(n_years))
-                gcm_inputs[gcm] = in_table.copy()
-                write_input_excel_no_blank(in_table, INPUT_XLSX_PATH)
-
-                model_gcm = _load_model_fresh(use_py_first, str(model_py_path), str(model_mdl_path))
-
-                n_days = len(in_table)
-                timestamps = list(range(n_days))
-                sim_params = params.copy()
-                for k, v in (("initial_time", 0), ("final_time", n_days - 1), ("time_step", 1)):
-                    if hasattr(model_gcm.components, k):
-                        sim_params[k] = v
-
-                requested_cols = sorted(set(return_cols) | REQUIRED_RETURN_COLS_FOR_ANNUAL)
-                res = _run_simulation(
-                    model_gcm,
-                    params=sim_params,
-                    timestamps=timestamps,
-                    return_cols=requested_cols
+                jid = _get_job_manager().submit(
+                    _session_owner(),
+                    {**job["params"], **forcing_params(job["table"])},
+                    requested_cols,
+                    n_days=len(job["timestamps"]),
+                    label=f"SSP{ssp_code} {gcm} {int(start_year)}〜{int(n_years)}年",
+                    meta={"key": job["key"]},
+                    model_py=job_py, model_mdl=job_mdl,
                 )
-                res = _build_model_datetime_index(res, start_dt_nies)
-                gcm_results[gcm] = res
+                gcm_status[gcm].info(f"{gcm}: ジョブ {jid} として投入しました（下の「バックグラウンドジョブ」で進捗を確認）")
+            except Exception as e:
+                gcm_status[gcm].error(f"{gcm}: ジョブを投入できません: {e}")
+        jobs = {}
+
+    # 未計算の GCM はウォームワーカーへ一括投入し、終わった順に受け取る
+    n_total = len(gcm_inputs)
+    if jobs:
+        t0 = time.perf_counter()
+        futures = {}
+        try:
+            # 閏日を詰めているので全 GCM で日数（時刻）は同じ
+            pool_py, pool_mdl = _pool_model_args(model_file)
+            futs = submit_ensemble(
+                [{**job["params"], **forcing_params(job["table"])} for job in jobs.values()],
+                requested_cols,
+                timestamps=next(iter(jobs.values()))["timestamps"],
+                model_py=pool_py, model_mdl=pool_mdl,
+            )
+            futures = dict(zip(futs, jobs))
+        except Exception as e:
+            st.warning(f"ワーカープールを使えないため逐次実行します: {e}")
+        for gcm in jobs:
+            gcm_status[gcm].info(f"{gcm}: 実行中...")
+        progress.progress(len(gcm_results) / max(n_total, 1), text=f"{len(gcm_results)}/{n_total} GCM 完了")
+
+        def _finish(gcm: str, res: pd.DataFrame, how: str) -> None:
+            cache.put(jobs[gcm]["key"], res)
+            gcm_results[gcm] = _build_model_datetime_index(res, start_dt_nies)
+            gcm_status[gcm].success(f"{gcm}: 完了（{how}, {time.perf_counter() - t0:.1f} 秒）")
+            progress.progress(len(gcm_results) / max(n_total, 1), text=f"{len(gcm_results)}/{n_total} GCM 完了")
+
+        failed = [gcm for gcm in jobs if gcm not in futures.values()]
+        for fut in as_completed(futures):
+            gcm = futures[fut]
+            try:
+                _finish(gcm, fut.result(), "並列")
+            except Exception as e:
+                gcm_status[gcm].warning(f"{gcm}: ワーカーで失敗したためこのプロセスで再実行します（{e}）")
+                failed.append(gcm)
 
+        # プールが使えない・ワーカーで失敗した GCM は従来どおり input.xlsx 経由で逐次実行
+        for gcm in failed:
+            job = jobs[gcm]
+            try:
+                res = _run_fresh(
+                    use_py_first, str(model_py_path), str(model_mdl_path),
+                    params=job["params"], timestamps=job["timestamps"], return_cols=requested_cols,
+                    write_input=lambda tbl=job["table"]: write_input_excel_no_blank(tbl, INPUT_XLSX_PATH),
+                )
+                _finish(gcm, res, "逐次")
             except Exception as e:
-                st.error(f"{gcm} の実行でエラー: {e}")
+                gcm_status[gcm].error(f"{gcm} の実行でエラー: {e}")
+    progress.progress(1.0, text=f"{len(gcm_results)}/{n_total} GCM 完了")
+    # 表示順は GCM の並び順にそろえる
+    gcm_results = {gcm: gcm_results[gcm] for gcm in models_to_run if gcm in gcm_results}
 
     if gcm_results:
-        st.success("5 GCM の計算が完了しました。")
+        st.success(f"{len(gcm_results)} GCM の計算が完了しました。")
         st.write("対象 GCM:", ", ".join(gcm_results.keys()))
 
-        # 下流流量の重ね描き
-        target_var = "river_discharge_downstream"
-        if all((target_var in df.columns) for df in gcm_results.values()):
-            st.subheader("📈 下流流量（river_discharge_downstream）— 5 GCM 重ね描き（将来）")
-            plot_df = pd.concat(
-                [df[target_var].rename(f"{target_var} ({gcm})") for gcm, df in gcm_results.items()],
-                axis=1
-            )
-            st.line_chart(plot_df, height=360, use_container_width=True)
-
-        # 変数ごとのタブ
-        st.subheader("📊 変数ごとの時系列（GCM別タブ）")
-        for var in return_cols:
-            st.markdown(f"**{var}**")
-            tabs = st.tabs(list(gcm_results.keys()))
-            for (gcm, df), tab in zip(gcm_results.items(), tabs):
-                with tab:
-                    if var in df.columns:
-                        st.line_chart(df[[var]], height=260, use_container_width=True)
-                    else:
-                        st.info(f"{gcm}: 変数 {var} は出力に存在しません")
-
-        # ダウンロード
-        st.subheader("💾 将来計算の結果ダウンロード")
-        for gcm, df in gcm_results.items():
-            csv_bytes = df.to_csv(index_label="date").encode("utf-8")
-            st.download_button(
-                f"{gcm} の出力CSVを保存",
-                data=csv_bytes,
-                file_name=f"simulation_output_{gcm}_ssp{ssp_code}_{start_year}_{int(n_years)}y.csv",
-                mime="text/csv"
-            )
+    # 表示・ダウンロードは下の「実行結果」で、開いたものだけ実行キャッシュから作る
+    # （セッションにはキャッシュのキーだけを持つので、結果の数が増えてもメモリは増えない）
+    st.session_state["result_view_state"] = {
+        "gcm_keys": {gcm: gcm_keys[gcm] for gcm in gcm_results},
+        "start": start_dt_nies,
+        "n_days": len(next(iter(gcm_results.values()))) if gcm_results else 0,
+        "start_year": int(start_year),
+        "n_years": int(n_years),
+        "ssp": ssp_code,
+        "return_cols": list(return_cols) or requested_cols,
+        "amedas": None if amedas_key is None else {"key": amedas_key, "start": start_dt_amedas, "obs": amedas_obs},
+    }
+    del gcm_results, gcm_inputs, amedas_result
+
+
+# 実行結果（再実行しなくても、ビューの切り替えやダウンロードで消えない）
+if st.session_state.get("result_view_state"):
+    st.divider()
+    st.header("📊 実行結果")
+    if hasattr(st, "fragment"):
+        st.fragment(_result_views)(st.session_state["result_view_state"])
+    else:
+        _result_views(st.session_state["result_view_state"])
 
-        if all((target_var in df.columns) for df in gcm_results.values()):
-            river_df = pd.concat(
-                [df[target_var].rename(gcm) for gcm, df in gcm_results.items()],
-                axis=1
-            )
-            csv_bytes = river_df.to_csv(index_label="date").encode("utf-8")
-            st.download_button(
-                "river_discharge_downstream（5 GCM横持ち）を保存",
-                data=csv_bytes,
-                file_name=f"river_discharge_5gcm_ssp{ssp_code}_{start_year}_{int(n_years)}y.csv",
-                mime="text/csv"
-            )
 
-        # ==== 年別集計（合計）: 5 GCM（折れ線） ====
-        st.divider()
-        st.subheader("📅 年別集計（合計・折れ線）: 5 GCM")
-
-        metric_labels = {
-            "financial_damage_by_flood":       "Financial Damage by Flood",
-            "financial_damage_by_innundation": "Financial Damage by Inundation",
-            "daily_crop_production":           "Daily Crop Production",
-            "biodiversity":                    "Biodiversity",
-            "co2_absorption":                  "CO₂ absorption",
-            "municipality_cost":               "Municipality Cost",
-        }
-
-        last_year = int(start_year) + int(n_years) - 1
-
-        def _annual_sum(df: pd.DataFrame, col: str) -> pd.Series:
-            if col not in df.columns:
-                return pd.Series(dtype=float)
-            tmp = df[[col]].copy()
-            tmp["__year__"] = df.index.year
-            out = tmp.groupby("__year__", sort=True)[col].sum(numeric_only=True)
-            # 実データの年だけに限定し、希望範囲でクリップ
-            out = out.loc[(out.index >= int(start_year)) & (out.index <= last_year)]
-            return out
-
-        for metric, label in metric_labels.items():
-            pieces = []
-            for gcm, df in gcm_results.items():
-                s = _annual_sum(df, metric)
-                if not s.empty:
-                    pieces.append(s.rename(gcm))
-            if not pieces:
-                continue
+# バックグラウンドジョブ（fragment が使える版では JOB_POLL_SEC ごとにこの部分だけ再描画）
+if hasattr(st, "fragment"):
+    st.fragment(run_every=JOB_POLL_SEC)(_jobs_panel)()
+else:
+    _jobs_panel()
+    st.button("ジョブの進捗を更新")
 
-            yearly_wide = pd.concat(pieces, axis=1).sort_index()
 
-            st.markdown(f"**{label}**")
-            # 折れ線グラフ（年×5GCM）
-            st.line_chart(yearly_wide, height=280, use_container_width=True)
+# 実行キャッシュの状態（再実行ボタンを押さなくても表示）
+with st.sidebar:
+    st.divider()
+    st.header("実行キャッシュ")
+    _cs = _get_run_cache().stats()
+    c1, c2 = st.columns(2)
+    c1.metric("ヒット率", f"{_cs['hit_rate']:.0%}", help=f"ヒット {_cs['hits']}（うちディスク {_cs['disk_hits']}）/ ミス {_cs['misses']}")
+    c2.metric("ディスク", f"{_cs['disk_mb']:.1f} MB", help=f"{_cs['disk_entries']} 件（メモリ {_cs['memory_entries']} 件）")
+    if st.button("キャッシュを消去"):
+        _get_run_cache().clear()
+        st.success("実行キャッシュを消去しました")
 
-            # ダウンロード（そのまま維持）
-            csv_bytes = yearly_wide.to_csv(index_label="year").encode("utf-8")
-            st.download_button(
-                f"{label}（年別合計, 折れ線, 5 GCM）CSV を保存",
-                data=csv_bytes,
-                file_name=f"annual_{metric}_5gcm_ssp{ssp_code}_{start_year}-{last_year}.csv",
-                mime="text/csv",
-                key=f"dl_{metric}"
-            )
 
+# =========================
+# 日降水量の確率値（return_levels.py の事前計算結果を読むだけ）
+# =========================
+@st.cache_data(show_spinner=False)
+def _load_return_levels(path: str, mtime_ns: int) -> pd.DataFrame:
+    return load_return_levels(Path(path))
 
-    # AMeDAS 再現出力の保存
-    if amedas_result is not None:
-        st.subheader("💾 AMeDAS 再現出力のダウンロード")
-        csv_bytes = amedas_result.to_csv(index_label="date").encode("utf-8")
-        st.download_button(
-            "AMeDAS 再現出力CSVを保存",
-            data=csv_bytes,
-            file_name=f"simulation_output_AMeDAS_baseline.csv",
-            mime="text/csv"
+if RETURN_LEVELS_PATH.exists():
+    st.divider()
+    st.subheader("🌧️ 日降水量の確率値（NIES 年最大日降水量, Gumbel/GEV）")
+    rl_all = _load_return_levels(str(RETURN_LEVELS_PATH), RETURN_LEVELS_PATH.stat().st_mtime_ns)
+    rl_ssp = rl_all[rl_all["ssp"].astype(str) == str(ssp_code)]
+    if rl_ssp.empty:
+        st.info(f"SSP{ssp_code} の確率値はまだ計算されていません（python return_levels.py --ssps {ssp_code}）。")
+    else:
+        r1, r2, r3 = st.columns(3)
+        rl_dist = r1.selectbox("分布", sorted(rl_ssp["distribution"].unique()), key="rl_dist")
+        rl_method = r2.selectbox("推定法", sorted(rl_ssp["method"].unique()), key="rl_method")
+        rl_period = r3.selectbox("再現期間（年）", sorted(rl_ssp["return_period"].unique()), key="rl_period")
+        rl_sel = rl_ssp[(rl_ssp["distribution"] == rl_dist) & (rl_ssp["method"] == rl_method)
+                        & (rl_ssp["return_period"] == rl_period)]
+        st.line_chart(rl_sel.pivot_table(index="window_start", columns="model", values="return_level"),
+                      height=280, use_container_width=True)
+        st.dataframe(
+            rl_sel[["model", "window_start", "window_end", "return_level", "ci_low", "ci_high"]],
+            use_container_width=True, hide_index=True,
         )
-
+        st.caption(f"窓の開始年ごとの {int(rl_period)} 年確率日降水量 (mm/day) とブートストラップ信頼区間（{RETURN_LEVELS_PATH}）")
 
 st.divider()
 with st.expander("🧩 ヒント & メモ"):
     st.markdown("""
 - **AMeDAS 再現**: `input.xlsx`（シート名 `input`、列 `No., precipitation, temperature, tasmax, tasmin, rsds, date`）をアップすると、モデルをその外部データで駆動し、**観測流量 CSV** と比較（RMSE/MAE/Bias/r/NSE、ラグ最適化）します。
-- **将来計算**: NIES の `national_average_<var>_ssp<code>.csv` から 5 GCM を自動選択。期間は「開始年＋年数」。閏日は削除して詰め、**空欄は作らず** `input.xlsx` を都度生成します。
+- **将来計算**: NIES の `national_average_<var>_ssp<code>.csv` から先頭 N GCM（既定 5）を自動選択。期間は「開始年＋年数」。閏日は削除して詰め、**空欄は作らず** 外部データとしてワーカープールへ渡して並列実行します（失敗時のみ `input.xlsx` を生成して逐次実行）。
 - NIES データの場所は `data/nies2020/` または `data/nies/` のどちらかでOK。
 - 起動: `pip install streamlit pysd numpy pandas openpyxl` → `streamlit run app.py`
     """)
@@ -0,0 +1,129 @@
+# chart_view.py
+# -*- coding: utf-8 -*-
+"""
+長い日次時系列をグラフ表示用に間引く（表示点数はグラフ幅程度に抑え、計算期間には依存させない）。
+
+- lttb: Largest-Triangle-Three-Buckets（形を保つ間引き）
+- minmax: バケットごとの最小・最大（ピークを必ず残す）
+- 複数列の表は列ごとに選んだ点の和集合を使う（どの列も実データの点だけで描く）
+- ViewCache: (実行, 変数, 表示期間, 点数, 方式) ごとに間引き結果を LRU で保持する
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+import numpy as np
+import pandas as pd
+
+
+CHART_POINTS = 1200         # 1 グラフあたりの表示点数（グラフ幅の 1〜2 倍程度）
+MIN_POINTS_PER_SERIES = 200
+VIEW_ENTRIES = 256
+
+
+def lttb_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """ LTTB で残す点の位置（x は等間隔とみなす）。先頭・末尾は必ず残す """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # 先頭と末尾を除いた n-2 点を n_out-2 個のバケットに分ける
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    out = np.empty(n_out, dtype=int)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 次のバケットの平均点（最後は末尾の点）
+        nlo, nhi = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        cx, cy = 0.5 * (nlo + nhi - 1), y[nlo:nhi].mean()
+        xs = np.arange(lo, hi)
+        area = np.abs((a - cx) * (y[lo:hi] - y[a]) - (a - xs) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def minmax_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """ n_out/2 個のバケットごとに最小・最大の位置を残す（先頭・末尾も残す）"""
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    n_buckets = max(1, n_out // 2)
+    if n_out >= n or n_buckets >= n:
+        return np.arange(n)
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    width = int(np.diff(edges).max())
+    # バケットを同じ幅の 2 次元配列にしてまとめて argmin / argmax（はみ出しは端の値で埋める）
+    pos = np.minimum(edges[:-1, None] + np.arange(width)[None, :], edges[1:, None] - 1)
+    block = y[pos]
+    idx = np.concatenate([
+        pos[np.arange(n_buckets), np.argmin(block, axis=1)],
+        pos[np.arange(n_buckets), np.argmax(block, axis=1)],
+        [0, n - 1],
+    ])
+    return np.unique(idx)
+
+
+def downsample_indices(y: np.ndarray, n_out: int = CHART_POINTS, method: str = "lttb") -> np.ndarray:
+    """ 1 系列の間引き位置。NaN の点は除いてから選ぶ """
+    y = np.asarray(y, dtype=float)
+    ok = np.flatnonzero(np.isfinite(y))
+    if len(ok) <= n_out:
+        return ok
+    fn = minmax_indices if method == "minmax" else lttb_indices
+    return ok[fn(y[ok], n_out)]
+
+
+def downsample_frame(
+    df: pd.DataFrame | pd.Series,
+    n_points: int = CHART_POINTS,
+    method: str = "lttb",
+    start: Any = None,
+    end: Any = None,
+) -> pd.DataFrame:
+    """
+    表示期間 [start, end] に切り出してから、n_points 点程度に間引いた表を返す。
+    行は列ごとに選んだ位置の和集合（値は元データのまま）。
+    """
+    frame = df.to_frame() if isinstance(df, pd.Series) else df
+    if start is not None or end is not None:
+        frame = frame.loc[start:end]
+    if len(frame) <= n_points or frame.shape[1] == 0:
+        return frame
+    # 列が多いときは 1 列あたりの点数を減らし、和集合が n_points 程度に収まるようにする
+    per_col = max(n_points // frame.shape[1], MIN_POINTS_PER_SERIES)
+    keep = np.unique(np.concatenate(
+        [downsample_indices(frame[c].to_numpy(dtype=float), per_col, method) for c in frame.columns]
+    ))
+    return frame.iloc[keep]
+
+
+class ViewCache:
+    """
+    間引き済みの表示用データの LRU。キーは呼び出し側で (実行キー, 変数, 期間, 点数, 方式) などにする。
+    app のセッション（スレッド）間で共有するのでロックで保護する。
+    """
+
+    def __init__(self, max_entries: int = VIEW_ENTRIES):
+        self.max_entries = max_entries
+        self._views: "OrderedDict[Hashable, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: Hashable, build: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        with self._lock:
+            if key in self._views:
+                self._views.move_to_end(key)
+                return self._views[key]
+        view = build()
+        with self._lock:
+            self._views[key] = view
+            self._views.move_to_end(key)
+            while len(self._views) > self.max_entries:
+                self._views.popitem(last=False)
+        return view
+
+    def clear(self) -> None:
+        with self._lock:
+            self._views.clear()
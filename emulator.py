@@ -0,0 +1,308 @@
+# emulator.py
+# -*- coding: utf-8 -*-
+"""
+SD モデル（river_discharge_downstream）の高速エミュレータ。
+
+1. パラメータ（ラテン超方格）と気象外力（input_*.xlsx からの 365 日切り出し）を標本化
+2. アンサンブル実行で PySD の下流流量を得る
+3. 「直近 WINDOW_DAYS 日の外力窓 + パラメータ + 季節」から当日の log 流量を返す MLP を学習
+4. 学習に使っていない PySD 実行でホールドアウト検証（NSE）
+
+DischargeEmulator.run() は PySD の model.run() と同じ引数で呼べるので、
+大量シナリオのスクリーニングではモデルの代わりにそのまま差し替えられる。
+"""
+from __future__ import annotations
+
+import argparse
+import pickle
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from sklearn.neural_network import MLPRegressor
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from pysd_ensemble import FORCING_COMPONENTS, HYDRO_BOUNDS, forcing_params, get_model, run_ensemble
+
+
+# ---- 設定 ----
+EMULATOR_PATH = Path("data/emulator_discharge.pkl")
+FORCING_FILES = [Path("jma_kurume_2023.xlsx"), *sorted(Path(".").glob("input_*_ssp*.xlsx"))]
+INPUT_SHEET = "input"
+
+TARGET = "river_discharge_downstream"
+FORCING_FEATURES = ["precipitation", "temperature", "rsds"]
+WINDOW_DAYS = 30          # 外力窓（日）
+N_DAYS = 365              # 1 メンバーの日数（モデルの FINAL TIME に合わせる）
+DISCHARGE_FLOOR = 2.5e6   # モデル側の基底流量 MAX(..., 2.5e6) と揃える
+PREDICT_CHUNK = 256       # 推論時に一度に扱うメンバー数
+
+# ---- エミュレートするパラメータ（水文 + 将来降水補正）----
+EMULATOR_BOUNDS = {
+    **HYDRO_BOUNDS,
+    "daily_precipitation_future_ratio": (0.5, 2.0),
+}
+
+
+# =========================
+# 標本化
+# =========================
+def load_forcing_pool(files: Sequence[Path] = FORCING_FILES) -> List[pd.DataFrame]:
+    """ input.xlsx 形式のファイル群を読み、外力テーブルのリストにする """
+    pool = []
+    for f in files:
+        if not Path(f).exists():
+            continue
+        df = pd.read_excel(f, sheet_name=INPUT_SHEET)
+        for col in FORCING_FEATURES + ["tasmax", "tasmin"]:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce").interpolate(limit_direction="both").fillna(0.0)
+        if len(df) >= N_DAYS:
+            pool.append(df.reset_index(drop=True))
+    if not pool:
+        raise FileNotFoundError("外力テーブル（input_*.xlsx など）が見つかりません。")
+    return pool
+
+
+def sample_forcings(pool: List[pd.DataFrame], n: int, rng: np.random.Generator,
+                    n_days: int = N_DAYS) -> List[pd.DataFrame]:
+    """ ファイル・開始日をランダムに選んで n_days 日ずつ切り出す """
+    out = []
+    for _ in range(n):
+        df = pool[rng.integers(len(pool))]
+        s = rng.integers(0, len(df) - n_days + 1)
+        out.append(df.iloc[s:s + n_days].reset_index(drop=True))
+    return out
+
+
+def sample_params(bounds: Dict[str, Tuple[float, float]], n: int, rng: np.random.Generator) -> np.ndarray:
+    """ ラテン超方格で (n, d) のパラメータを作る """
+    d = len(bounds)
+    u = (np.argsort(rng.random((n, d)), axis=0) + rng.random((n, d))) / n
+    lo = np.array([b[0] for b in bounds.values()], dtype=float)
+    hi = np.array([b[1] for b in bounds.values()], dtype=float)
+    return lo + u * (hi - lo)
+
+
+def _target_array(res: pd.DataFrame) -> List[float]:
+    # ワーカー側で流量だけを取り出す（pickle 可能なトップレベル関数）
+    return [float(v) for v in res[TARGET].to_numpy(float)]
+
+
+def simulate(names: Sequence[str], x: np.ndarray, forcings: List[pd.DataFrame],
+             workers: int | None = None) -> np.ndarray:
+    """ (パラメータ, 外力) の組を 1 回のアンサンブル実行で流し、(n, n_days) の流量を返す """
+    n_days = len(forcings[0])
+    param_sets = [{**dict(zip(names, map(float, row))), **forcing_params(f)} for row, f in zip(x, forcings)]
+    res = run_ensemble(param_sets, [TARGET], timestamps=list(range(n_days)),
+                       reducer=_target_array, workers=workers, errors="ignore")
+    return np.array([np.full(n_days, np.nan) if r is None else r for r in res], dtype=float)
+
+
+# =========================
+# 特徴量
+# =========================
+def forcing_array(forcings: List[pd.DataFrame]) -> np.ndarray:
+    """ 外力テーブル群を (n, n_days, n_features) にまとめる """
+    return np.stack([f[FORCING_FEATURES].to_numpy(float) for f in forcings])
+
+
+def build_features(f_arr: np.ndarray, x: np.ndarray, window: int = WINDOW_DAYS) -> np.ndarray:
+    """
+    (n, n_days, n_feat) の外力と (n, d) のパラメータから (n*n_days, window*n_feat + d + 2) の特徴量を作る。
+    窓は sliding_window_view のビューなので、最後の reshape までコピーしない。
+    """
+    n, n_days, n_feat = f_arr.shape
+    padded = np.concatenate([np.repeat(f_arr[:, :1], window - 1, axis=1), f_arr], axis=1)
+    win = sliding_window_view(padded, window, axis=1)            # (n, n_days, n_feat, window)
+    t = np.arange(n_days) % 365
+    season = np.stack([np.sin(2 * np.pi * t / 365), np.cos(2 * np.pi * t / 365)], axis=1)
+    return np.concatenate([
+        win.reshape(n, n_days, n_feat * window),
+        np.broadcast_to(x[:, None, :], (n, n_days, x.shape[1])),
+        np.broadcast_to(season[None], (n, n_days, 2)),
+    ], axis=2).reshape(n * n_days, -1)
+
+
+# forcing_params() の逆引き（PySD の構成要素名 → input.xlsx の列名）
+_FORCING_COLUMNS = {comp: col for col, comp in FORCING_COMPONENTS.items()}
+
+
+def _forcing_table(series: Dict[str, Any], base: pd.DataFrame | None) -> pd.DataFrame:
+    """
+    forcing_params() 形式の外力系列から外力テーブルを組み立てる（forcing_params の逆）。
+    series に無い列は base から取り、長さは series 側に合わせる。
+    """
+    if not series:
+        if base is None:
+            raise ValueError("外力テーブル（forcing）を指定してください。")
+        return base
+    cols = {_FORCING_COLUMNS[k]: v for k, v in series.items()}
+    lengths = {len(v) for v in cols.values() if np.ndim(v) > 0}
+    if len(lengths) > 1:
+        raise ValueError(f"外力系列の長さが揃っていません: {sorted(lengths)}")
+    n_days = lengths.pop() if lengths else (None if base is None else len(base))
+    if n_days is None:
+        raise ValueError("外力系列の長さが決まりません（系列を 1 つ以上渡すか forcing を指定してください）。")
+    table = pd.DataFrame(index=pd.RangeIndex(n_days))
+    for col in FORCING_FEATURES:
+        if col in cols:
+            v = cols[col]
+            table[col] = np.full(n_days, float(v)) if np.ndim(v) == 0 else np.asarray(v, dtype=float)
+        elif base is not None and col in base.columns and len(base) >= n_days:
+            table[col] = base[col].to_numpy(float)[:n_days]
+        else:
+            raise ValueError(f"外力 {FORCING_COMPONENTS[col]}（{col}）が params にも forcing にもありません。")
+    return table
+
+
+def nse(sim: np.ndarray, obs: np.ndarray) -> np.ndarray:
+    """ 行ごとの Nash–Sutcliffe 効率 """
+    num = np.nansum((sim - obs) ** 2, axis=-1)
+    den = np.nansum((obs - np.nanmean(obs, axis=-1, keepdims=True)) ** 2, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1.0 - num / den
+
+
+# =========================
+# エミュレータ本体
+# =========================
+class DischargeEmulator:
+    """
+    学習済み MLP をラップし、PySD の run() 互換の呼び出しと一括推論を提供する。
+    """
+
+    def __init__(self, names: Sequence[str], defaults: Dict[str, float], regressor,
+                 window: int = WINDOW_DAYS, forcing: pd.DataFrame | None = None):
+        self.names = list(names)
+        self.defaults = dict(defaults)
+        self.regressor = regressor
+        self.window = window
+        self.forcing = forcing
+
+    def predict(self, x: np.ndarray, f_arr: np.ndarray) -> np.ndarray:
+        """ (n, d) のパラメータと (n, n_days, n_feat) の外力から (n, n_days) の流量を返す """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        if f_arr.shape[0] == 1 and x.shape[0] > 1:
+            f_arr = np.broadcast_to(f_arr, (x.shape[0],) + f_arr.shape[1:])
+        n, n_days = x.shape[0], f_arr.shape[1]
+        out = np.empty((n, n_days))
+        for s in range(0, n, PREDICT_CHUNK):
+            feats = build_features(np.asarray(f_arr[s:s + PREDICT_CHUNK]), x[s:s + PREDICT_CHUNK], self.window)
+            pred = self.regressor.predict(feats).reshape(-1, n_days)
+            out[s:s + PREDICT_CHUNK] = np.maximum(np.exp(pred), DISCHARGE_FLOOR)
+        return out
+
+    def run(self, params: Dict[str, Any] | None = None, return_timestamps=None,
+            return_columns=None, forcing: pd.DataFrame | None = None, **_) -> pd.DataFrame:
+        """
+        model.run() と同じ形で呼べる高速版。扱えるのは river_discharge_downstream のみ。
+        params にはエミュレート対象のパラメータと、forcing_params() が返す外力系列
+        （daily_precip など）を渡せる。外力系列は forcing（既定は学習時の代表外力）の列を置き換える。
+        """
+        cols = [TARGET] if return_columns is None else list(return_columns)
+        if cols != [TARGET]:
+            raise KeyError(f"エミュレータが返せるのは {TARGET} のみです: {cols}")
+        params = dict(params or {})
+        unknown = [k for k in params if k not in self.names and k not in _FORCING_COLUMNS]
+        if unknown:
+            raise KeyError(f"エミュレータが扱えないパラメータです: {unknown}"
+                           f"（対象: {self.names} と外力 {list(_FORCING_COLUMNS)}）")
+        forcing = _forcing_table(
+            {k: v for k, v in params.items() if k in _FORCING_COLUMNS},
+            self.forcing if forcing is None else forcing,
+        )
+        p = {**self.defaults, **{k: v for k, v in params.items() if k in self.names}}
+        x = np.array([[float(p[k]) for k in self.names]])
+        y = self.predict(x, forcing_array([forcing]))[0]
+        t = np.arange(len(y), dtype=float)
+        df = pd.DataFrame({TARGET: y}, index=pd.Index(t, name="time"))
+        if return_timestamps is not None:
+            ts = np.atleast_1d(np.asarray(return_timestamps, dtype=float))
+            outside = ts[~np.isin(ts, t)]
+            if outside.size:
+                raise ValueError(f"return_timestamps が外力の範囲（0〜{len(t) - 1} 日）外です: {outside.tolist()}")
+            df = df.loc[ts]
+        return df
+
+    def save(self, path: Path = EMULATOR_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: Path = EMULATOR_PATH) -> "DischargeEmulator":
+        with Path(path).open("rb") as f:
+            return pickle.load(f)
+
+
+def train(
+    n_train: int = 200,
+    n_test: int = 20,
+    bounds: Dict[str, Tuple[float, float]] = EMULATOR_BOUNDS,
+    workers: int | None = None,
+    seed: int = 42,
+) -> Tuple[DischargeEmulator, pd.DataFrame]:
+    """
+    学習用・検証用のアンサンブルを流してエミュレータを学習し、(エミュレータ, 検証表) を返す。
+    """
+    rng = np.random.default_rng(seed)
+    names = list(bounds.keys())
+    pool = load_forcing_pool()
+
+    x = sample_params(bounds, n_train + n_test, rng)
+    forcings = sample_forcings(pool, n_train + n_test, rng)
+    print(f"simulate: {len(x)} members x {N_DAYS} days")
+    y = simulate(names, x, forcings, workers)
+    ok = np.isfinite(y).all(axis=1)
+    x, y, forcings = x[ok], y[ok], [f for f, k in zip(forcings, ok) if k]
+    if len(x) < 2:
+        raise RuntimeError(f"成功した PySD 実行が {len(x)} 件しかありません（学習と検証に 2 件以上必要です）。")
+    n_train = min(n_train, len(x) - 1)
+
+    f_arr = forcing_array(forcings)
+    feats = build_features(f_arr[:n_train], x[:n_train])
+    target = np.log(np.maximum(y[:n_train], DISCHARGE_FLOOR)).reshape(-1)
+
+    regressor = make_pipeline(
+        StandardScaler(),
+        MLPRegressor(hidden_layer_sizes=(64, 64), early_stopping=True, max_iter=200, random_state=seed),
+    )
+    regressor.fit(feats, target)
+
+    model = get_model()
+    defaults = {k: float(getattr(model.components, k)()) for k in names}
+    emu = DischargeEmulator(names, defaults, regressor, forcing=pool[0].iloc[:N_DAYS].reset_index(drop=True))
+
+    # ホールドアウト検証（学習に使っていない PySD 実行）
+    y_hat = emu.predict(x[n_train:], f_arr[n_train:])
+    y_ref = y[n_train:]
+    report = pd.DataFrame({
+        "nse": nse(y_hat, y_ref),
+        "log_nse": nse(np.log(y_hat), np.log(y_ref)),
+        "peak_rel_error": (y_hat.max(axis=1) - y_ref.max(axis=1)) / y_ref.max(axis=1),
+    })
+    return emu, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下流流量エミュレータの学習と検証")
+    parser.add_argument("--n-train", type=int, default=200, help="学習用アンサンブルのメンバー数")
+    parser.add_argument("--n-test", type=int, default=20, help="検証用（ホールドアウト）メンバー数")
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", type=Path, default=EMULATOR_PATH)
+    args = parser.parse_args()
+
+    emu, report = train(args.n_train, args.n_test, workers=args.workers, seed=args.seed)
+    print("Hold-out validation:")
+    print(report.describe().loc[["mean", "min", "50%", "max"]].to_string())
+    emu.save(args.out)
+    print(f"  -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
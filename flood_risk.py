@@ -0,0 +1,331 @@
+# flood_risk.py
+# -*- coding: utf-8 -*-
+"""
+適応策ごとのモンテカルロ洪水被害リスク（年期待被害額 EAD・損失超過曲線）。
+
+- 合成気象（weather_generator）を MEMORY_BUDGET_MB に収まるブロックごとに生成し、
+  同じブロックを全適応策に流す（共通乱数。策の間の差の推定誤差が小さくなる）
+- 実行は pysd_ensemble.run_ensemble（ウォームワーカーのプロセスプール）。ワーカー側で
+  年ごとの被害額（年合計・日最大）だけに集計し、日別出力は親プロセスに返さない
+- 1 本は sim_years 年の連続実行。堤防・ダムは投資後に建設期間（モデルの 3 次遅れ、既定 5 年・10 年）を
+  経てから効くので、既定は SIM_YEARS 年を回して先頭 BURN_IN 年を評価から外す
+- 年値は策 × 指標ごとの DamageSketch（対数ビンの固定長ヒストグラム + 正確な合計）に流し込み、
+  年数に関係なくメモリは一定。EAD は合計から正確に、超過曲線はヒストグラムから求める
+"""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from model_params import BASE_PARAMS, OPT_RESULT
+from pysd_ensemble import run_ensemble
+from weather_generator import (
+    AEP_LEVELS, N_DAYS, RISK_DIR,
+    WeatherGenerator, load_nies, load_observed, member_params,
+)
+
+
+# ---- 対象指標 ----
+DAMAGE_COLS = ["financial_damage_by_flood", "financial_damage_by_innundation"]
+STATS = ["annual_total", "annual_max"]   # 年合計（= 年被害額）と日被害額の年最大
+
+# ---- 適応策（BASE_PARAMS への上書き。範囲は model_params.PARAM_SPECS に合わせる）----
+POLICIES: Dict[str, Dict[str, float]] = {
+    "baseline": {},
+    "levee": {"levee_investment_amount": 100_000_000, "levee_investment_start_time": 0},
+    "dam": {"dam_investment_amount": 1_000_000_000, "dam_investment_start_time": 0},
+    "drainage": {"drainage_investment_amount": 1_000_000_000},
+    "paddy_dam": {"annual_paddy_dam_investment": 50_000_000},
+    "combined": {
+        "levee_investment_amount": 100_000_000, "levee_investment_start_time": 0,
+        "dam_investment_amount": 1_000_000_000, "dam_investment_start_time": 0,
+        "drainage_investment_amount": 1_000_000_000,
+        "annual_paddy_dam_investment": 50_000_000,
+    },
+}
+
+# ---- 評価期間 ----
+# 投資額の列 → (開始年の列, 建設期間の列, モデルの既定の建設期間 [年])
+CONSTRUCTION = {
+    "levee_investment_amount": ("levee_investment_start_time", "levee_construction_time", 5),
+    "dam_investment_amount": ("dam_investment_start_time", "dam_construction_time", 10),
+}
+SIM_YEARS = 20                       # 1 本あたりの年数（ダムの効果がほぼ出そろうまで）
+BURN_IN = 16                         # 評価から外す先頭の年数（開始 0 年 + 投資 1 年 + 3 次遅れの大半）
+N_MEMBERS = 2500                     # 既定の本数（評価年数 = 本数 × (SIM_YEARS - BURN_IN)）
+
+# ---- スケッチ・メモリ ----
+SKETCH_MIN = 1.0                     # これ未満の年値は 0 として数える（円）
+SKETCH_MAX = 1e15                    # これを超える年値は最上位ビン（max は別に正確に保持）
+SKETCH_BINS_PER_DECADE = 200         # 相対誤差 ≈ 10^(1/200) - 1 ≈ 1.2%
+MEMORY_BUDGET_MB = 256               # 1 ブロックの強制データ＋タスクの目安
+BYTES_PER_VALUE_OVERHEAD = 4         # 生成配列・Series・pickle 済みタスクの重複分の見込み
+MAX_BLOCK = 5000
+
+
+# =========================
+# ストリーミング分位スケッチ
+# =========================
+class DamageSketch:
+    """
+    非負の年値用の固定長スケッチ。0（SKETCH_MIN 未満）の件数、対数ビンのヒストグラム、
+    件数・合計・二乗和・最大値だけを持つ。同じ設定同士は merge で足し合わせられる。
+    分位の相対誤差はビン幅（既定 ≈1.2%）以内、平均（EAD）は正確。
+    """
+
+    def __init__(self, lo: float = SKETCH_MIN, hi: float = SKETCH_MAX,
+                 bins_per_decade: int = SKETCH_BINS_PER_DECADE):
+        n_bins = int(np.ceil(np.log10(hi / lo) * bins_per_decade))
+        self.edges = lo * 10.0 ** (np.arange(n_bins + 1) / bins_per_decade)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.n_zero = 0
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = 0.0
+
+    def add(self, values: np.ndarray) -> None:
+        v = np.asarray(values, dtype=float).ravel()
+        v = v[np.isfinite(v)]
+        if v.size == 0:
+            return
+        v = np.maximum(v, 0.0)
+        self.n += v.size
+        self.total += float(v.sum())
+        self.total_sq += float((v * v).sum())
+        self.max = max(self.max, float(v.max()))
+        pos = v[v >= self.edges[0]]
+        self.n_zero += v.size - pos.size
+        idx = np.clip(np.searchsorted(self.edges, pos, side="right") - 1, 0, len(self.counts) - 1)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+
+    def merge(self, other: "DamageSketch") -> None:
+        if len(other.counts) != len(self.counts) or other.edges[0] != self.edges[0]:
+            raise ValueError("ビン設定の異なる DamageSketch は merge できません")
+        self.counts += other.counts
+        self.n_zero += other.n_zero
+        self.n += other.n
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.n if self.n else np.nan
+
+    @property
+    def std_error(self) -> float:
+        """ 平均の標準誤差（モンテカルロ誤差）"""
+        if self.n < 2:
+            return np.nan
+        var = (self.total_sq - self.n * self.mean ** 2) / (self.n - 1)
+        return float(np.sqrt(max(var, 0.0) / self.n))
+
+    @property
+    def p_positive(self) -> float:
+        return (self.n - self.n_zero) / self.n if self.n else np.nan
+
+    def exceedance(self, aep: Sequence[float]) -> np.ndarray:
+        """
+        年超過確率 aep に対応する値（= 1 - aep 分位）。ビン内は対数で線形補間する。
+        """
+        aep = np.asarray(aep, dtype=float)
+        out = np.full(aep.shape, np.nan)
+        if self.n == 0:
+            return out
+        # 上から数えた累積件数（ビンの下端を超える件数）
+        above = np.concatenate([np.cumsum(self.counts[::-1])[::-1], [0]])
+        target = aep * self.n
+        for k, t in enumerate(target):
+            if t >= above[0]:
+                out[k] = 0.0              # 0 の年が超過確率 aep 以上を占める
+                continue
+            j = int(np.searchsorted(-above, -t, side="left")) - 1   # above[j] > t >= above[j+1]
+            c = self.counts[j]
+            frac = (above[j] - t) / c if c else 0.0
+            lo, hi = np.log(self.edges[j]), np.log(self.edges[j + 1])
+            out[k] = min(float(np.exp(lo + frac * (hi - lo))), self.max)
+        return out
+
+
+# =========================
+# ワーカー側の集計
+# =========================
+def annual_damage(res: pd.DataFrame) -> List[List[float]]:
+    """
+    メンバー 1 本の日別出力を、年ごとの [指標1 年合計, 指標1 日最大, 指標2 年合計, ...] にする。
+    （pickle 可能なトップレベル関数。親プロセスには年数 × 4 個の数値だけが返る）
+    """
+    year = (np.asarray(res.index, dtype=float) // N_DAYS).astype(int)
+    rows = []
+    for y in np.unique(year):
+        sel = year == y
+        row = []
+        for col in DAMAGE_COLS:
+            x = pd.to_numeric(res[col], errors="coerce").to_numpy(float)[sel]
+            row += [float(np.nansum(x)), float(np.nanmax(x)) if np.isfinite(x).any() else np.nan]
+        rows.append(row)
+    return rows
+
+
+# =========================
+# パイプライン
+# =========================
+def block_size(n_vars: int, n_days: int, budget_mb: float = MEMORY_BUDGET_MB) -> int:
+    """ 1 ブロックの実現数。強制データ（変数 × 日数の float64）の重複込みで予算に収める """
+    per_member = n_vars * n_days * 8 * BYTES_PER_VALUE_OVERHEAD
+    return int(max(1, min(MAX_BLOCK, budget_mb * 1024 ** 2 // per_member)))
+
+
+def effect_year(params: Dict[str, float]) -> float:
+    """
+    堤防・ダム投資の効果が出始める年（開始年 + 投資の 1 年 + 建設期間）。投資が無ければ 0。
+    建設期間は 3 次遅れの平均なので、この年までに効果の大半が出る（ちょうど切り替わるわけではない）。
+    """
+    year = 0.0
+    for amount, (start, lag, default_lag) in CONSTRUCTION.items():
+        if float(params.get(amount, 0) or 0) > 0:
+            year = max(year, float(params.get(start, 0)) + 1 + float(params.get(lag, default_lag)))
+    return year
+
+
+def new_sketches(policies: Sequence[str]) -> Dict[tuple, DamageSketch]:
+    return {(p, col, s): DamageSketch() for p in policies for col in DAMAGE_COLS for s in STATS}
+
+
+def simulate_risk(
+    gen: WeatherGenerator,
+    n_members: int,
+    policies: Dict[str, Dict[str, float]] | None = None,
+    params: Dict[str, float] | None = None,
+    sim_years: int = SIM_YEARS,
+    burn_in: int = BURN_IN,
+    seed: int = 42,
+    workers: int | None = None,
+    budget_mb: float = MEMORY_BUDGET_MB,
+) -> Dict[tuple, DamageSketch]:
+    """
+    n_members 本の合成気象（各 sim_years 年）を全適応策で実行し、先頭 burn_in 年を除いた
+    年値をスケッチに溜める。戻り値は {(策, 指標, 統計): DamageSketch}。
+    burn_in は投資開始直後の効果が出る前の年を評価から外すためのもの。
+    堤防・ダムの効果が出る年（effect_year）より評価期間が前にかかる策には警告を出す。
+    """
+    policies = POLICIES if policies is None else policies
+    if burn_in >= sim_years:
+        raise ValueError("burn_in は sim_years より小さくしてください")
+    for name, overrides in policies.items():
+        year = effect_year({**BASE_PARAMS, **(params or {}), **overrides})
+        if year >= sim_years:
+            print(f"  warning: {name} の投資は {year:g} 年目ごろまで効かず、sim_years={sim_years} では基準策と同じ結果になります")
+        elif year > burn_in:
+            print(f"  warning: {name} の投資は {year:g} 年目ごろから効きます。burn_in={burn_in} では効果が薄まります")
+    n_days = N_DAYS * sim_years
+    base = {**BASE_PARAMS, **(params or {})}
+    sketches = new_sketches(policies)
+    block = block_size(len(gen.variables) + 1, n_days, budget_mb)   # + 降水量
+    n_failed = 0
+
+    for b, s in enumerate(range(0, n_members, block)):
+        n = min(block, n_members - s)
+        sim = gen.generate(n, n_days, seed=seed + b)
+        sets = [member_params(sim, i) for i in range(n)]
+        del sim
+        for name, overrides in policies.items():
+            res = run_ensemble(sets, DAMAGE_COLS, timestamps=list(range(n_days)),
+                               base_params={**base, **overrides}, reducer=annual_damage,
+                               workers=workers, errors="ignore")
+            ok = [np.asarray(r, dtype=float)[burn_in:] for r in res if r is not None]
+            n_failed += len(res) - len(ok)
+            if not ok:
+                continue
+            arr = np.concatenate(ok)                       # (年数, 指標 × 統計)
+            for c, col in enumerate(DAMAGE_COLS):
+                for k, st in enumerate(STATS):
+                    sketches[(name, col, st)].add(arr[:, c * len(STATS) + k])
+        del sets
+        print(f"  members {s + n}/{n_members} (block {block}, policies {len(policies)})")
+
+    if n_failed:
+        print(f"  warning: {n_failed} 件のメンバーが失敗し、集計から除外しました")
+    return sketches
+
+
+def ead_table(sketches: Dict[tuple, DamageSketch], baseline: str = "baseline") -> pd.DataFrame:
+    """ 策 × 指標ごとの EAD（年合計の平均）とその標準誤差、被害発生確率、基準策からの削減額 """
+    rows = []
+    for (policy, col, st), sk in sketches.items():
+        if st != "annual_total":
+            continue
+        rows.append({"policy": policy, "indicator": col, "n_years": sk.n, "ead": sk.mean,
+                     "ead_se": sk.std_error, "p_damage": sk.p_positive, "max_annual": sk.max})
+    df = pd.DataFrame(rows)
+    if baseline in set(df["policy"]):
+        ref = df[df["policy"] == baseline].set_index("indicator")["ead"]
+        df["ead_reduction"] = df["indicator"].map(ref) - df["ead"]
+    return df
+
+
+def exceedance_curves(sketches: Dict[tuple, DamageSketch], levels: Sequence[float] = AEP_LEVELS) -> pd.DataFrame:
+    """ 策 × 指標 × 統計ごとの損失超過曲線（AEP → 値）。件数に対して細かすぎる AEP は reliable=False """
+    levels = np.asarray(levels, dtype=float)
+    frames = []
+    for (policy, col, st), sk in sketches.items():
+        frames.append(pd.DataFrame({
+            "policy": policy, "indicator": col, "stat": st,
+            "aep": levels, "return_period": 1.0 / levels,
+            "value": sk.exceedance(levels),
+            "reliable": levels >= 1.0 / (sk.n + 1.0),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="適応策ごとのモンテカルロ洪水被害リスク（EAD・損失超過曲線）")
+    parser.add_argument("--generator", type=Path, default=None, help="保存済みの気象発生器（weather_generator.py の出力）")
+    parser.add_argument("--source", choices=["observed", "nies"], default="observed", help="--generator が無いときの較正データ")
+    parser.add_argument("--ssp", default="245", help="--source nies の SSP")
+    parser.add_argument("--gcm", default="MIROC6", help="--source nies の GCM")
+    parser.add_argument("--years", nargs=2, type=int, default=[2015, 2044], help="--source nies の期間（開始 終了）")
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), choices=list(POLICIES), help="評価する適応策")
+    parser.add_argument("--n-members", type=int, default=N_MEMBERS, help="合成気象の本数")
+    parser.add_argument("--sim-years", type=int, default=SIM_YEARS, help="1 本あたりの年数（堤防・ダムの建設期間より長く）")
+    parser.add_argument("--burn-in", type=int, default=BURN_IN, help="評価から外す先頭の年数（投資の効果が出る前の年）")
+    parser.add_argument("--memory-mb", type=float, default=MEMORY_BUDGET_MB, help="1 ブロックのメモリ予算（MB）")
+    parser.add_argument("--params", type=Path, default=OPT_RESULT, help="水文パラメータ（Vensim 成果物、無ければ既定値）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    args = parser.parse_args()
+
+    if args.generator is not None:
+        gen = WeatherGenerator.load(args.generator)
+    elif args.source == "observed":
+        gen = WeatherGenerator.fit(load_observed())
+    else:
+        gen = WeatherGenerator.fit(load_nies(args.ssp, args.gcm, range(args.years[0], args.years[1] + 1)))
+
+    params = {}
+    if args.params and args.params.exists():
+        from pysd_ensemble import get_model
+        from vensim_artifacts import load_calibrated_params
+        params = load_calibrated_params(args.params, get_model())
+
+    sketches = simulate_risk(gen, args.n_members, {p: POLICIES[p] for p in args.policies}, params,
+                             sim_years=args.sim_years, burn_in=args.burn_in, seed=args.seed,
+                             workers=args.workers, budget_mb=args.memory_mb)
+    ead = ead_table(sketches)
+    curves = exceedance_curves(sketches)
+    print(ead.to_string(index=False))
+
+    RISK_DIR.mkdir(parents=True, exist_ok=True)
+    ead.to_csv(RISK_DIR / "flood_risk_ead.csv", index=False, encoding="utf-8")
+    curves.to_csv(RISK_DIR / "flood_risk_exceedance.csv", index=False, encoding="utf-8")
+    print(f"  -> {RISK_DIR / 'flood_risk_ead.csv'}")
+    print(f"  -> {RISK_DIR / 'flood_risk_exceedance.csv'}")
+
+
+if __name__ == "__main__":
+    main()
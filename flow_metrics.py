@@ -0,0 +1,241 @@
+# flow_metrics.py
+# -*- coding: utf-8 -*-
+"""
+観測流量とモデル流量の比較指標（配列で一括計算）。
+
+- lag_correlogram: ±max_lag 日のラグ相関を FFT の相互相関でまとめて求める
+  （ラグごとに Series をずらして corr を取るのと同じ値。欠測はラグごとの重なりから除く）
+- skill_scores: (n_members, n_days) のシミュレーションと観測から RMSE / MAE / Bias / r / NSE / KGE / log-NSE /
+  ピーク時期の誤差とペイオフ構成要素をメンバー分まとめて計算する（メンバーごとの Python ループなし）
+- 先頭の軸（観測所・アンサンブルメンバーなど）はブロードキャストしてまとめて計算する
+"""
+from __future__ import annotations
+
+from typing import Dict, Mapping, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# ペイオフ構成要素（モデルの flow log error sq / high flow error / top flow error と同じ式）
+LOG_ERROR_START = 10
+HIGH_FLOW = 3.6e7
+TOP_FLOW = 1.23e8
+
+
+def _next_fft_len(n: int) -> int:
+    return 1 << max(0, int(n - 1).bit_length())
+
+
+def _xcorr(a: np.ndarray, b: np.ndarray, nfft: int, max_lag: int) -> np.ndarray:
+    """ c[k] = Σ_t a[t] b[t-k]（k = -max_lag..max_lag）"""
+    c = np.fft.irfft(np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft)), nfft)
+    return np.concatenate([c[..., nfft - max_lag:], c[..., :max_lag + 1]], axis=-1)
+
+
+def lag_correlogram(
+    obs: np.ndarray,
+    sim: np.ndarray,
+    max_lag: int,
+    min_periods: int = 2,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    r[..., k] = corr(obs[t], sim[t - lag_k])（pandas の obs.corr(sim.shift(lag)) と同じ向き）を返す。
+    obs, sim は (..., n_days)。NaN は欠測として、ラグごとに両方そろう日だけで相関を取る。
+    重なりが min_periods 未満・分散 0 のラグは NaN。戻り値は (lags, r)。
+    """
+    x = np.asarray(obs, dtype=float)
+    y = np.asarray(sim, dtype=float)
+    x, y = np.broadcast_arrays(x, y)
+    n = x.shape[-1]
+    max_lag = int(min(max_lag, max(n - 1, 0)))
+    lags = np.arange(-max_lag, max_lag + 1)
+
+    mx = np.isfinite(x)
+    my = np.isfinite(y)
+    # 相関は系列ごとの 1 次変換で変わらないので、桁落ちを避けるため先に標準化しておく
+    x = _standardize(x, mx)
+    y = _standardize(y, my)
+    mx_f, my_f = mx.astype(float), my.astype(float)
+
+    nfft = _next_fft_len(n + max_lag + 1)
+    cnt = _xcorr(mx_f, my_f, nfft, max_lag)
+    sx = _xcorr(x, my_f, nfft, max_lag)
+    sy = _xcorr(mx_f, y, nfft, max_lag)
+    sxx = _xcorr(x * x, my_f, nfft, max_lag)
+    syy = _xcorr(mx_f, y * y, nfft, max_lag)
+    sxy = _xcorr(x, y, nfft, max_lag)
+
+    cnt = np.rint(cnt)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sxy - sx * sy / cnt
+        vx = sxx - sx * sx / cnt
+        vy = syy - sy * sy / cnt
+        r = cov / np.sqrt(vx * vy)
+    tol = 1e-10 * np.maximum(cnt, 1.0)
+    r = np.where((cnt >= max(min_periods, 2)) & (vx > tol) & (vy > tol), r, np.nan)
+    return lags, np.clip(r, -1.0, 1.0)
+
+
+def _standardize(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    n = np.maximum(mask.sum(axis=-1, keepdims=True), 1)
+    z = np.where(mask, x, 0.0)
+    mu = z.sum(axis=-1, keepdims=True) / n
+    z = np.where(mask, x - mu, 0.0)
+    sd = np.sqrt((z * z).sum(axis=-1, keepdims=True) / n)
+    return z / np.where(sd > 0, sd, 1.0)
+
+
+def best_lag(
+    obs: np.ndarray,
+    sim: np.ndarray,
+    max_lag: int,
+    min_periods: int = 2,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    相関が最大のラグ（同値なら負側）とその相関、およびコレログラム全体 (lags, r) を返す。
+    戻り値: (best_lag, best_r, lags, r)。1 次元入力なら best_lag / best_r はスカラー配列。
+    """
+    lags, r = lag_correlogram(obs, sim, max_lag, min_periods)
+    filled = np.where(np.isnan(r), -1.0, r)     # 計算できないラグは相関 -1 扱い（app の従来の挙動）
+    i = np.argmax(filled, axis=-1)
+    return lags[i], np.take_along_axis(filled, i[..., None], axis=-1)[..., 0], lags, r
+
+
+def correlogram_frame(obs: pd.DataFrame, sim: pd.DataFrame, max_lag: int) -> pd.DataFrame:
+    """
+    日付で揃えた観測・モデルの表（列 = 観測所など）のラグ相関表（行 = ラグ、列 = 共通の列名）。
+    日付の欠けは NaN で埋めてから計算するので、ラグは日数どおりになる。
+    """
+    cols = [c for c in obs.columns if c in sim.columns]
+    idx = obs.index.union(sim.index)
+    if isinstance(idx, pd.DatetimeIndex) and len(idx):
+        idx = pd.date_range(idx.min(), idx.max(), freq="D")
+    x = obs.reindex(idx)[cols].to_numpy(dtype=float).T
+    y = sim.reindex(idx)[cols].to_numpy(dtype=float).T
+    lags, r = lag_correlogram(x, y, max_lag)
+    return pd.DataFrame(r.T, index=pd.Index(lags, name="lag"), columns=cols)
+
+
+# =========================
+# スキルスコア（メンバー一括）
+# =========================
+def payoff_components(sim: np.ndarray, obs: np.ndarray, t: np.ndarray) -> Dict[str, np.ndarray]:
+    """ モデルのペイオフ構成要素を配列で再計算する（sim, obs は (..., n_days)）"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_sq = (np.log(obs) - np.log(sim)) ** 2
+    return {
+        "flow_log_error_sq": np.where(t < LOG_ERROR_START, 0.0, log_sq),
+        "high_flow_error": np.where(obs > HIGH_FLOW, ((obs - sim) / HIGH_FLOW) ** 2, 0.0),
+        "top_flow_error": np.where(obs > TOP_FLOW, ((obs - sim) / TOP_FLOW) ** 2, 0.0),
+    }
+
+
+def payoff_scores(
+    sim: np.ndarray,
+    obs: np.ndarray,
+    t: np.ndarray | None = None,
+    weights: Mapping[str, float] | None = None,
+    mask: np.ndarray | None = None,
+) -> Dict[str, np.ndarray]:
+    """
+    構成要素ごとの -Σ(重み×値)^2 と合計 "total"（calibration_payoff と同じ定義）を (...,) の配列で返す。
+    weights を省略すると重み 1（pysd_ensemble.PAYOFF_WEIGHTS を渡せばキャリブレーションと同じ）。
+    mask が False の日は数えない。
+    """
+    sim = np.asarray(sim, dtype=float)
+    obs = np.asarray(obs, dtype=float)
+    t = np.arange(sim.shape[-1]) if t is None else np.asarray(t, dtype=float)
+    comps = payoff_components(sim, obs, t)
+    out: Dict[str, np.ndarray] = {}
+    for k, v in comps.items():
+        w = 1.0 if weights is None else float(weights.get(k, 1.0))
+        v = (w * v) ** 2
+        if mask is not None:
+            v = np.where(mask, v, 0.0)
+        out[k] = -np.nansum(v, axis=-1)
+    out["total"] = sum(out.values())
+    return out
+
+
+def _nse(sim: np.ndarray, obs: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    cnt = valid.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mo = np.where(valid, obs, 0.0).sum(axis=-1) / cnt
+        sse = np.where(valid, (sim - obs) ** 2, 0.0).sum(axis=-1)
+        sso = np.where(valid, (obs - mo[..., None]) ** 2, 0.0).sum(axis=-1)
+        return np.where(sso > 0, 1.0 - sse / sso, np.nan)
+
+
+def skill_scores(
+    sim: np.ndarray,
+    obs: np.ndarray,
+    mask: np.ndarray | None = None,
+    t: np.ndarray | None = None,
+    weights: Mapping[str, float] | None = None,
+) -> Dict[str, np.ndarray]:
+    """
+    sim (n_members, n_days) と obs (n_days,) または (n_members, n_days) の比較指標をメンバー分まとめて返す。
+    mask（True = 使う日）と NaN の日は除く。各値は (n_members,) の配列。
+    - RMSE / MAE / Mean Bias（sim - obs）/ Pearson r / NSE
+    - KGE（2009 年版: r・分散比・平均比）と log-NSE（正の値の日だけ）
+    - Peak timing（日）: 有効な日の中での sim の最大日 - obs の最大日
+    - ペイオフ構成要素と合計（payoff_scores と同じ。キーは "payoff_<名前>"）
+    """
+    sim = np.atleast_2d(np.asarray(sim, dtype=float))
+    obs = np.broadcast_to(np.asarray(obs, dtype=float), sim.shape)
+    valid = np.isfinite(sim) & np.isfinite(obs)
+    if mask is not None:
+        valid &= np.broadcast_to(np.asarray(mask, dtype=bool), sim.shape)
+    cnt = valid.sum(axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ms = np.where(valid, sim, 0.0).sum(axis=-1) / cnt
+        mo = np.where(valid, obs, 0.0).sum(axis=-1) / cnt
+        d = np.where(valid, sim - obs, 0.0)
+        ds = np.where(valid, sim - ms[:, None], 0.0)
+        do = np.where(valid, obs - mo[:, None], 0.0)
+        sss, soo, sso = (ds * ds).sum(axis=-1), (do * do).sum(axis=-1), (ds * do).sum(axis=-1)
+        r = np.where((sss > 0) & (soo > 0), sso / np.sqrt(sss * soo), np.nan)
+        alpha = np.sqrt(sss / soo)
+        beta = ms / mo
+        kge = 1.0 - np.sqrt((r - 1.0) ** 2 + (alpha - 1.0) ** 2 + (beta - 1.0) ** 2)
+        pos = valid & (sim > 0) & (obs > 0)
+        log_nse = _nse(np.log(np.where(pos, sim, 1.0)), np.log(np.where(pos, obs, 1.0)), pos)
+
+        peak = np.argmax(np.where(valid, sim, -np.inf), axis=-1) - np.argmax(np.where(valid, obs, -np.inf), axis=-1)
+        scores = {
+            "RMSE": np.sqrt((d * d).sum(axis=-1) / cnt),
+            "MAE": np.abs(d).sum(axis=-1) / cnt,
+            "Mean Bias": d.sum(axis=-1) / cnt,
+            "Pearson r": r,
+            "NSE": np.where(soo > 0, 1.0 - (d * d).sum(axis=-1) / soo, np.nan),
+            "KGE": kge,
+            "log-NSE": log_nse,
+            "Peak timing": np.where(cnt > 0, peak, np.nan).astype(float),
+        }
+    for k, v in payoff_scores(sim, obs, t, weights, valid).items():
+        scores[f"payoff_{k}"] = v
+    return scores
+
+
+def score_table(
+    sim: np.ndarray | pd.DataFrame,
+    obs: np.ndarray | pd.Series,
+    mask: np.ndarray | None = None,
+    t: np.ndarray | None = None,
+    weights: Mapping[str, float] | None = None,
+) -> pd.DataFrame:
+    """
+    skill_scores を表にする（行 = メンバー）。sim が DataFrame（列 = メンバー、行 = 日）なら
+    obs を同じ行に揃えてから計算し、列名を行ラベルに使う。
+    """
+    if isinstance(sim, pd.DataFrame):
+        if isinstance(obs, pd.Series):
+            obs = obs.reindex(sim.index)
+        labels = sim.columns
+        sim = sim.to_numpy(dtype=float).T
+    else:
+        sim = np.atleast_2d(np.asarray(sim, dtype=float))
+        labels = pd.RangeIndex(sim.shape[0], name="member")
+    return pd.DataFrame(skill_scores(sim, np.asarray(obs, dtype=float), mask, t, weights), index=labels)
@@ -45,42 +45,43 @@ def _http_get(url: str, timeout=25) -> str:
     r.raise_for_status()
     return _decode(r)
 
-def _follow_frames(html: str, base_url: str) -> tuple[str, str]:
+def _follow_frames(html: str, base_url: str, http_get=_http_get) -> tuple[str, str]:
     soup = BeautifulSoup(html, "lxml")
     fr = soup.find(["iframe", "frame"])
     if fr and fr.get("src"):
         next_url = urljoin(base_url, fr["src"])
-        nxt = _http_get(next_url)
+        nxt = http_get(next_url)
         return nxt, next_url
     meta = soup.find("meta", attrs={"http-equiv": re.compile(r"refresh", re.I)})
     if meta and "content" in meta.attrs:
         m = re.search(r"url\s*=\s*([^;]+)", meta["content"], flags=re.I)
         if m:
             next_url = urljoin(base_url, m.group(1).strip())
-            nxt = _http_get(next_url)
+            nxt = http_get(next_url)
             return nxt, next_url
     return html, base_url
 
-def _fetch_year_page(station_id: str, year: int) -> tuple[str, str]:
+def _fetch_year_page(station_id: str, year: int, http_get=_http_get, bases=WIS_BASES) -> tuple[str, str]:
     params = f"ID={station_id}&KIND=7&KAWABOU=NO&BGNDATE={year}0101&ENDDATE={year}1231"
     last_err = None
-    for base in WIS_BASES:
+    for base in bases:
         url = f"{base}/DspWaterData.exe?{params}"
         try:
-            html = _http_get(url)
-            html2, url2 = _follow_frames(html, url)
+            html = http_get(url)
+            html2, url2 = _follow_frames(html, url, http_get)
             return html2, url2
         except Exception as e:
             last_err = e
     raise RuntimeError(f"年表取得に失敗: ID={station_id}, year={year}, err={last_err}")
 
-def _fetch_csv_text(station_id: str, bgn: date, end: date) -> tuple[str|None, str|None]:
+def _fetch_csv_text(station_id: str, bgn: date, end: date,
+                    http_get=_http_get, bases=WIS_BASES) -> tuple[str|None, str|None]:
     params = f"ID={station_id}&KIND=7&KAWABOU=NO&BGNDATE={bgn:%Y%m%d}&ENDDATE={end:%Y%m%d}&CSV=1"
-    for base in WIS_BASES:
+    for base in bases:
         url = f"{base}/DspWaterData.exe?{params}"
         try:
-            txt = _http_get(url)
-            txt2, url2 = _follow_frames(txt, url)
+            txt = http_get(url)
+            txt2, url2 = _follow_frames(txt, url, http_get)
             if re.search(r"^\s*\d{4}/\d{1,2}/\d{1,2}\s*,", txt2, flags=re.M):
                 return txt2, url2
         except Exception:
@@ -259,13 +260,13 @@ def forward_fill_missing(df: pd.DataFrame) -> pd.DataFrame:
     out["flow"] = out["flow"].ffill()
     return out
 
-def _parse_dat_link_to_df(page_html: str, year_page_url: str) -> pd.DataFrame:
+def _parse_dat_link_to_df(page_html: str, year_page_url: str, http_get=_http_get) -> pd.DataFrame:
     soup = BeautifulSoup(page_html, "lxml")
     a = soup.find("a", href=re.compile(r"/dat/(?:dload/)?download/.*\.dat", re.I))
     if not a or not a.get("href"):
         return pd.DataFrame()
     dat_url = urljoin(year_page_url, a["href"])
-    txt = _http_get(dat_url)
+    txt = http_get(dat_url)
     df = _parse_daily_csv_lines(txt)
     return df
 
@@ -288,36 +289,95 @@ def _parse_year_arg(arg: str) -> list[int]:
         return [int(s)]
     raise ValueError("年は 'YYYY' または 'YYYY-YYYY' で指定してください。")
 
+def _save_year(df: pd.DataFrame, rep: str, y: int, fill_forward: bool) -> None:
+    outpath = pathlib.Path.cwd() / f"flow_{rep}_{y}.csv"
+    df.to_csv(outpath, index=False, encoding="utf-8")
+    print(f"[OK] saved: {outpath}")
+
+    if fill_forward:
+        dff = forward_fill_missing(df)
+        outpath2 = pathlib.Path.cwd() / f"flow_{rep}_{y}_filled.csv"
+        dff.to_csv(outpath2, index=False, encoding="utf-8")
+        print(f"[OK] saved: {outpath2}")
+
+def _read_year_files(rep: str, years: list[int]) -> pd.DataFrame:
+    """ --sync 用：既存の flow_<rep>_<year>.csv をまとめて手元の表にする """
+    from wis_downloader import read_local_flow
+
+    frames = [read_local_flow(p) for y in years if (p := pathlib.Path.cwd() / f"flow_{rep}_{y}.csv").exists()]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["date", "flow"])
+
 def main():
     parser = argparse.ArgumentParser(description="WIS 日流量取得（年ごとCSV出力）")
-    parser.add_argument("rep", help="代表地点（REP_TO_ID のキー）")
+    parser.add_argument("rep", help="代表地点（REP_TO_ID のキー）。カンマ区切りで複数可")
     parser.add_argument("year", help="年（例: 2015）または 範囲（例: 2008-2018）")
     parser.add_argument("--fill-forward", action="store_true",
                         help="欠測を前日値で補間したCSVも一緒に出力（_filled 付き）")
-    parser.add_argument("--pause", type=float, default=0.3, help="アクセス間隔秒（既定0.3）")
+    parser.add_argument("--pause", type=float, default=0.3, help="アクセス間隔秒（既定0.3、--no-cache かつ --workers 1 のとき）")
+    parser.add_argument("--workers", type=int, default=1, help="同時取得数（既定1）")
+    parser.add_argument("--rate", type=float, default=2.0, help="全体のリクエスト上限（回/秒、既定2.0）")
+    parser.add_argument("--cache", default=".http_cache", help="応答キャッシュの置き場所（既定 .http_cache）")
+    parser.add_argument("--no-cache", action="store_true", help="応答キャッシュを使わない")
+    parser.add_argument("--sync", action="store_true",
+                        help="既存の flow_<rep>_<year>.csv に無い月・暫定の月だけ取得して更新")
+    parser.add_argument("--store", type=pathlib.Path, default=None,
+                        help="この日流量CSV（例: data/flow_sumimata_2008_2009.csv）を手元の表として差分同期する")
     args = parser.parse_args()
 
-    rep = args.rep
-    if rep not in REP_TO_ID:
-        sys.exit(f"代表地点 '{rep}' が REP_TO_ID に見つかりません。辞書に追加してください。")
+    reps = [r.strip() for r in args.rep.split(",") if r.strip()]
+    unknown = [r for r in reps if r not in REP_TO_ID]
+    if unknown:
+        sys.exit(f"代表地点 {unknown} が REP_TO_ID に見つかりません。辞書に追加してください。")
+    if args.store is not None and len(reps) != 1:
+        sys.exit("--store を使うときは代表地点を1つだけ指定してください。")
 
-    station_id = REP_TO_ID[rep]
     years = _parse_year_arg(args.year)
 
-    for y in years:
-        start, end = date(y, 1, 1), date(y, 12, 31)
-        print(f"[INFO] fetching {rep} (ID={station_id}) {y} ...")
-        df = get_daily_discharge(station_id, start, end, pause_sec=args.pause)
-
-        outpath = pathlib.Path.cwd() / f"flow_{rep}_{y}.csv"
-        df.to_csv(outpath, index=False, encoding="utf-8")
-        print(f"[OK] saved: {outpath}")
-
-        if args.fill_forward:
-            dff = forward_fill_missing(df)
-            outpath2 = pathlib.Path.cwd() / f"flow_{rep}_{y}_filled.csv"
-            dff.to_csv(outpath2, index=False, encoding="utf-8")
-            print(f"[OK] saved: {outpath2}")
+    if args.no_cache and args.workers <= 1 and not (args.sync or args.store):
+        for rep in reps:
+            station_id = REP_TO_ID[rep]
+            for y in years:
+                start, end = date(y, 1, 1), date(y, 12, 31)
+                print(f"[INFO] fetching {rep} (ID={station_id}) {y} ...")
+                df = get_daily_discharge(station_id, start, end, pause_sec=args.pause)
+                _save_year(df, rep, y, args.fill_forward)
+        return
+
+    # 全地点・全年の (観測所, 月) をまとめて取得し（キャッシュ済みで確定した月は通信しない）、年ごとに分けて保存する
+    from http_cache import HttpCache
+    from wis_downloader import WisDownloader, is_wis_table, read_local_flow, uses_slash_dates, write_local_flow
+
+    start, end = date(years[0], 1, 1), date(years[-1], 12, 31)
+    cache = None if args.no_cache else HttpCache(args.cache)
+    mode = "sync" if (args.sync or args.store) else "full"
+    print(f"[INFO] fetching {','.join(reps)} {years[0]}-{years[-1]} ({mode}, workers={args.workers}, rate={args.rate}/s) ...")
+    with WisDownloader(workers=args.workers, rate=args.rate, cache=cache) as dl:
+        if args.store is not None:
+            store = args.store
+            table = store.exists() and is_wis_table(store)
+            local = read_local_flow(store) if store.exists() else pd.DataFrame(columns=["date", "flow"])
+            merged = dl.sync(REP_TO_ID[reps[0]], local, start, end)
+            # WIS 年表形式の元ファイルは上書きせず、date,flow 形式で隣に保存する
+            out = store.with_name(f"{store.stem}_daily.csv") if table else store
+            write_local_flow(merged, out, slash_dates=store.exists() and not table and uses_slash_dates(store))
+            print(f"[OK] saved: {out} ({len(merged) - len(local):+d} rows)")
+            flows = None
+        elif args.sync:
+            flows = {REP_TO_ID[rep]: dl.sync(REP_TO_ID[rep], _read_year_files(rep, years), start, end) for rep in reps}
+        else:
+            flows = dl.download([REP_TO_ID[r] for r in reps], start, end)
+        print(f"[INFO] requests={dl.stats['requests']} retries={dl.stats['retries']}"
+              + (f" cache={cache.stats}" if cache is not None else ""))
+    if flows is None:
+        return
+    for rep in reps:
+        df = flows[REP_TO_ID[rep]]
+        for y in years:
+            dfy = df[[d.year == y for d in df["date"]]].reset_index(drop=True)
+            if dfy.empty:
+                print(f"[WARN] {rep} {y}: 日データを取得できませんでした。")
+                continue
+            _save_year(dfy, rep, y, args.fill_forward)
 
 if __name__ == "__main__":
     main()
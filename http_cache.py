@@ -0,0 +1,178 @@
+# http_cache.py
+# -*- coding: utf-8 -*-
+"""
+スクレイパ（WIS / 気象庁）用のディスク上の HTTP 応答キャッシュ。
+
+- キーは (エンドポイント, 地点, 期間)。同じキーでも URL（ミラーのホスト・フレーム先など）ごとに別エントリ
+- accept を渡すと、それを満たす本文だけを保存・再利用する（200 で返るメンテナンス画面などを残さない）
+- 期間が確定した後に取得した応答はそのまま使う（通信しない）
+- まだ暫定の期間は ETag / Last-Modified 付きの条件付き GET で問い合わせ、304 なら保存済みの本文を使う
+- 取得処理は呼び出し側から渡す（requests / urllib どちらでもよい）
+
+レイアウト:
+    <root>/<endpoint>/<station>/<period>_<URL のハッシュ>.body   応答本文（bytes）
+    <root>/<endpoint>/<station>/<period>_<URL のハッシュ>.json   url, etag, last_modified, content_type, fetched_at
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Mapping, Tuple
+from urllib.parse import urlsplit
+
+
+CACHE_DIR = Path(".http_cache")
+SETTLE_DAYS = 5     # 期間の終わりからこの日数が過ぎたら確定とみなす（それまでは暫定値として取り直す）
+
+# fetch(url, 追加ヘッダ) -> (status, 本文, 応答ヘッダ)。304 のときの本文は空でよい
+Fetch = Callable[[str, Dict[str, str]], Tuple[int, bytes, Mapping[str, str]]]
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    content_type: str
+    from_cache: bool      # True: ネットワークに出ていない
+    revalidated: bool     # True: 304 で保存済みの本文を使った
+
+
+def settle_date(period_end: date, settle_days: int = SETTLE_DAYS) -> date:
+    """ この日より後に取得した応答は確定値とみなす """
+    return period_end + timedelta(days=settle_days)
+
+
+def is_provisional(period_end: date, today: date | None = None, settle_days: int = SETTLE_DAYS) -> bool:
+    return (today or date.today()) <= settle_date(period_end, settle_days)
+
+
+def _safe(part: str) -> str:
+    return re.sub(r"[^0-9A-Za-z_.-]", "_", str(part)) or "_"
+
+
+def urllib_fetch(headers: Mapping[str, str] | None = None, timeout: float = 30) -> Fetch:
+    """ urllib で取る fetch を作る（304 は HTTPError になるので status として返す）"""
+    base = dict(headers or {})
+
+    def fetch(url: str, extra: Dict[str, str]) -> Tuple[int, bytes, Mapping[str, str]]:
+        req = urllib.request.Request(url, headers={**base, **extra})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return resp.status, resp.read(), resp.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304, b"", e.headers
+            raise
+
+    return fetch
+
+
+class HttpCache:
+    """
+        cache = HttpCache(".http_cache")
+        res = cache.get(url, ("jma_daily", "47807", "2023-05"), fetch, settled_after=date(2023, 6, 5))
+        res.body, res.from_cache
+    """
+
+    def __init__(self, root: str | os.PathLike = CACHE_DIR):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "fetched": 0, "rejected": 0}
+
+    def _paths(self, url: str, key: Tuple[str, str, str]) -> Tuple[Path, Path]:
+        endpoint, station, period = key
+        # ミラーごとに別エントリ（あるミラーの応答を別のミラーの分として返さない）
+        parts = urlsplit(url)
+        h = hashlib.sha1(f"{parts.netloc}{parts.path}?{parts.query}".encode("utf-8")).hexdigest()[:10]
+        d = self.root / _safe(endpoint) / _safe(station)
+        stem = f"{_safe(period)}_{h}"
+        return d / f"{stem}.body", d / f"{stem}.json"
+
+    def _load(self, url: str, key) -> Tuple[dict, bytes] | None:
+        body_path, meta_path = self._paths(url, key)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            return meta, body_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, url: str, key, body: bytes, headers: Mapping[str, str]) -> None:
+        body_path, meta_path = self._paths(url, key)
+        body_path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "content_type": headers.get("Content-Type") or "",
+            "fetched_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        # 本文 → メタの順に置き換える（メタがあれば本文もそろっている）
+        for path, data in ((body_path, body), (meta_path, json.dumps(meta, ensure_ascii=False).encode("utf-8"))):
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(
+        self,
+        url: str,
+        key: Tuple[str, str, str],
+        fetch: Fetch,
+        settled_after: date | None = None,
+        accept: Callable[[bytes], bool] | None = None,
+    ) -> CachedResponse:
+        """
+        key = (エンドポイント, 地点, 期間)。settled_after より後に取得済みなら通信せずに返す。
+        それ以外は条件付き GET。fetch が例外を投げたときはそのまま投げる（古い本文では代用しない）。
+        accept(本文) が False の応答は保存せずにそのまま返す（保存済みでも満たさなければ無いものとして取り直す）。
+        """
+        cached = self._load(url, key)
+        if cached is not None and accept is not None and not accept(cached[1]):
+            cached = None
+        if cached is not None:
+            meta, body = cached
+            fetched_at = datetime.fromisoformat(meta["fetched_at"]).date()
+            if settled_after is not None and fetched_at > settled_after:
+                self._count("hits")
+                return CachedResponse(body, meta.get("content_type", ""), True, False)
+
+        extra: Dict[str, str] = {}
+        if cached is not None:
+            if meta.get("etag"):
+                extra["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                extra["If-Modified-Since"] = meta["last_modified"]
+
+        status, new_body, headers = fetch(url, extra)
+        if status == 304 and cached is not None:
+            self._count("revalidated")
+            # 検証した時刻を更新する（確定後に検証できればそれ以降は通信しない）
+            merged = {
+                "ETag": headers.get("ETag") or meta.get("etag"),
+                "Last-Modified": headers.get("Last-Modified") or meta.get("last_modified"),
+                "Content-Type": meta.get("content_type", ""),
+            }
+            self._store(url, key, body, {k: v for k, v in merged.items() if v})
+            return CachedResponse(body, meta.get("content_type", ""), False, True)
+
+        self._count("fetched")
+        if accept is not None and not accept(new_body):
+            self._count("rejected")
+            return CachedResponse(new_body, headers.get("Content-Type") or "", False, False)
+        self._store(url, key, new_body, headers)
+        return CachedResponse(new_body, headers.get("Content-Type") or "", False, False)
+
+    def clear(self, endpoint: str | None = None) -> None:
+        target = self.root / _safe(endpoint) if endpoint else self.root
+        shutil.rmtree(target, ignore_errors=True)
@@ -0,0 +1,277 @@
+# hybrid_residual.py
+# -*- coding: utf-8 -*-
+"""
+SD + 機械学習のハイブリッド（残差補正）モード。
+
+SD モデルの river_discharge_downstream は基底流量 2.5e6 で下限が切られ、ピークも取りこぼしやすい
+（top_flow_error / high_flow_error があるのはそのため）。ここでは
+  (外力窓, SD の状態量, SD の流量) → log(観測流量) - log(SD 流量)
+を返す軽量な回帰モデルを学習し、シミュレーション中にチャンク（既定 30 日）ごとに 1 回の一括推論で補正する。
+
+- 観測値はモデル内の flow（ペイオフと同じデータ・同じ単位）を使う
+- 学習データは Vensim 成果物（.out / .cin）の各パラメータセットの実行をまとめて使う
+- 精度は日ブロックの交差検証（学習に使っていない日）でペイオフ構成要素を補正前後で比較する
+- 推論コストは「シミュレーション 1 年あたりの推論時間」として報告する
+"""
+from __future__ import annotations
+
+import argparse
+import pickle
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from flow_metrics import LOG_ERROR_START, payoff_scores
+from model_params import OPT_RESULT
+from pysd_ensemble import PAYOFF_WEIGHTS, get_model, run_ensemble
+
+
+# ---- 設定 ----
+RESIDUAL_PATH = Path("data/residual_discharge.pkl")
+REPORT_CSV = Path("data/hybrid_residual_report.csv")
+
+TARGET = "river_discharge_downstream"
+OBS_COL = "flow"
+FORCING_COLS = ["daily_precip", "daily_ave_temp"]
+STATE_COLS = [
+    "upstream_storage",
+    "downstream_storage",
+    "upstream_underground",
+    "downstream_underground",
+    "dam_storage",
+]
+WINDOW_DAYS = 14          # 外力窓（日）
+CHUNK_DAYS = 30           # 補正を適用するチャンク長（日）
+N_DAYS = 365
+N_FOLDS = 4               # 日ブロック交差検証の分割数
+
+
+# =========================
+# 特徴量
+# =========================
+def pad_history(forcing: np.ndarray, window: int = WINDOW_DAYS) -> np.ndarray:
+    """ (..., n_days, n_feat) の先頭を初日の値で window-1 日分埋める """
+    head = np.repeat(forcing[..., :1, :], window - 1, axis=-2)
+    return np.concatenate([head, forcing], axis=-2)
+
+
+def build_features(
+    forcing_ext: np.ndarray,
+    sim: np.ndarray,
+    states: np.ndarray,
+    t: np.ndarray,
+    window: int = WINDOW_DAYS,
+) -> np.ndarray:
+    """
+    (n, n_days + window - 1, n_feat) の履歴込み外力、(n, n_days) の SD 流量、(n, n_days, n_state) の状態量、
+    (n_days,) の時刻から (n*n_days, n_features) の特徴量を作る。当日までの情報しか使わない。
+    """
+    n, n_days = sim.shape
+    win = sliding_window_view(forcing_ext, window, axis=1)      # (n, n_days, n_feat, window)
+    season = np.stack([np.sin(2 * np.pi * t / 365), np.cos(2 * np.pi * t / 365)], axis=1)
+    return np.concatenate([
+        win.reshape(n, n_days, -1),
+        np.log(np.maximum(sim, 1.0))[..., None],
+        np.log1p(np.maximum(states, 0.0)),
+        np.broadcast_to(season[None], (n, n_days, 2)),
+    ], axis=2).reshape(n * n_days, -1)
+
+
+def frames_to_arrays(results: Sequence[pd.DataFrame]) -> Dict[str, np.ndarray]:
+    """ run の結果（同じ時刻軸）を (n, n_days, ...) の配列にまとめる """
+    return {
+        "forcing": np.stack([r[FORCING_COLS].to_numpy(float) for r in results]),
+        "sim": np.stack([r[TARGET].to_numpy(float) for r in results]),
+        "obs": np.stack([r[OBS_COL].to_numpy(float) for r in results]),
+        "states": np.stack([r[STATE_COLS].to_numpy(float) for r in results]),
+        "t": np.asarray(results[0].index, dtype=float),
+    }
+
+
+# =========================
+# 残差補正モデル
+# =========================
+class ResidualCorrector:
+    """
+    log 流量の残差を予測し、SD の流量に掛け戻す。推論はチャンク単位の一括呼び出しにする。
+    """
+
+    def __init__(self, regressor, window: int = WINDOW_DAYS, clip: Tuple[float, float] = (-np.inf, np.inf)):
+        self.regressor = regressor
+        self.window = window
+        self.clip = clip
+
+    def residual(self, forcing_ext, sim, states, t) -> np.ndarray:
+        """ (n, n_days) の log 残差 """
+        feats = build_features(forcing_ext, sim, states, t, self.window)
+        return np.clip(self.regressor.predict(feats), *self.clip).reshape(sim.shape)
+
+    def correct(self, forcing_ext, sim, states, t) -> np.ndarray:
+        """ 補正後の流量 = SD 流量 × exp(残差) """
+        return sim * np.exp(self.residual(forcing_ext, sim, states, t))
+
+    def save(self, path: Path = RESIDUAL_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: Path = RESIDUAL_PATH) -> "ResidualCorrector":
+        with Path(path).open("rb") as f:
+            return pickle.load(f)
+
+
+def make_regressor(seed: int = 42):
+    """ 日数が少ない（1 年×数メンバー）ので浅い勾配ブースティングにする """
+    return HistGradientBoostingRegressor(
+        max_depth=3, learning_rate=0.05, max_iter=300, l2_regularization=1.0,
+        min_samples_leaf=20, random_state=seed,
+    )
+
+
+def training_runs(paths: Sequence[Path], workers: int | None = None) -> List[pd.DataFrame]:
+    """ 成果物ごとのパラメータで 1 年分を 1 回のアンサンブル実行で流す """
+    from vensim_artifacts import load_param_sets
+
+    sets = load_param_sets(paths, model=get_model())
+    cols = [TARGET, OBS_COL, *FORCING_COLS, *STATE_COLS]
+    res = run_ensemble(list(sets.values()), cols, timestamps=list(range(N_DAYS)), workers=workers, errors="ignore")
+    return [r for r in res if r is not None]
+
+
+def train(
+    paths: Sequence[Path],
+    workers: int | None = None,
+    n_folds: int = N_FOLDS,
+    seed: int = 42,
+) -> Tuple[ResidualCorrector, pd.DataFrame]:
+    """
+    残差補正モデルを学習し、(補正器, 交差検証のペイオフ比較表) を返す。
+    交差検証は日を連続ブロックに分け、全メンバーの同じ日を同じ側に置く（同日の情報漏れを防ぐ）。
+    """
+    arr = frames_to_arrays(training_runs(paths, workers))
+    n, n_days = arr["sim"].shape
+    forcing_ext = pad_history(arr["forcing"])
+    feats = build_features(forcing_ext, arr["sim"], arr["states"], arr["t"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        target = (np.log(arr["obs"]) - np.log(arr["sim"])).reshape(-1)
+    day = np.broadcast_to(np.arange(n_days), (n, n_days)).reshape(-1)
+    ok = np.isfinite(target) & (arr["t"][day] >= LOG_ERROR_START)
+    clip = (float(target[ok].min()), float(target[ok].max()))
+
+    # 日ブロック交差検証（学習に使っていない日の予測だけで評価）
+    fold = np.minimum(day * n_folds // n_days, n_folds - 1)
+    oof = np.zeros_like(target)
+    for k in range(n_folds):
+        reg = make_regressor(seed).fit(feats[ok & (fold != k)], target[ok & (fold != k)])
+        oof[fold == k] = np.clip(reg.predict(feats[fold == k]), *clip)
+    corrected = arr["sim"] * np.exp(oof.reshape(n, n_days))
+
+    before = payoff_scores(arr["sim"], arr["obs"], arr["t"], PAYOFF_WEIGHTS)
+    after = payoff_scores(corrected, arr["obs"], arr["t"], PAYOFF_WEIGHTS)
+    report = pd.DataFrame({"member": np.arange(n), **{f"{k}_sd": v for k, v in before.items()},
+                           **{f"{k}_hybrid": v for k, v in after.items()}})
+
+    corrector = ResidualCorrector(make_regressor(seed).fit(feats[ok], target[ok]), clip=clip)
+    return corrector, report
+
+
+# =========================
+# ハイブリッド実行（チャンクごとに補正）
+# =========================
+def run_hybrid(
+    corrector: ResidualCorrector,
+    params: Dict[str, Any] | None = None,
+    n_days: int = N_DAYS,
+    chunk_days: int = CHUNK_DAYS,
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+    SD モデルを chunk_days 日ずつ進め（initial_condition="current" で状態を引き継ぐ）、
+    チャンクごとに 1 回の一括推論で流量を補正する。
+    戻り値: (日別の SD 流量・補正後流量・観測値, 時間計測)
+    """
+    model = get_model()
+    model.reload()
+    cols = [TARGET, OBS_COL, *FORCING_COLS, *STATE_COLS]
+    hist = None
+    parts = []
+    sd_sec = ml_sec = 0.0
+    try:
+        for start in range(0, n_days, chunk_days):
+            end = min(start + chunk_days, n_days) - 1
+            t0 = time.perf_counter()
+            res = model.run(
+                params=params if start == 0 else None,
+                return_columns=cols,
+                return_timestamps=list(range(start, end + 1)),
+                final_time=end,
+                initial_condition="original" if start == 0 else "current",
+            )
+            t1 = time.perf_counter()
+            arr = frames_to_arrays([res])
+            if hist is None:
+                hist = np.repeat(arr["forcing"][:, :1], corrector.window - 1, axis=1)
+            forcing_ext = np.concatenate([hist, arr["forcing"]], axis=1)
+            hybrid = corrector.correct(forcing_ext, arr["sim"], arr["states"], arr["t"])[0]
+            hist = forcing_ext[:, -(corrector.window - 1):]
+            ml_sec += time.perf_counter() - t1
+            sd_sec += t1 - t0
+            parts.append(pd.DataFrame(
+                {TARGET: arr["sim"][0], f"{TARGET}_hybrid": hybrid, OBS_COL: arr["obs"][0]}, index=res.index))
+    finally:
+        model.reload()   # 上書きを残さない（同じプロセスの run_member と干渉させない）
+
+    years = n_days / 365.0
+    timing = {
+        "chunks": len(parts),
+        "sd_sec_per_year": sd_sec / years,
+        "ml_sec_per_year": ml_sec / years,
+        "ml_share": ml_sec / (sd_sec + ml_sec),
+    }
+    return pd.concat(parts), timing
+
+
+def main():
+    from vensim_artifacts import discover_artifacts, load_calibrated_params
+
+    parser = argparse.ArgumentParser(description="SD + 残差補正（ハイブリッド）による下流流量の予測")
+    parser.add_argument("mode", choices=["train", "run"])
+    parser.add_argument("paths", nargs="*", type=Path,
+                        help="学習に使う Vensim 成果物（省略時は ARTIFACT_PREFIX の .out/.dat/.cin 一式）")
+    parser.add_argument("--params", type=Path, default=OPT_RESULT, help="run で使う較正済みパラメータ（.out など）")
+    parser.add_argument("--chunk-days", type=int, default=CHUNK_DAYS)
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--model", type=Path, default=RESIDUAL_PATH)
+    args = parser.parse_args()
+
+    if args.mode == "train":
+        corrector, report = train(args.paths or discover_artifacts(), workers=args.workers)
+        summary = report.drop(columns="member").mean().rename("mean").to_frame()
+        print("Payoff (block cross-validation, mean over members):")
+        print(summary.to_string())
+        corrector.save(args.model)
+        REPORT_CSV.parent.mkdir(parents=True, exist_ok=True)
+        report.to_csv(REPORT_CSV, index=False, encoding="utf-8")
+        print(f"  -> {args.model}, {REPORT_CSV}")
+        return
+
+    corrector = ResidualCorrector.load(args.model)
+    params = load_calibrated_params(args.params, get_model())
+    df, timing = run_hybrid(corrector, params, chunk_days=args.chunk_days)
+    t = np.asarray(df.index, dtype=float)
+    sd = payoff_scores(df[TARGET].to_numpy(), df[OBS_COL].to_numpy(), t, PAYOFF_WEIGHTS)
+    hy = payoff_scores(df[f"{TARGET}_hybrid"].to_numpy(), df[OBS_COL].to_numpy(), t, PAYOFF_WEIGHTS)
+    print(pd.DataFrame({"sd": sd, "hybrid": hy}).to_string())
+    print(f"Chunks: {timing['chunks']} x {args.chunk_days} days")
+    print(f"SD run:       {timing['sd_sec_per_year']:.3f} s / simulated year")
+    print(f"ML inference: {timing['ml_sec_per_year'] * 1e3:.1f} ms / simulated year "
+          f"({timing['ml_share']:.1%} of total)")
+
+
+if __name__ == "__main__":
+    main()
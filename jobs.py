@@ -0,0 +1,284 @@
+# jobs.py
+# -*- coding: utf-8 -*-
+"""
+長期間シミュレーションのバックグラウンドジョブ（app から投入し、進捗を見ながら結果を受け取る）。
+
+- ジョブごとに JOBS_DIR/<job_id>/ の作業ディレクトリを持つ
+  （spec.pkl: 入力、status.json: 状態、progress.json: 計算済み日数、result.parquet: 結果、cancel: 中止要求）
+- 外部データは forcing_params で渡すので、同時実行しても input.xlsx を共有しない
+- モデルは CHUNK_DAYS 日ずつ進め（initial_condition="current"）、チャンクごとに進捗を書き・中止要求を確認する
+- 実行は対話用（pysd_ensemble）とは別の小さなプロセスプール。ワーカーは nice を上げて対話の計算を優先させる
+- 投入者（セッション）ごとのキューからラウンドロビンで取り出し、1 投入者が同時に使うワーカーは MAX_RUNNING_PER_OWNER まで
+"""
+from __future__ import annotations
+
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Sequence
+
+import pandas as pd
+
+from pysd_ensemble import MODEL_MDL, MODEL_PY, get_model
+
+
+JOBS_DIR = Path(".jobs")
+JOB_WORKERS = max(1, (os.cpu_count() or 2) // 2)   # 残りのコアは対話用に空けておく
+MAX_RUNNING_PER_OWNER = 1
+MAX_QUEUED_PER_OWNER = 20
+CHUNK_DAYS = 365
+WORKER_NICE = 10
+KEEP_HOURS = 24                                    # cleanup で消す完了ジョブの経過時間
+
+ACTIVE_STATES = ("queued", "running")
+
+
+# =========================
+# 作業ディレクトリ
+# =========================
+def _write_json(path: Path, obj: Dict[str, Any]) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False, default=str), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _read_json(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _set_status(job_dir: Path, **updates: Any) -> None:
+    status = _read_json(job_dir / "status.json")
+    status.update(updates)
+    _write_json(job_dir / "status.json", status)
+
+
+# =========================
+# ワーカー側
+# =========================
+def _init_job_worker(nice: int) -> None:
+    try:
+        os.nice(nice)        # バックグラウンドジョブは対話の計算より低い優先度で
+    except (AttributeError, OSError):
+        pass
+
+
+def run_job(job_dir: str) -> str:
+    """
+    spec.pkl のジョブを実行して最終状態（done / cancelled / failed）を返す。
+    spec: params, return_cols, n_days, chunk_days, model_py, model_mdl
+    """
+    job_dir = Path(job_dir)
+    with (job_dir / "spec.pkl").open("rb") as f:
+        spec = pickle.load(f)
+    n_days = int(spec["n_days"])
+    chunk = int(spec.get("chunk_days") or CHUNK_DAYS)
+    _set_status(job_dir, state="running", started=time.time(), pid=os.getpid())
+    _write_json(job_dir / "progress.json", {"day": 0, "total": n_days})
+
+    model = get_model(spec.get("model_py"), spec.get("model_mdl"))
+    parts = []
+    try:
+        model.reload()
+        for start in range(0, n_days, chunk):
+            if (job_dir / "cancel").exists():
+                _set_status(job_dir, state="cancelled", finished=time.time())
+                return "cancelled"
+            end = min(start + chunk, n_days) - 1
+            parts.append(model.run(
+                params=spec["params"] if start == 0 else None,
+                return_columns=list(spec["return_cols"]),
+                return_timestamps=list(range(start, end + 1)),
+                final_time=end,
+                initial_condition="original" if start == 0 else "current",
+            ))
+            _write_json(job_dir / "progress.json", {"day": end + 1, "total": n_days})
+        res = pd.concat(parts)
+        tmp = job_dir / f"result.{os.getpid()}.tmp"
+        res.to_parquet(tmp)
+        os.replace(tmp, job_dir / "result.parquet")
+        _set_status(job_dir, state="done", finished=time.time())
+        return "done"
+    except Exception as e:
+        _set_status(job_dir, state="failed", finished=time.time(), error=repr(e),
+                    traceback=traceback.format_exc())
+        return "failed"
+    finally:
+        model.reload()   # 上書きを次のジョブに残さない
+
+
+# =========================
+# 親プロセス側
+# =========================
+class JobManager:
+    """
+    submit / status / jobs / cancel / result を持つジョブ管理。app ではサーバーに 1 つ（st.cache_resource）。
+    """
+
+    def __init__(
+        self,
+        root: Path | str = JOBS_DIR,
+        workers: int = JOB_WORKERS,
+        per_owner: int = MAX_RUNNING_PER_OWNER,
+        max_queued: int = MAX_QUEUED_PER_OWNER,
+    ):
+        self.root = Path(root)
+        self.workers = int(workers)
+        self.per_owner = int(per_owner)
+        self.max_queued = int(max_queued)
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock = threading.RLock()
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()   # 投入者 → 待ちジョブ
+        self._running: Dict[str, Future] = {}
+        self._owner: Dict[str, str] = {}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_job_worker,
+                                             initargs=(WORKER_NICE,))
+        return self._pool
+
+    def submit(
+        self,
+        owner: str,
+        params: Dict[str, Any],
+        return_cols: Sequence[str],
+        n_days: int,
+        label: str = "",
+        meta: Dict[str, Any] | None = None,
+        chunk_days: int = CHUNK_DAYS,
+        model_py: Path | str | None = MODEL_PY,
+        model_mdl: Path | str | None = MODEL_MDL,
+    ) -> str:
+        """
+        ジョブを登録して job_id を返す。params には forcing_params の時系列を含めてよい。
+        meta は結果と一緒に返すだけの任意情報（キャッシュキーや開始日など）。
+        """
+        with self._lock:
+            queued = len(self._queues.get(owner, ()))
+            if queued >= self.max_queued:
+                raise RuntimeError(f"待ちジョブが上限（{self.max_queued} 件）に達しています")
+            job_id = uuid.uuid4().hex[:12]
+            job_dir = self.root / job_id
+            job_dir.mkdir(parents=True, exist_ok=True)
+            spec = {
+                "params": params, "return_cols": list(return_cols), "n_days": int(n_days),
+                "chunk_days": int(chunk_days),
+                "model_py": str(model_py) if model_py else None,
+                "model_mdl": str(model_mdl) if model_mdl else None,
+            }
+            with (job_dir / "spec.pkl").open("wb") as f:
+                pickle.dump(spec, f)
+            _write_json(job_dir / "status.json", {
+                "job_id": job_id, "owner": owner, "label": label, "state": "queued",
+                "submitted": time.time(), "n_days": int(n_days), "meta": meta or {},
+            })
+            self._owner[job_id] = owner
+            self._queues.setdefault(owner, deque()).append(job_id)
+            self._dispatch()
+            return job_id
+
+    def _dispatch(self) -> None:
+        """ 空いているワーカーに、投入者を順に回しながらジョブを割り当てる """
+        with self._lock:
+            while len(self._running) < self.workers:
+                running_by_owner: Dict[str, int] = {}
+                for jid in self._running:
+                    running_by_owner[self._owner[jid]] = running_by_owner.get(self._owner[jid], 0) + 1
+                owner = next((o for o, q in self._queues.items()
+                              if q and running_by_owner.get(o, 0) < self.per_owner), None)
+                if owner is None:
+                    return
+                job_id = self._queues[owner].popleft()
+                self._queues.move_to_end(owner)          # ラウンドロビン
+                if (self.root / job_id / "cancel").exists():
+                    continue
+                fut = self._get_pool().submit(run_job, str(self.root / job_id))
+                self._running[job_id] = fut
+                fut.add_done_callback(lambda f, jid=job_id: self._on_done(jid, f))
+
+    def _on_done(self, job_id: str, fut: Future) -> None:
+        with self._lock:
+            self._running.pop(job_id, None)
+        exc = fut.exception()
+        if exc is not None:
+            # ワーカーが落ちた場合など（run_job 内の例外は status.json に書かれている）
+            _set_status(self.root / job_id, state="failed", finished=time.time(), error=repr(exc))
+            if self._pool is not None and getattr(self._pool, "_broken", False):
+                self._pool = None
+        self._dispatch()
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        """ 状態と進捗（day / total / fraction）"""
+        job_dir = self.root / job_id
+        st = _read_json(job_dir / "status.json")
+        if not st:
+            return {"job_id": job_id, "state": "unknown"}
+        prog = _read_json(job_dir / "progress.json")
+        total = prog.get("total", st.get("n_days", 0)) or 0
+        day = prog.get("day", 0)
+        with self._lock:
+            q = self._queues.get(st.get("owner"), deque())
+            tracked = job_id in self._running or job_id in q
+            if st.get("state") == "queued":
+                st["position"] = list(q).index(job_id) + 1 if job_id in q else None
+        if st.get("state") in ACTIVE_STATES and not tracked:
+            st["state"] = "interrupted"     # 前回のサーバープロセスで投入され、終わらずに止まったもの
+        return {**st, "day": day, "total": total, "fraction": day / total if total else 0.0}
+
+    def jobs(self, owner: str | None = None) -> List[Dict[str, Any]]:
+        """ 投入順のジョブ一覧（owner を指定するとそのセッションの分だけ）"""
+        if not self.root.exists():
+            return []
+        out = []
+        for d in self.root.iterdir():
+            if not (d / "status.json").exists():
+                continue
+            st = self.status(d.name)
+            if owner is None or st.get("owner") == owner:
+                out.append(st)
+        return sorted(out, key=lambda s: s.get("submitted", 0))
+
+    def cancel(self, job_id: str) -> None:
+        """ 待ちなら即取り消し、実行中なら次のチャンク境界で止める """
+        job_dir = self.root / job_id
+        (job_dir / "cancel").touch()
+        with self._lock:
+            owner = self._owner.get(job_id)
+            q = self._queues.get(owner)
+            if q is not None and job_id in q:
+                q.remove(job_id)
+                _set_status(job_dir, state="cancelled", finished=time.time())
+
+    def result(self, job_id: str) -> pd.DataFrame | None:
+        path = self.root / job_id / "result.parquet"
+        return pd.read_parquet(path) if path.exists() else None
+
+    def cleanup(self, keep_hours: float = KEEP_HOURS) -> int:
+        """ 終了から keep_hours 以上たったジョブの作業ディレクトリを消す """
+        n = 0
+        for st in self.jobs():
+            if st.get("state") in ACTIVE_STATES:
+                continue
+            if time.time() - float(st.get("finished") or st.get("submitted") or 0) > keep_hours * 3600:
+                shutil.rmtree(self.root / st["job_id"], ignore_errors=True)
+                n += 1
+        return n
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for job_id in list(self._running):
+                (self.root / job_id / "cancel").touch()
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
@@ -1,105 +1,152 @@
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
+from numpy.lib.stride_tricks import sliding_window_view
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
-import tensorflow as tf
 print("TensorFlow version:", tf.__version__)
 print("GPU Available:", tf.config.list_physical_devices('GPU'))
 
+AUTOTUNE = tf.data.AUTOTUNE
 
-# ------------------------------
-# 1. AMeDAS（久留米）の整形
-# ------------------------------
-merged_df = pd.read_csv("data/merged_df.csv", parse_dates=["date"])
 
 # ------------------------------
 # 5. 時系列データセットの作成
 # ------------------------------
 def make_timeseries_dataset(df, input_features, output_features, sequence_length=7):
-    X, y = [], []
-    for i in range(len(df) - sequence_length):
-        input_seq = df[input_features].iloc[i:i + sequence_length].values
-        output_seq = df[output_features].iloc[i + sequence_length].values
-        X.append(input_seq)
-        y.append(output_seq)
-    return np.array(X), np.array(y)
-
-input_features = ['precipitation', 'temperature']
-output_features = ['flow', 'level']
-X, y = make_timeseries_dataset(merged_df, input_features, output_features)
-
-# ------------------------------
-# 6. スケーリング
-# ------------------------------
-scaler_X = StandardScaler()
-# X_scaled = scaler_X.fit_transform(X.reshape(-1, X.shape[2])).reshape(X.shape)
-X_scaled = np.zeros_like(X)
-for i in range(X.shape[2]):
-    X_scaled[:, :, i] = StandardScaler().fit_transform(X[:, :, i])
-
-
-scaler_y = StandardScaler()
-y_scaled = scaler_y.fit_transform(y)
-
-# ------------------------------
-# 7. 学習データと検証データに分割
-# ------------------------------
-X_train, X_val, y_train, y_val = train_test_split(
-    X_scaled, y_scaled, test_size=0.2, shuffle=False
-)
-
-# ------------------------------
-# 8. LSTM モデル構築・学習
-# ------------------------------
-import tensorflow as tf
-
-model = tf.keras.Sequential([
-    tf.keras.layers.Input(shape=(X.shape[1], X.shape[2])),
-    tf.keras.layers.LSTM(64),
-    tf.keras.layers.Dense(32, activation='relu'),
-    tf.keras.layers.Dense(len(output_features))  # 出力は flow, level
-])
-
-model.compile(optimizer='adam', loss='mse', metrics=['mae'])
-model.summary()
-
-history = model.fit(
-    X_train, y_train,
-    epochs=2,
-    batch_size=16,
-    validation_data=(X_val, y_val),
-    verbose=1
-)
-
-# ------------------------------
-# 9. 予測と可視化
-# ------------------------------
-y_pred_scaled = model.predict(X_val)
-y_pred = scaler_y.inverse_transform(y_pred_scaled)
-y_true = scaler_y.inverse_transform(y_val)
-
-import matplotlib.pyplot as plt
-
-plt.figure(figsize=(14, 5))
-
-plt.subplot(1, 2, 1)
-plt.plot(y_true[:, 0], label='True Flow')
-plt.plot(y_pred[:, 0], label='Predicted Flow')
-plt.title('Flow Prediction')
-plt.xlabel('Time Step')
-plt.ylabel('Flow')
-plt.legend()
-
-plt.subplot(1, 2, 2)
-plt.plot(y_true[:, 1], label='True Level')
-plt.plot(y_pred[:, 1], label='Predicted Level')
-plt.title('Level Prediction')
-plt.xlabel('Time Step')
-plt.ylabel('Level')
-plt.legend()
-
-plt.tight_layout()
-plt.show()
+    """
+    X[i] = 入力の i..i+L-1 行目, y[i] = 出力の i+L 行目（i = 0..N-L-1）。
+    X は sliding_window_view によるビューなので、窓ごとのコピーは作らない。
+    """
+    x = df[input_features].to_numpy(dtype=np.float32)
+    y = df[output_features].to_numpy(dtype=np.float32)
+    X = sliding_window_view(x, sequence_length, axis=0)[:-1].transpose(0, 2, 1)  # (N-L, L, F)
+    return X, y[sequence_length:]
+
+
+def window_starts(n_rows, sequence_length, groups=None):
+    """
+    窓の開始行を返す。groups（観測所などの列）を渡すと、グループ境界をまたぐ窓は除外する。
+    """
+    starts = np.arange(n_rows - sequence_length)
+    if groups is None:
+        return starts
+    g = np.asarray(groups)
+    same = g[starts] == g[starts + sequence_length]  # 予測対象の行まで同じグループ
+    return starts[same]
+
+
+def fit_scaler(arr, rows):
+    """ 特徴量ごとの平均・標準偏差を学習行だけで 1 回だけ推定する """
+    mean = arr[rows].mean(axis=0)
+    std = arr[rows].std(axis=0)
+    return mean, np.where(std > 0, std, 1.0)
+
+
+def make_tf_dataset(X, y, starts, batch_size=16, shuffle=False, seed=42):
+    """
+    make_timeseries_dataset の (X, y) から、開始行インデックスだけを流すストリーミング tf.data パイプライン。
+    X はビューのままで、バッチごとに必要な窓だけをコピーする。窓の配列を事前に作らないので、
+    数十年×複数観測所でもメモリは (行数×特徴量) で済む。
+    """
+    def take(idx):
+        return X[idx], y[idx]
+
+    ds = tf.data.Dataset.from_tensor_slices(np.asarray(starts, dtype=np.int64))
+    if shuffle:
+        ds = ds.shuffle(len(starts), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(
+        lambda s: tf.numpy_function(take, [s], (tf.float32, tf.float32)),
+        num_parallel_calls=AUTOTUNE,
+    )
+    ds = ds.map(lambda a, b: (tf.ensure_shape(a, (None,) + X.shape[1:]), tf.ensure_shape(b, (None,) + y.shape[1:])))
+    return ds.prefetch(AUTOTUNE)
+
+
+def main():
+    # ------------------------------
+    # 1. AMeDAS（久留米）の整形
+    # ------------------------------
+    merged_df = pd.read_csv("data/merged_df.csv", parse_dates=["date"])
+
+    input_features = ['precipitation', 'temperature']
+    output_features = ['flow', 'level']
+    sequence_length = 7
+    batch_size = 16
+    groups = merged_df["station"] if "station" in merged_df.columns else None
+
+    x_raw = merged_df[input_features].to_numpy(dtype=np.float32)
+    y_raw = merged_df[output_features].to_numpy(dtype=np.float32)
+    starts = window_starts(len(merged_df), sequence_length, groups)
+
+    # ------------------------------
+    # 7. 学習データと検証データに分割（時系列順、シャッフルなし）
+    # ------------------------------
+    n_train = int(len(starts) * 0.8)
+    train_starts, val_starts = starts[:n_train], starts[n_train:]
+
+    # ------------------------------
+    # 6. スケーリング（学習期間の行だけで 1 回 fit）
+    # ------------------------------
+    train_rows = np.arange(train_starts[-1] + sequence_length + 1)
+    x_mean, x_std = fit_scaler(x_raw, train_rows)
+    y_mean, y_std = fit_scaler(y_raw, train_rows)
+    scaled = pd.DataFrame(np.hstack([(x_raw - x_mean) / x_std, (y_raw - y_mean) / y_std]),
+                          columns=input_features + output_features)
+    X, y = make_timeseries_dataset(scaled, input_features, output_features, sequence_length)
+
+    train_ds = make_tf_dataset(X, y, train_starts, batch_size, shuffle=True)
+    val_ds = make_tf_dataset(X, y, val_starts, batch_size)
+
+    # ------------------------------
+    # 8. LSTM モデル構築・学習
+    # ------------------------------
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input(shape=(sequence_length, len(input_features))),
+        tf.keras.layers.LSTM(64),
+        tf.keras.layers.Dense(32, activation='relu'),
+        tf.keras.layers.Dense(len(output_features))  # 出力は flow, level
+    ])
+
+    model.compile(optimizer='adam', loss='mse', metrics=['mae'])
+    model.summary()
+
+    model.fit(
+        train_ds,
+        epochs=2,
+        validation_data=val_ds,
+        verbose=1
+    )
+
+    # ------------------------------
+    # 9. 予測と可視化
+    # ------------------------------
+    y_pred_scaled = model.predict(val_ds)
+    y_pred = y_pred_scaled * y_std + y_mean
+    y_true = y_raw[val_starts + sequence_length]
+
+    plt.figure(figsize=(14, 5))
+
+    plt.subplot(1, 2, 1)
+    plt.plot(y_true[:, 0], label='True Flow')
+    plt.plot(y_pred[:, 0], label='Predicted Flow')
+    plt.title('Flow Prediction')
+    plt.xlabel('Time Step')
+    plt.ylabel('Flow')
+    plt.legend()
+
+    plt.subplot(1, 2, 2)
+    plt.plot(y_true[:, 1], label='True Level')
+    plt.plot(y_pred[:, 1], label='Predicted Level')
+    plt.title('Level Prediction')
+    plt.xlabel('Time Step')
+    plt.ylabel('Level')
+    plt.legend()
+
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# mcmc_dream.py
+# -*- coding: utf-8 -*-
+"""
+DREAM 型（差分進化 MCMC）による水文パラメータの事後分布サンプリング。
+
+Vensim の MCMC 設定（.voc の MCNCHAINS, MCBURNIN, MCXOVER, ...）を読み取り、
+全チェーンの提案を 1 イテレーションにつき 1 回のアンサンブル実行で評価する。
+- 尤度は Vensim のペイオフ（MCPAYOFFTYPE=0: ペイオフ = 対数尤度）を MCTEMP で割ったもの
+- チェーン状態は一定間隔で .npz にチェックポイントし、--resume で再開できる
+- バーンイン後のサンプルを CSV に出し、パラメータアンサンブルとして再利用する
+"""
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from model_params import BASE_PARAMS
+from pysd_ensemble import (
+    HYDRO_BOUNDS,
+    PAYOFF_WEIGHTS,
+    DEFAULT_TIMESTAMPS,
+    calibration_payoff,
+    run_ensemble,
+)
+from vensim_artifacts import initial_population, read_voc
+
+
+# ---- 入出力 ----
+VOC_PATH = Path("opt_chikugo_river_discharge.voc")
+CHECKPOINT_PATH = Path("data/mcmc_checkpoint.npz")
+POSTERIOR_CSV = Path("data/mcmc_posterior.csv")
+
+# ---- 進捗表示・保存間隔 ----
+PROGRESS_EVERY = 5
+CHECKPOINT_EVERY = 10
+
+# ---- Vensim MCMC 設定の既定値と DREAM での解釈 ----
+#   MCNCHAINS     チェーン数（DE には 2*MCUPDATEPAIRS+1 本以上が必要なので下限を設ける）
+#   MCBURNIN      バーンイン反復数（事後サンプルから除外）
+#   MCXOVER       クロスオーバー確率 CR（各次元を更新する確率）
+#   MCUPDATEPAIRS 差分ベクトルに使うチェーン対の数 δ
+#   MCGAMMA       ジャンプ率 γ = 2.38/sqrt(2δd') に掛ける倍率
+#   MCJUMP        γ=1 とするモードジャンプの確率
+#   MCEPSILON     差分に掛ける一様乱数 (1+e), e~U(-b, b) の幅 b
+#   MCDELTA       正規乱数 ε~N(0, b*) の標準偏差 b*（正規化空間）
+#   MCTEMP        尤度の温度
+#   MCOUTLIER     >0 ならバーンイン中に外れチェーン（IQR 法）を最良チェーンへ戻す
+MC_DEFAULTS = {
+    "MCNCHAINS": 2,
+    "MCBURNIN": 0,
+    "MCXOVER": 0.2,
+    "MCUPDATEPAIRS": 1,
+    "MCGAMMA": 1.0,
+    "MCJUMP": 0.05,
+    "MCEPSILON": 0.01,
+    "MCDELTA": 0.0001,
+    "MCTEMP": 1.0,
+    "MCOUTLIER": 0.05,
+}
+
+
+def read_voc_settings(path: Path = VOC_PATH) -> Dict[str, float]:
+    """
+    .voc の ':KEY=value' 行を読み、MC 系設定を既定値に上書きして返す。
+    """
+    settings = dict(MC_DEFAULTS)
+    if path.exists():
+        voc, _, _ = read_voc(path)
+        settings.update({k: v for k, v in voc.items() if k in MC_DEFAULTS})
+    return settings
+
+
+# =========================
+# 尤度評価（全チェーン 1 パス）
+# =========================
+def _to_physical(u: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    return lo + u * (hi - lo)
+
+
+def _to_unit(x: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    return (x - lo) / (hi - lo)
+
+
+def _reflect(u: np.ndarray) -> np.ndarray:
+    """ 正規化空間 [0,1] の外に出た提案を境界で折り返す """
+    u = np.mod(u, 2.0)
+    return np.where(u > 1.0, 2.0 - u, u)
+
+
+def evaluate_loglik(
+    x: np.ndarray,
+    names: List[str],
+    temperature: float = 1.0,
+    workers: int | None = None,
+    timestamps=None,
+) -> np.ndarray:
+    """
+    (n_chains, d) のパラメータ行列を 1 回のアンサンブル実行で評価し、対数尤度を返す。
+    失敗したメンバーは -inf とする。
+    """
+    param_sets = [dict(zip(names, map(float, row))) for row in x]
+    payoff = functools.partial(calibration_payoff, weights=PAYOFF_WEIGHTS)
+    res = run_ensemble(
+        param_sets,
+        return_cols=list(PAYOFF_WEIGHTS),
+        timestamps=DEFAULT_TIMESTAMPS if timestamps is None else timestamps,
+        base_params=BASE_PARAMS,
+        reducer=payoff,
+        workers=workers,
+        errors="ignore",
+    )
+    ll = np.array([-np.inf if r is None or not np.isfinite(r) else r for r in res], dtype=float)
+    return ll / float(temperature)
+
+
+# =========================
+# DREAM 提案
+# =========================
+def propose(u: np.ndarray, settings: Dict[str, float], rng: np.random.Generator) -> np.ndarray:
+    """
+    正規化空間の現在値 u (n_chains, d) から全チェーンの提案を一括生成する。
+    """
+    n, d = u.shape
+    delta = int(settings["MCUPDATEPAIRS"])
+    cr = float(settings["MCXOVER"])
+
+    # 各チェーンについて自分以外から 2δ 本を非復元抽出
+    order = np.argsort(rng.random((n, n - 1)), axis=1)[:, : 2 * delta]
+    others = np.array([[j for j in range(n) if j != i] for i in range(n)])
+    picks = np.take_along_axis(others, order, axis=1)
+    diff = (u[picks[:, :delta]] - u[picks[:, delta:]]).sum(axis=1)
+
+    # クロスオーバー（少なくとも 1 次元は更新）
+    mask = rng.random((n, d)) < cr
+    none = ~mask.any(axis=1)
+    mask[none, rng.integers(0, d, size=int(none.sum()))] = True
+    d_eff = mask.sum(axis=1)
+
+    gamma = settings["MCGAMMA"] * 2.38 / np.sqrt(2.0 * delta * d_eff)
+    gamma = np.where(rng.random(n) < settings["MCJUMP"], 1.0, gamma)
+
+    b = settings["MCEPSILON"]
+    e = rng.uniform(-b, b, size=(n, d))
+    eps = rng.normal(0.0, settings["MCDELTA"], size=(n, d))
+    step = (1.0 + e) * gamma[:, None] * diff + eps
+    return _reflect(u + np.where(mask, step, 0.0))
+
+
+def _outlier_chains(ll_hist: np.ndarray) -> np.ndarray:
+    """ 直近半分の平均対数尤度が Q1 - 2*IQR を下回るチェーンを返す """
+    half = ll_hist[ll_hist.shape[0] // 2:]
+    mean_ll = np.where(np.isfinite(half), half, np.nan)
+    mean_ll = np.nanmean(mean_ll, axis=0)
+    q1, q3 = np.nanpercentile(mean_ll, [25, 75])
+    return np.where(mean_ll < q1 - 2.0 * (q3 - q1))[0]
+
+
+def gelman_rubin(x_hist: np.ndarray) -> np.ndarray:
+    """
+    (n_iter, n_chains, d) の後半から次元ごとの R-hat を計算する。
+    """
+    x = x_hist[x_hist.shape[0] // 2:]
+    n = x.shape[0]
+    if n < 2:
+        return np.full(x.shape[-1], np.nan)
+    chain_mean = x.mean(axis=0)
+    w = x.var(axis=0, ddof=1).mean(axis=0)
+    b = n * chain_mean.var(axis=0, ddof=1)
+    var_hat = (n - 1) / n * w + b / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(var_hat / w)
+
+
+# =========================
+# チェックポイント
+# =========================
+def save_checkpoint(path: Path, state: Dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.stem + ".tmp.npz")
+    np.savez(
+        tmp,
+        names=np.array(state["names"]),
+        lo=state["lo"], hi=state["hi"],
+        u=state["u"], ll=state["ll"],
+        x_hist=state["x_hist"], ll_hist=state["ll_hist"],
+        iteration=state["iteration"],
+        n_accept=state["n_accept"],
+        rng_state=np.array(json.dumps(state["rng"].bit_generator.state)),
+    )
+    tmp.replace(path)  # 書き込み途中で落ちても前回分を壊さない
+
+
+def load_checkpoint(path: Path) -> Dict:
+    z = np.load(path, allow_pickle=False)
+    rng = np.random.default_rng()
+    rng.bit_generator.state = json.loads(str(z["rng_state"]))
+    return {
+        "names": [str(n) for n in z["names"]],
+        "lo": z["lo"], "hi": z["hi"],
+        "u": z["u"], "ll": z["ll"],
+        "x_hist": z["x_hist"], "ll_hist": z["ll_hist"],
+        "iteration": int(z["iteration"]),
+        "n_accept": int(z["n_accept"]),
+        "rng": rng,
+    }
+
+
+# =========================
+# サンプラー本体
+# =========================
+def sample(
+    n_iter: int,
+    bounds: Dict[str, Tuple[float, float]] = HYDRO_BOUNDS,
+    settings: Dict[str, float] | None = None,
+    init: np.ndarray | None = None,
+    workers: int | None = None,
+    seed: int = 42,
+    checkpoint: Path | None = CHECKPOINT_PATH,
+    resume: bool = False,
+) -> Dict:
+    """
+    DREAM で n_iter 反復（チェックポイントからの再開時は合計 n_iter まで）サンプリングする。
+
+    init: (n_points, d) の初期値（物理単位）。チェーン数 max(MCNCHAINS, 2*MCUPDATEPAIRS+1) に合わせて
+          切り詰め／一様乱数で補う。None なら範囲内一様乱数。
+    戻り値: 最終状態（x_hist: (n_iter, n_chains, d), ll_hist: (n_iter, n_chains) ほか）
+    """
+    settings = read_voc_settings() if settings is None else settings
+    temperature = float(settings["MCTEMP"])
+
+    if resume and checkpoint is not None and checkpoint.exists():
+        state = load_checkpoint(checkpoint)
+        print(f"[resume] {checkpoint} から再開（iteration={state['iteration']}）")
+    else:
+        names = list(bounds.keys())
+        lo = np.array([bounds[k][0] for k in names], dtype=float)
+        hi = np.array([bounds[k][1] for k in names], dtype=float)
+        rng = np.random.default_rng(seed)
+        min_chains = 2 * int(settings["MCUPDATEPAIRS"]) + 1
+        n_chains = max(int(settings["MCNCHAINS"]), min_chains)
+        if init is not None:
+            # 初期値はチェーン数に合わせる（多ければ先頭から、足りなければ範囲内一様乱数で補う）
+            u0 = np.clip(_to_unit(np.asarray(init, dtype=float), lo, hi), 0.0, 1.0)
+            if u0.shape[0] > n_chains:
+                print(f"[init] 初期値 {u0.shape[0]} 点のうち先頭 {n_chains} 点を使います（チェーン数 {n_chains}）")
+                u0 = u0[:n_chains]
+            elif u0.shape[0] < n_chains:
+                u0 = np.vstack([u0, rng.random((n_chains - u0.shape[0], len(names)))])
+        else:
+            u0 = rng.random((n_chains, len(names)))
+        ll0 = evaluate_loglik(_to_physical(u0, lo, hi), names, temperature, workers)
+        state = {
+            "names": names, "lo": lo, "hi": hi,
+            "u": u0, "ll": ll0,
+            "x_hist": np.empty((0,) + u0.shape), "ll_hist": np.empty((0, u0.shape[0])),
+            "iteration": 0, "n_accept": 0, "rng": rng,
+        }
+
+    names, lo, hi, rng = state["names"], state["lo"], state["hi"], state["rng"]
+    u, ll = state["u"], state["ll"]
+    x_hist = [state["x_hist"]]
+    ll_hist = [state["ll_hist"]]
+    burnin = int(settings["MCBURNIN"])
+
+    for it in range(state["iteration"] + 1, n_iter + 1):
+        z = propose(u, settings, rng)
+        ll_z = evaluate_loglik(_to_physical(z, lo, hi), names, temperature, workers)
+
+        accept = np.log(rng.random(len(ll))) < (ll_z - ll)
+        accept &= np.isfinite(ll_z)
+        u = np.where(accept[:, None], z, u)
+        ll = np.where(accept, ll_z, ll)
+        state["n_accept"] += int(accept.sum())
+
+        x_hist.append(_to_physical(u, lo, hi)[None])
+        ll_hist.append(ll[None])
+
+        if settings["MCOUTLIER"] > 0 and it <= burnin and it % 10 == 0:
+            bad = _outlier_chains(np.concatenate(ll_hist))
+            if len(bad):
+                best = int(np.argmax(ll))
+                u[bad], ll[bad] = u[best], ll[best]
+
+        state.update(u=u, ll=ll, iteration=it)
+        if checkpoint is not None and (it % CHECKPOINT_EVERY == 0 or it == n_iter):
+            state.update(x_hist=np.concatenate(x_hist), ll_hist=np.concatenate(ll_hist))
+            save_checkpoint(checkpoint, state)
+
+        if it % PROGRESS_EVERY == 0:
+            rate = state["n_accept"] / (it * len(ll))
+            print(f"[iter {it}] best_loglik={np.max(ll):.6g} accept_rate={rate:.3f}")
+
+    state.update(x_hist=np.concatenate(x_hist), ll_hist=np.concatenate(ll_hist))
+    return state
+
+
+def posterior_samples(state: Dict, burnin: int = 0, thin: int = 1) -> pd.DataFrame:
+    """
+    バーンイン後のチェーン履歴を縦持ちの DataFrame（iteration, chain, loglik, 各パラメータ）にする。
+    iteration は反復番号（1 始まり。x_hist[0] が反復 1、チェックポイントの iteration と同じ数え方）。
+    """
+    x = state["x_hist"][burnin::thin]
+    ll = state["ll_hist"][burnin::thin]
+    n_it, n_ch, d = x.shape
+    df = pd.DataFrame(x.reshape(-1, d), columns=state["names"])
+    df.insert(0, "loglik", ll.reshape(-1))
+    df.insert(0, "chain", np.tile(np.arange(n_ch), n_it))
+    df.insert(0, "iteration", np.repeat(np.arange(burnin + 1, burnin + 1 + n_it * thin, thin), n_ch))
+    return df
+
+
+def to_param_sets(posterior: pd.DataFrame, n: int | None = None, seed: int = 0) -> List[Dict[str, float]]:
+    """
+    事後サンプルから run_ensemble にそのまま渡せるパラメータセットのリストを作る。
+    """
+    cols = [c for c in posterior.columns if c not in ("iteration", "chain", "loglik")]
+    df = posterior if n is None else posterior.sample(n=min(n, len(posterior)), random_state=seed)
+    return [{c: float(v) for c, v in zip(cols, row)} for row in df[cols].to_numpy()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DREAM 型 MCMC による水文パラメータの事後分布推定")
+    parser.add_argument("--iterations", type=int, default=200, help="総反復数（既定200）")
+    parser.add_argument("--chains", type=int, default=None, help="チェーン数（既定は .voc の MCNCHAINS）")
+    parser.add_argument("--burnin", type=int, default=None, help="バーンイン（既定は .voc の MCBURNIN）")
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--voc", type=Path, default=VOC_PATH, help="Vensim 最適化設定 .voc")
+    parser.add_argument("--resume", action="store_true", help="チェックポイントから再開")
+    parser.add_argument("--init", nargs="+", type=Path, default=None,
+                        help="初期チェーンに使う Vensim 成果物（.out/.dat/.cin）")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    settings = read_voc_settings(args.voc)
+    if args.chains is not None:
+        settings["MCNCHAINS"] = args.chains
+    if args.burnin is not None:
+        settings["MCBURNIN"] = args.burnin
+
+    init = initial_population(args.init, HYDRO_BOUNDS) if args.init else None
+    state = sample(args.iterations, settings=settings, init=init, workers=args.workers,
+                   seed=args.seed, resume=args.resume)
+
+    rhat = gelman_rubin(state["x_hist"])
+    print("R-hat:")
+    for k, r in zip(state["names"], rhat):
+        print(f"  {k}: {r:.4f}")
+
+    post = posterior_samples(state, burnin=int(settings["MCBURNIN"]))
+    POSTERIOR_CSV.parent.mkdir(parents=True, exist_ok=True)
+    post.to_csv(POSTERIOR_CSV, index=False, encoding="utf-8")
+    print(f"  -> {POSTERIOR_CSV}（{len(post)} samples）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# model_params.py
+# -*- coding: utf-8 -*-
+"""
+流域プリセットと UI パラメータ定義（app.py・バッチ処理で共用）。
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+
+# ==== 流域プリセット（代表値セット） ====
+PRESETS = {
+    "筑後川流域": {
+        "initial_dam_capacity": 74_200_000,      # m3
+        "upstream_area": 157_585,                # ha
+        "downstream_area": 143_951,              # ha
+        "forest_area_ratio": 166_000/(198_500*0.9),
+        "direct_discharge_ratio": 0.97,
+        "current_highwater_discharge": 11_500,   # m3/s
+        "paddy_field_ratio": 0.12,
+    },
+    "長良川流域": {
+        "initial_dam_capacity": 8_500_000,      # m3
+        "upstream_area": 178_650,               # ha
+        "downstream_area": 19_850,              # ha
+        "forest_area_ratio": 0.92,
+        "direct_discharge_ratio": 0.97,
+        "current_highwater_discharge": 8_900,   # m3/s
+        "paddy_field_ratio": 0.8,
+    },
+    "利根川流域（例）": {
+        "initial_dam_capacity": 200_000_000,
+        "upstream_area": 420_000,
+        "downstream_area": 600_000,
+        "forest_area_ratio": 0.65,
+        "direct_discharge_ratio": 0.96,
+        "current_highwater_discharge": 22_000,
+        "paddy_field_ratio": 0.10,
+    },
+}
+
+PARAM_SPECS = {
+    "daily_precipitation_future_ratio": dict(label="将来降水補正（×）", min=0.5, max=2.0, step=0.01, value=1.0),
+    "dam_investment_amount":           dict(label="ダム投資額（円/年）",           min=0, max=1_000_000_000, step=1_000_000, value=0),
+    "levee_investment_amount":         dict(label="堤防投資額（円/年）",           min=0, max=100_000_000,  step=1_000_000,  value=0),
+    "drainage_investment_amount":      dict(label="排水能力投資額（円/年）",       min=0, max=10_000_000_000, step=100_000_000, value=0),
+    "annual_paddy_dam_investment":     dict(label="ため池（圃場）投資額（円/年）",   min=0, max=50_000_000,   step=1_000_000,  value=1_000_000),
+    "dam_investment_start_time":       dict(label="ダム投資 開始時期（年）",        min=0, max=11, step=1, value=0),
+    "levee_investment_start_time":     dict(label="堤防投資 開始時期（年）",        min=0, max=10, step=1, value=0),
+    "eldery_people_ratio":             dict(label="高齢者比率", min=0.0, max=1.0, step=0.01, value=0.6),
+    "capacity_building":               dict(label="防災力（避難率係数）", min=0.0, max=1.0, step=0.05, value=0.5),
+    "outflow_rate_of_residents":       dict(label="住民流出率（/日）", min=0.0, max=0.1, step=0.0001, value=0.01/365),
+    "inflow_rate_of_residents":        dict(label="住民流入率（/日）", min=0.0, max=0.1, step=0.0001, value=0.01/365),
+    "ratio_of_paddy_field_in_risky_area": dict(label="リスク域の圃場比率", min=0.0, max=1.0, step=0.01, value=0.01),
+    "paddy_field_ratio":                   dict(label="下流域における圃場比率", min=0.0, max=1.0, step=0.01, value=0.12),
+
+    # 地域パラメータ
+    "initial_dam_capacity": dict(label="初期ダム容量（m³）", min=0, max=500_000_000, step=100_000, value=74_200_000),
+    "upstream_area":        dict(label="上流域面積（ha）",  min=1_000, max=1_000_000, step=100, value=157_585),
+    "downstream_area":      dict(label="下流域面積（ha）",  min=1_000, max=1_000_000, step=100, value=143_951),
+    "forest_area_ratio":    dict(label="森林面積比（-）",   min=0.0, max=1.0, step=0.001, value=166_000/(198_500*0.9)),
+    "direct_discharge_ratio": dict(label="直接流出比（-）", min=0.0, max=1.0, step=0.001, value=1 - 40/1950),
+    "current_highwater_discharge": dict(label="計画高水流量（m³/秒）", min=0, max=30_000, step=100, value=11_500),
+}
+
+
+# ==== バッチ処理（アンサンブル・感度分析・リスク評価）の共通設定 ====
+# 較正済み水文パラメータ（Vensim 最適化の成果物）
+OPT_RESULT = Path("chikugo_run_opt_flow_obs_NormHighTopflowSq_BF_100_heat26.out")
+
+# 投資なし・現在気候のベースパラメータ
+BASE_PARAMS = {
+    "daily_precipitation_future_ratio": 1,
+    "levee_investment_amount": 0,
+    "dam_investment_amount": 0,
+}
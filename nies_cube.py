@@ -0,0 +1,291 @@
+# nies_cube.py
+# -*- coding: utf-8 -*-
+"""
+NIES 将来気候（national_average_<var>_ssp<code>.csv）を (model, year, doy) の密な NumPy キューブに変換する。
+
+- CSV は 1 回だけ読み、列名の正規表現照合もその 1 回だけ行う
+- キューブは CSV の隣に <stem>.npy（本体）と <stem>.index.json（モデル・年の索引、元 CSV のサイズ・更新時刻）で保存
+- 読み込みは np.load(mmap_mode="r")。OS のページキャッシュ経由で app・指標計算・バッチの各プロセスが共有する
+- CSV が更新されていれば（サイズ・更新時刻が索引と違えば）作り直す
+- (model, year) の参照は辞書引き + 配列スライスの O(1)
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# NIES 未来気候ファイルディレクトリ候補（どちらかに置いてあればOK）
+NIES_DIR_CANDIDATES = [Path("data/nies2020"), Path("data/nies")]
+
+N_DOY = 366                  # 閏年を含めた 1 年の最大日数（足りない日は NaN）
+FEB29_DOY = 59               # 閏年の 2/29 の doy（0 始まり）
+CUBE_FORMAT = 1              # 保存形式のバージョン（変えたら既存キューブは作り直し）
+
+# 外部データ表の列（NIES の変数 → input.xlsx の列名）
+EXTDATA_COLUMNS = {
+    "pr": "precipitation",
+    "tas": "temperature",
+    "tasmax": "tasmax",
+    "tasmin": "tasmin",
+    "rsds": "rsds",
+}
+
+
+def csv_path(var: str, ssp_code: str | int, dirs: Sequence[Path] = NIES_DIR_CANDIDATES) -> Path:
+    """ national_average_<var>_ssp<code>.csv を候補ディレクトリから探す """
+    fname = f"national_average_{var}_ssp{ssp_code}.csv"
+    for base in dirs:
+        p = Path(base) / fname
+        if p.exists():
+            return p
+    # 見つからなければ候補パスを列挙してエラー
+    cand = ", ".join(str((Path(base) / fname).resolve()) for base in dirs)
+    raise FileNotFoundError(f"{fname} が見つかりません。探した場所: {cand}")
+
+
+def _store_paths(path: Path) -> Tuple[Path, Path]:
+    return path.with_suffix(".npy"), path.with_suffix(".index.json")
+
+
+def _stamp(path: Path) -> Dict[str, int]:
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def is_leap(years: np.ndarray) -> np.ndarray:
+    years = np.asarray(years)
+    return (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+
+
+def doy_index_365(years: Sequence[int]) -> np.ndarray:
+    """
+    年ごとに 2/29 を除いた 365 日分の doy 位置を返す（(n_years, 365)）。
+    閏年は 0..365 から 59 を除き、平年は 0..364。take_along_axis でキューブから 365 日を一括で抜ける。
+    """
+    base = np.arange(365)
+    leap = is_leap(np.asarray(years))[:, None]
+    return np.where(leap & (base >= FEB29_DOY), base + 1, base)
+
+
+class NiesCube:
+    """
+    1 変数・1 SSP 分のキューブ。data は (n_models, n_years, N_DOY) の float64（mmap の読み取り専用ビュー）。
+    """
+
+    def __init__(self, var: str, ssp_code: str, data: np.ndarray, models: List[str], years: List[int],
+                 present: np.ndarray):
+        self.var = var
+        self.ssp_code = ssp_code
+        self.data = data
+        self.models = models
+        self.years = years
+        self.present = present
+        self.model_index = {m: i for i, m in enumerate(models)}
+        self.year_index = {y: i for i, y in enumerate(years)}
+
+    def has(self, model: str, year: int) -> bool:
+        i = self.model_index.get(model)
+        j = self.year_index.get(int(year))
+        return i is not None and j is not None and bool(self.present[i, j])
+
+    def values(self, model: str, year: int) -> np.ndarray:
+        """ (N_DOY,) の日別値（コピーしないビュー）。列が無ければ KeyError """
+        if not self.has(model, year):
+            raise KeyError(f"{self.var}: {model} {year} の列がありません")
+        return self.data[self.model_index[model], self.year_index[int(year)]]
+
+    def series(self, model: str, year: int, name: str | None = None) -> pd.Series:
+        """ doy を index にした Series（従来の _extract_one_year と同じ形）"""
+        v = self.values(model, year)
+        n = 366 if is_leap(np.array([year]))[0] else 365
+        return pd.Series(np.array(v[:n]), index=pd.RangeIndex(n, name="doy"), name=name or self.var)
+
+    def _positions(self, models: Sequence[str] | None, years: Sequence[int] | None):
+        models = self.models if models is None else list(models)
+        years = self.years if years is None else [int(y) for y in years]
+        mi = np.array([self.model_index.get(m, -1) for m in models], dtype=int)
+        yi = np.array([self.year_index.get(y, -1) for y in years], dtype=int)
+        return np.asarray(years, dtype=int), mi, yi
+
+    def available(self, models: Sequence[str] | None = None, years: Sequence[int] | None = None) -> np.ndarray:
+        """ (n_models, n_years) の列の有無 """
+        _, mi, yi = self._positions(models, years)
+        out = np.zeros((len(mi), len(yi)), dtype=bool)
+        ok_m, ok_y = mi >= 0, yi >= 0
+        out[np.ix_(ok_m, ok_y)] = self.present[np.ix_(mi[ok_m], yi[ok_y])]
+        return out
+
+    def days365(self, models: Sequence[str] | None = None, years: Sequence[int] | None = None) -> np.ndarray:
+        """ 2/29 を除いた (n_models, n_years, 365) の配列（無い列は NaN）"""
+        years, mi, yi = self._positions(models, years)
+        out = np.full((len(mi), len(yi), 365), np.nan)
+        ok_m, ok_y = mi >= 0, yi >= 0
+        if ok_m.any() and ok_y.any():
+            sub = self.data[np.ix_(mi[ok_m], yi[ok_y])]
+            idx = doy_index_365(years[ok_y])
+            out[np.ix_(ok_m, ok_y)] = np.take_along_axis(sub, np.broadcast_to(idx, sub.shape[:2] + (365,)), axis=2)
+        return out
+
+
+def build_cube(path: Path, var: str, ssp_code: str | int) -> Tuple[np.ndarray, Dict]:
+    """
+    CSV を 1 回読み、列名 <var>_<model>_ssp<code>_<member>_<year> から (model, year) を引いてキューブに詰める。
+    """
+    df = pd.read_csv(path)
+    if "time" not in df.columns:
+        df = df.rename(columns={df.columns[0]: "time"})
+    df = df.set_index("time")
+
+    # 例: pr_MIROC6_ssp245_r1i1p1f1_2050
+    pattern = re.compile(rf'^{re.escape(var)}_(?P<model>.+?)_ssp{ssp_code}_.+?_(?P<year>\d{{4}})$')
+    found: Dict[Tuple[str, int], str] = {}
+    for c in df.columns:
+        m = pattern.match(str(c))
+        if m:
+            found.setdefault((m.group("model"), int(m.group("year"))), c)   # 同じ (model, year) は先頭の列
+    cols = list(found.values())
+    col_models = [k[0] for k in found]
+    col_years = [k[1] for k in found]
+    models = sorted(set(col_models))
+    years = sorted(set(col_years))
+    mi = np.array([models.index(m) for m in col_models], dtype=int)
+    yi = np.searchsorted(years, col_years)
+
+    values = df[cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)   # (n_rows, n_cols)
+    n_rows = min(values.shape[0], N_DOY)
+    cube = np.full((len(models), len(years), N_DOY), np.nan)
+    cube[mi, yi, :n_rows] = values[:n_rows].T
+    present = np.zeros((len(models), len(years)), dtype=bool)
+    present[mi, yi] = True
+
+    index = {
+        "format": CUBE_FORMAT,
+        "var": var,
+        "ssp": str(ssp_code),
+        "source": {"name": path.name, **_stamp(path)},
+        "shape": list(cube.shape),
+        "models": models,
+        "years": years,
+        "present": present.astype(int).tolist(),
+    }
+    return cube, index
+
+
+def _write_store(path: Path, cube: np.ndarray, index: Dict) -> None:
+    """ 一時ファイルに書いてから置き換える（並行プロセスに書きかけを読ませない）"""
+    npy, idx = _store_paths(path)
+    tmp_npy = npy.with_name(f"{npy.stem}.{os.getpid()}.tmp.npy")
+    tmp_idx = idx.with_name(f"{idx.name}.{os.getpid()}.tmp")
+    np.save(tmp_npy, cube)
+    tmp_idx.write_text(json.dumps(index), encoding="utf-8")
+    os.replace(tmp_npy, npy)
+    os.replace(tmp_idx, idx)
+
+
+def _read_store(path: Path) -> Tuple[np.ndarray, Dict] | None:
+    """ 保存済みキューブが元 CSV と一致していれば (mmap 配列, 索引) を返す """
+    npy, idx = _store_paths(path)
+    if not (npy.exists() and idx.exists()):
+        return None
+    try:
+        index = json.loads(idx.read_text(encoding="utf-8"))
+        if index.get("format") != CUBE_FORMAT or index.get("source", {}).get("name") != path.name:
+            return None
+        if {k: index["source"].get(k) for k in ("size", "mtime_ns")} != _stamp(path):
+            return None
+        data = np.load(npy, mmap_mode="r")
+        if list(data.shape) != index["shape"]:
+            return None
+        return data, index
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+@lru_cache(maxsize=64)
+def _load_cached(path_str: str, var: str, ssp_code: str, size: int, mtime_ns: int) -> NiesCube:
+    # CSV のサイズ・更新時刻をキーに含めるので、CSV が変われば別エントリになる
+    path = Path(path_str)
+    stored = _read_store(path)
+    if stored is None:
+        cube, index = build_cube(path, var, ssp_code)
+        try:
+            _write_store(path, cube, index)
+            stored = _read_store(path)
+        except OSError:
+            stored = None   # 書き込めない場所ならメモリ上のキューブをそのまま使う
+        if stored is None:
+            stored = (cube, index)
+    data, index = stored
+    return NiesCube(var, ssp_code, data, index["models"], index["years"],
+                    np.asarray(index["present"], dtype=bool).reshape(data.shape[:2]))
+
+
+def load_cube(var: str, ssp_code: str | int, dirs: Sequence[Path] = NIES_DIR_CANDIDATES) -> NiesCube:
+    """ 変数・SSP のキューブを返す（無ければ作って保存、CSV が新しければ作り直す）"""
+    path = csv_path(var, ssp_code, dirs)
+    st = _stamp(path)
+    return _load_cached(str(path.resolve()), var, str(ssp_code), st["size"], st["mtime_ns"])
+
+
+def load_cubes(variables: Sequence[str], ssp_code: str | int,
+               dirs: Sequence[Path] = NIES_DIR_CANDIDATES) -> Dict[str, NiesCube]:
+    return {v: load_cube(v, ssp_code, dirs) for v in variables}
+
+
+# =========================
+# モデル入力テーブル（input.xlsx 形式）
+# =========================
+def clean_numeric(series: pd.Series, fallback: pd.Series | None = None) -> pd.Series:
+    s = pd.to_numeric(series, errors="coerce")
+    if s.isna().all() and fallback is not None:
+        s = pd.to_numeric(fallback, errors="coerce")
+    s = s.interpolate(limit_direction="both")
+    s = s.bfill().ffill().fillna(0)
+    s = s.replace([np.inf, -np.inf], 0)
+    return s.astype(float)
+
+
+def build_extdata_multi_year(ssp_code: str | int, model: str, start_year: int, n_years: int,
+                             dirs: Sequence[Path] = NIES_DIR_CANDIDATES) -> pd.DataFrame:
+    """
+    指定SSP/モデル/開始年/年数の連結テーブル（No., precipitation, temperature, tasmax, tasmin, rsds, date）
+    - 閏日は削除して詰める（常に 365*n_years 行）
+    - 欠測は補間後に前後詰め、なお残れば 0
+    キューブから (年, 365 日) を 1 回で抜き、日付も配列で作る（年ごとの DataFrame は作らない）。
+    """
+    cubes = load_cubes(list(EXTDATA_COLUMNS), ssp_code, dirs)
+    years = np.arange(int(start_year), int(start_year) + int(n_years))
+    for var, cube in cubes.items():
+        missing = years[~cube.available([model], years)[0]]
+        if len(missing):
+            raise KeyError(f"{var}: {model} {int(missing[0])} の列がありません")
+
+    # 2/29 を除いた暦日: 各年の 1/1 + doy（閏年は 2/29 の分だけ後ろへずらした doy）
+    jan1 = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    dates = (jan1[:, None] + doy_index_365(years)).reshape(-1)
+    df = pd.DataFrame(
+        {col: cubes[var].days365([model], years)[0].reshape(-1) for var, col in EXTDATA_COLUMNS.items()},
+        index=pd.DatetimeIndex(pd.Timestamp(f"{int(start_year)}-01-01")
+                               + pd.to_timedelta((dates - jan1[0]).astype(int), unit="D"), name="date"),
+    )
+
+    # 数値化＆埋め（clean_numeric と同じ処理を全列まとめて。tasmax/tasmin が全欠測なら気温で代用）
+    df["temperature"] = clean_numeric(df["temperature"])
+    for col in ("tasmax", "tasmin"):
+        if df[col].isna().all():
+            df[col] = df["temperature"]
+    df = df.interpolate(limit_direction="both").bfill().ffill().fillna(0)
+    df = df.replace([np.inf, -np.inf], 0).astype(float)
+
+    df = df.reset_index()
+    df.insert(0, "No.", np.arange(len(df), dtype=int))
+    df = df[["No.", "precipitation", "temperature", "tasmax", "tasmin", "rsds", "date"]]
+    return df
@@ -1,21 +1,38 @@
 # fetch_jma_to_excel.py
 # 使い方:
 #   python fetch_jma_to_excel.py --prec-no 82 --block-no 0790 --year 2023 --out jma_kurume_2023.xls
+#   python fetch_jma_to_excel.py --prec-no 82 --block-no 0790 --year 2023 --out jma_kurume_2023.xls --sync
+#     （--sync: 既存の --out に無い月・まだ暫定の月だけ取得して差し替える）
 #
 # ポイント:
 # - block-no が4桁 => AMeDAS (daily_s2.php)
 # - block-no が5桁 => 官署    (daily_s1.php)
 # - CSVは format=1、CP932、注記行スキップ＆ヘッダ自動検出
 # - 出典をメタ情報としてExcelに併記
+# - 応答はリポジトリ直下の .http_cache/ に保存（確定した月は再取得しない、当月は条件付きGET）
 
 import argparse
+import calendar
 import io
 import re
+import sys
 import time
 import requests
 import pandas as pd
+from datetime import date
 from pathlib import Path
 
+# old/ から直接実行しても http_cache（リポジトリ直下）を読めるようにする
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+try:
+    from http_cache import HttpCache, is_provisional, settle_date, urllib_fetch
+except ImportError:  # スクリプトだけを別の場所にコピーしたとき
+    HttpCache = None
+    print("[WARN] http_cache を読み込めません。キャッシュなしで全月を取得します（--sync も使えません）。",
+          file=sys.stderr)
+
 BASE = "https://www.data.jma.go.jp/stats/etrn/view"
 
 def build_endpoint(block_no: str) -> str:
@@ -29,7 +46,7 @@ def build_endpoint(block_no: str) -> str:
         # 官署（5桁）
         return "daily_s1.php", s
 
-def fetch_month_csv(prec_no: str, block_no: str, year: int, month: int, pause_sec=1.2) -> pd.DataFrame:
+def fetch_month_csv(prec_no: str, block_no: str, year: int, month: int, pause_sec=1.2, cache=None) -> pd.DataFrame:
     ep, bn = build_endpoint(block_no)
     url = (f"{BASE}/{ep}?prec_no={prec_no}&block_no={bn}"
            f"&year={year}&month={month}&day=&view=p1&format=1")
@@ -40,11 +57,18 @@ def fetch_month_csv(prec_no: str, block_no: str, year: int, month: int, pause_se
         "Accept": "text/csv, text/plain, */*",
         "Referer": "https://www.data.jma.go.jp/stats/etrn/index.php"
     }
-    r = requests.get(url, headers=headers, timeout=30)
-    r.raise_for_status()
+    if cache is not None:
+        month_end = date(year, month, calendar.monthrange(year, month)[1])
+        res = cache.get(url, (ep.split(".")[0], bn, f"{year}-{month:02d}"), urllib_fetch(headers, timeout=30),
+                        settled_after=settle_date(month_end), accept=lambda b: "日".encode("cp932") in b)
+        raw, from_cache = res.body, res.from_cache
+    else:
+        r = requests.get(url, headers=headers, timeout=30)
+        r.raise_for_status()
+        raw, from_cache = r.content, False
 
     # JMAのCSVはCP932（Shift_JIS想定）
-    text = r.content.decode("cp932", errors="ignore")
+    text = raw.decode("cp932", errors="ignore")
 
     # ヘッダ行（カラム行）を探す（「日」または「年月日」を含み、カンマ区切りの行）
     header_idx = None
@@ -108,15 +132,16 @@ def fetch_month_csv(prec_no: str, block_no: str, year: int, month: int, pause_se
         else:
             out[key] = pd.NA  # 列がない月もある
 
-    # 取得間隔を空ける
-    time.sleep(pause_sec)
+    # 取得間隔を空ける（キャッシュから返したときは通信していないので待たない）
+    if not from_cache:
+        time.sleep(pause_sec)
     return out
 
-def fetch_daily_year_by_codes(prec_no: str, block_no: str, year: int) -> pd.DataFrame:
+def fetch_daily_year_by_codes(prec_no: str, block_no: str, year: int, cache=None, months=None) -> pd.DataFrame:
     frames = []
-    for m in range(1, 13):
+    for m in (range(1, 13) if months is None else months):
         try:
-            frames.append(fetch_month_csv(str(prec_no), str(block_no), year, m))
+            frames.append(fetch_month_csv(str(prec_no), str(block_no), year, m, cache=cache))
         except Exception as e:
             print(f"[WARN] {year}-{m}: {e}")
     if not frames:
@@ -125,6 +150,56 @@ def fetch_daily_year_by_codes(prec_no: str, block_no: str, year: int) -> pd.Data
     df = df.sort_values("date").reset_index(drop=True)
     return df
 
+# 'jma' シートの列（to_pysd_excel の逆引き）
+JMA_SHEET_COLUMNS = {"B": "date", "E": "tavg", "H": "precipitation", "K": "sunshine", "Q": "tmax", "V": "tmin"}
+
+def read_pysd_excel(path: Path) -> pd.DataFrame:
+    """to_pysd_excel で書いた 'jma' シートを fetch_daily_year_by_codes と同じ列の表に戻す"""
+    jma = pd.read_excel(path, sheet_name="jma", header=None, names=list(JMA_SHEET_COLUMNS))
+    df = jma.rename(columns=JMA_SHEET_COLUMNS)
+    df["date"] = pd.to_datetime(df["date"], errors="coerce")
+    return df.dropna(subset=["date"])
+
+def months_to_sync(local: pd.DataFrame, year: int, today=None) -> list:
+    """
+    取得が必要な月の一覧。
+    - 手元に日の行がそろっていない月、値が 1 つも無い月
+    - 月末から SETTLE_DAYS 日以内（暫定値）の月
+    今日より後の月は対象にしない。
+    """
+    today = today or date.today()
+    values = local.drop(columns="date").apply(pd.to_numeric, errors="coerce")
+    per_day = pd.DataFrame({"date": local["date"].dt.normalize(), "ok": values.notna().any(axis=1)})
+    out = []
+    for m in range(1, 13):
+        m0 = date(year, m, 1)
+        m1 = date(year, m, calendar.monthrange(year, m)[1])
+        if m0 > today:
+            break
+        rows = per_day[(per_day["date"] >= pd.Timestamp(m0)) & (per_day["date"] <= pd.Timestamp(m1))]
+        complete = rows["date"].nunique() >= m1.day and bool(rows["ok"].any())
+        if not complete or is_provisional(m1, today):
+            out.append(m)
+    return out
+
+def sync_year(prec_no: str, block_no: str, year: int, out_path: Path, cache=None) -> pd.DataFrame:
+    """既存の out_path に無い月・暫定の月だけを取得し、手元の値と合わせた 1 年分の表を返す"""
+    if out_path.exists():
+        local = read_pysd_excel(out_path)
+    else:
+        local = pd.DataFrame({c: pd.Series(dtype=float) for c in JMA_SHEET_COLUMNS.values()})
+        local["date"] = pd.to_datetime(local["date"])
+    months = months_to_sync(local, year)
+    print(f"[INFO] 取得する月: {months if months else 'なし（手元の表が最新）'}")
+    if not months:
+        return local.sort_values("date").reset_index(drop=True)
+    fetched = fetch_daily_year_by_codes(prec_no, block_no, year, cache=cache, months=months)
+    # 取得できた月だけ差し替える（取得に失敗した月は手元の値を残す）
+    got = fetched["date"].dt.to_period("M").unique()
+    keep = local[~local["date"].dt.to_period("M").isin(got)]
+    df = pd.concat([keep, fetched], ignore_index=True)
+    return df.sort_values("date").reset_index(drop=True)
+
 def to_pysd_excel(df: pd.DataFrame, out_path: Path):
     """
     PySDモデル（River_management_chikugo.py）のExtData参照に合わせた
@@ -164,10 +239,17 @@ def main():
     ap.add_argument("--block-no", required=True, help="例: 0790（久留米 AMeDAS） / 47807（官署）")
     ap.add_argument("--year", type=int, required=True)
     ap.add_argument("--out", type=Path, required=True)
+    ap.add_argument("--sync", action="store_true", help="既存の --out に無い月・暫定の月だけ取得する")
     args = ap.parse_args()
+    if args.sync and HttpCache is None:
+        ap.error("--sync には http_cache が必要です（リポジトリ内の old/ から実行してください）")
 
     print(f"[INFO] 取得先: prec_no={args.prec_no}, block_no={args.block_no}, year={args.year}")
-    df = fetch_daily_year_by_codes(args.prec_no, args.block_no, args.year)
+    cache = HttpCache(REPO_ROOT / ".http_cache") if HttpCache is not None else None
+    if args.sync:
+        df = sync_year(args.prec_no, args.block_no, args.year, args.out, cache=cache)
+    else:
+        df = fetch_daily_year_by_codes(args.prec_no, args.block_no, args.year, cache=cache)
     to_pysd_excel(df, args.out)
     print(f"[OK] 保存しました: {args.out}")
 
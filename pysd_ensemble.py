@@ -0,0 +1,355 @@
+# pysd_ensemble.py
+# -*- coding: utf-8 -*-
+"""
+PySD モデルのアンサンブル実行（複数パラメータセットを 1 パスで評価）。
+
+PySD の各コンポーネントはスカラー計算のため、メンバー数ぶんのパラメータセットは
+「モデル読込済み（ウォーム）ワーカーのプロセスプール」に分配して 1 回で評価する。
+- ワーカーはモデルを 1 回だけ読み込み、以降のメンバーで使い回す
+- reducer を渡すとワーカー側で集計し、日次出力を親プロセスへ送らない
+- 実行時間はメンバー数ではなくコア数でスケールする
+"""
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from pysd import read_vensim, load
+
+
+# ---- 入力ファイル設定 ----
+MODEL_MDL = Path("River_management_xls_to3.mdl")  # Vensim テキスト
+MODEL_PY = Path("River_management_xls_to3.py")    # 変換済み PySD モデル
+
+# ---- シミュレーション設定（Vensim の CONTROL に合わせる）----
+DEFAULT_TIMESTAMPS = list(range(0, 365))
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# ---- キャリブレーション対象の水文パラメータ（.voc / .out の探索範囲）----
+HYDRO_BOUNDS = {
+    "upstream_outflow_ratio": (0.01, 0.99),
+    "downstream_outflow_ratio": (0.01, 0.99),
+    "direct_discharge_ratio": (0.01, 0.99),
+    "upstream_percolation_ratio": (0.01, 0.5),
+    "downstream_deep_percolation_ratio": (0.01, 0.5),
+    "upstream_middle_flow_ratio": (0.01, 0.99),
+    "downstream_percolation_ratio": (0.01, 0.5),
+    "downstream_middle_flow_ratio": (0.01, 0.99),
+    "waterholding_capacity_of_forest": (150, 250),
+    "upstream_deep_percolation_ratio": (0.01, 0.99),
+}
+
+# ---- ペイオフ構成（.voc の *CG/*CGE「変数|Zero/重み」に合わせる）----
+PAYOFF_WEIGHTS = {
+    "flow_log_error_sq": 1.0,
+    "high_flow_error": 1.0,
+    "top_flow_error": 1.0,
+}
+
+# ---- 入力テーブル列 → モデルの外部データ変数（GET XLS DATA の列割当）----
+FORCING_COMPONENTS = {
+    "precipitation": "daily_precip",
+    "temperature": "daily_ave_temp",
+    "tasmax": "daily_max_temp",
+    "tasmin": "daily_min_temp",
+    "rsds": "solar_radiation_time",
+}
+
+
+# =========================
+# ワーカー側（モデル保持）
+# =========================
+_MODELS: Dict[str, Any] = {}
+_OVERRIDDEN: Dict[str, set] = {}
+
+
+def _model_key(model_py: Path | str | None, model_mdl: Path | str | None) -> str:
+    return f"{model_py or ''}|{model_mdl or ''}"
+
+
+def get_model(model_py: Path | str | None = MODEL_PY, model_mdl: Path | str | None = MODEL_MDL):
+    """
+    マルチプロセス対応のため、モデルは遅延ロードしてプロセス内で使い回す。
+    """
+    key = _model_key(model_py, model_mdl)
+    if key not in _MODELS:
+        if model_py and Path(model_py).exists():
+            _MODELS[key] = load(Path(model_py).as_posix())
+        elif model_mdl and Path(model_mdl).exists():
+            _MODELS[key] = read_vensim(Path(model_mdl).as_posix())
+        else:
+            raise FileNotFoundError(f"{model_py} も {model_mdl} も見つかりません。")
+        _OVERRIDDEN[key] = set()
+    return _MODELS[key]
+
+
+def _init_worker(model_py: str | None, model_mdl: str | None) -> None:
+    # ワーカー起動時にモデルを読み込んでおく（初回メンバーの待ち時間を消す）
+    get_model(model_py, model_mdl)
+
+
+def run_member(
+    params: Dict[str, Any],
+    return_cols: Sequence[str],
+    timestamps: Sequence[float],
+    model_py: Path | str | None = MODEL_PY,
+    model_mdl: Path | str | None = MODEL_MDL,
+) -> pd.DataFrame:
+    """
+    1 メンバー分を実行する。PySD は run(params=...) の上書きをモデルに残すため、
+    前のメンバーで上書きしたのに今回指定の無い変数があればモデルを reload する。
+    """
+    model = get_model(model_py, model_mdl)
+    key = _model_key(model_py, model_mdl)
+    if not _OVERRIDDEN[key] <= set(params):
+        model.reload()
+        _OVERRIDDEN[key] = set()
+    _OVERRIDDEN[key] |= set(params)
+    return model.run(
+        params=params,
+        return_timestamps=list(timestamps),
+        return_columns=list(return_cols),
+        initial_condition="original",
+    )
+
+
+def _run_task(task: tuple) -> Any:
+    params, return_cols, timestamps, reducer, model_py, model_mdl, errors = task
+    try:
+        res = run_member(params, return_cols, timestamps, model_py, model_mdl)
+        return reducer(res) if reducer is not None else res
+    except Exception:
+        if errors == "ignore":
+            return None
+        raise
+
+
+# =========================
+# 親プロセス側（プール管理）
+# =========================
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_KEY: tuple | None = None
+
+
+def get_pool(
+    workers: int | None = None,
+    model_py: Path | str | None = MODEL_PY,
+    model_mdl: Path | str | None = MODEL_MDL,
+) -> ProcessPoolExecutor:
+    """
+    ウォームワーカーのプールを返す（同じ設定なら使い回す）。
+    """
+    global _POOL, _POOL_KEY
+    workers = int(workers or DEFAULT_WORKERS)
+    key = (workers, str(model_py or ""), str(model_mdl or ""))
+    if _POOL is None or _POOL_KEY != key:
+        shutdown_pool()
+        _POOL = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(str(model_py or ""), str(model_mdl or "")),
+        )
+        _POOL_KEY = key
+    return _POOL
+
+
+def shutdown_pool() -> None:
+    global _POOL, _POOL_KEY
+    if _POOL is not None:
+        _POOL.shutdown(wait=True, cancel_futures=True)
+    _POOL, _POOL_KEY = None, None
+
+
+atexit.register(shutdown_pool)
+
+
+def run_ensemble(
+    param_sets: Sequence[Dict[str, Any]],
+    return_cols: Sequence[str],
+    timestamps: Sequence[float] | None = None,
+    base_params: Dict[str, Any] | None = None,
+    reducer: Callable[[pd.DataFrame], Any] | None = None,
+    workers: int | None = None,
+    model_py: Path | str | None = MODEL_PY,
+    model_mdl: Path | str | None = MODEL_MDL,
+    errors: str = "raise",
+) -> List[Any]:
+    """
+    param_sets の全メンバーを 1 パスで評価し、入力順に結果を返す。
+
+    - base_params: 全メンバー共通の上書き（各メンバーの値が優先）
+    - reducer: ワーカー側で DataFrame を集計する関数（pickle 可能なトップレベル関数）
+    - workers: 1 以下ならプロセス内で逐次実行
+    - errors: "raise" なら例外を送出、"ignore" なら失敗メンバーを None で返す
+    """
+    if errors not in ("raise", "ignore"):
+        raise ValueError(f"Unknown errors mode: {errors}")
+    timestamps = list(DEFAULT_TIMESTAMPS if timestamps is None else timestamps)
+    base = dict(base_params or {})
+    tasks = [
+        ({**base, **p}, list(return_cols), timestamps, reducer, model_py, model_mdl, errors)
+        for p in param_sets
+    ]
+    if not tasks:
+        return []
+
+    workers = int(workers or DEFAULT_WORKERS)
+    if workers <= 1 or len(tasks) == 1:
+        return [_run_task(t) for t in tasks]
+
+    pool = get_pool(workers, model_py, model_mdl)
+    chunksize = max(1, math.ceil(len(tasks) / (workers * 4)))
+    return list(pool.map(_run_task, tasks, chunksize=chunksize))
+
+
+def submit_ensemble(
+    param_sets: Sequence[Dict[str, Any]],
+    return_cols: Sequence[str],
+    timestamps: Sequence[float] | None = None,
+    base_params: Dict[str, Any] | None = None,
+    reducer: Callable[[pd.DataFrame], Any] | None = None,
+    workers: int | None = None,
+    model_py: Path | str | None = MODEL_PY,
+    model_mdl: Path | str | None = MODEL_MDL,
+) -> List[Future]:
+    """
+    run_ensemble の非同期版。メンバーごとの Future を入力順に返す
+    （concurrent.futures.as_completed で終わった順に受け取れる。失敗は Future の例外になる）。
+    """
+    timestamps = list(DEFAULT_TIMESTAMPS if timestamps is None else timestamps)
+    base = dict(base_params or {})
+    pool = get_pool(workers, model_py, model_mdl)
+    return [
+        pool.submit(_run_task, ({**base, **p}, list(return_cols), timestamps, reducer, model_py, model_mdl, "raise"))
+        for p in param_sets
+    ]
+
+
+# =========================
+# 入出力ヘルパ
+# =========================
+def forcing_params(table: pd.DataFrame) -> Dict[str, pd.Series]:
+    """
+    input.xlsx 形式のテーブル（precipitation, temperature, tasmax, tasmin, rsds）を
+    モデル時刻（0, 1, 2, ...日）の時系列パラメータに変換する。
+    run(params=...) に渡すと Excel を書き出さずに外部データを差し替えられる。
+    """
+    t = np.arange(len(table), dtype=float)
+    out = {}
+    for col, comp in FORCING_COMPONENTS.items():
+        if col in table.columns:
+            out[comp] = pd.Series(pd.to_numeric(table[col], errors="coerce").to_numpy(float), index=t)
+    return out
+
+
+def calibration_payoff(res: pd.DataFrame, weights: Dict[str, float] | None = None) -> float:
+    """
+    Vensim のキャリブレーションペイオフ（-Σ(重み×(変数-Zero))^2）を再現する。
+    """
+    weights = PAYOFF_WEIGHTS if weights is None else weights
+    total = 0.0
+    for col, w in weights.items():
+        x = np.asarray(res[col], dtype=float)
+        total -= float(np.nansum((w * x) ** 2))
+    return total
+
+
+# =========================
+# 評価キャッシュ
+# =========================
+def _canonical(value: Any) -> Any:
+    """ ハッシュ用に値を JSON 化可能な形へ（時系列は中身のダイジェスト）"""
+    if isinstance(value, pd.Series):
+        h = hashlib.sha1(np.ascontiguousarray(value.to_numpy(float)).tobytes())
+        h.update(np.ascontiguousarray(value.index.to_numpy(float)).tobytes())
+        return {"__series__": h.hexdigest()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def hash_params(params: Dict[str, Any], *extra: Any) -> str:
+    """
+    パラメータ辞書（＋出力定義など）から決定的なキーを作る。
+    """
+    payload = {k: _canonical(v) for k, v in sorted(params.items())}
+    text = json.dumps([payload, list(extra)], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EvaluationCache:
+    """
+    集計済み評価結果の追記型ディスクキャッシュ（JSON Lines, 1 行 1 メンバー）。
+    途中で止めても評価済みの分は残り、同じ設計を再実行すると続きから評価する。
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._data: Dict[str, Any] = {}
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 書き込み途中で落ちた最終行は捨てる
+                    self._data[rec["key"]] = rec["value"]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def put_many(self, items: Dict[str, Any]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            for key, value in items.items():
+                f.write(json.dumps({"key": key, "value": value}, default=float) + "\n")
+        self._data.update(items)
+
+
+def run_ensemble_cached(
+    param_sets: Sequence[Dict[str, Any]],
+    return_cols: Sequence[str],
+    reducer: Callable[[pd.DataFrame], Any],
+    cache: EvaluationCache,
+    tag: str = "",
+    batch_size: int = 256,
+    **kwargs,
+) -> List[Any]:
+    """
+    run_ensemble のキャッシュ付き版。未評価メンバーだけを batch_size ごとに評価し、
+    バッチが終わるたびにキャッシュへ追記する（中断しても再開可能）。
+    reducer の戻り値は JSON 化できる値（数値や辞書）にすること。
+    """
+    timestamps = kwargs.get("timestamps")
+    base = dict(kwargs.get("base_params") or {})
+    keys = [hash_params({**base, **p}, tag, list(return_cols), timestamps) for p in param_sets]
+    seen: Dict[str, int] = {}
+    todo = [
+        i for i, k in enumerate(keys)
+        if k not in cache and seen.setdefault(k, i) == i  # 同一メンバーは 1 回だけ評価
+    ]
+
+    for s in range(0, len(todo), batch_size):
+        idx = todo[s : s + batch_size]
+        res = run_ensemble([param_sets[i] for i in idx], return_cols, reducer=reducer, **kwargs)
+        cache.put_many({keys[i]: r for i, r in zip(idx, res) if r is not None})
+        print(f"  evaluated {min(s + batch_size, len(todo))}/{len(todo)} (cached {len(cache)})")
+
+    return [cache.get(k) for k in keys]
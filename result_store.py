@@ -0,0 +1,379 @@
+# result_store.py
+# -*- coding: utf-8 -*-
+"""
+シミュレーション結果のパーティション付き Parquet ストア。
+
+- 1 実行 = 1 ファイル: <root>/<key>=<value>/.../<run_id>.parquet（Hive 形式、値は URI エンコード）
+- スキーマのメタデータに実行情報（モデルのハッシュ、パラメータ、強制データのハッシュ、期間）を持たせ、
+  同じ内容を <root>/_runs.jsonl（実行カタログ）にも追記する。一覧はファイルを開かずにカタログで引ける
+- 行グループは ROW_GROUP_DAYS 日ごと。time / date の範囲指定は行グループ統計で読み飛ばされる
+- 読み込みは pyarrow.dataset（パーティション・述語プッシュダウン）＋ mmap のローカルファイルシステム
+- 年別集計・実行横断の集計は Arrow の group_by で行い、必要な列だけを pandas に渡す
+
+これまでの simulation_output*.csv は import_csv で取り込める。
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from pysd_ensemble import MODEL_PY, hash_params
+
+
+STORE_DIR = Path("out_results")
+CATALOG = "_runs.jsonl"              # 先頭が "_" のファイルは pyarrow.dataset の探索対象外
+ROW_GROUP_DAYS = 365
+META_KEY = b"run"
+
+
+# =========================
+# ハッシュ
+# =========================
+@lru_cache(maxsize=16)
+def _file_hash(path_str: str, size: int, mtime_ns: int) -> str:
+    h = hashlib.sha1()
+    with open(path_str, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def model_hash(model_file: Path | str | None = MODEL_PY) -> str | None:
+    """ モデルファイル（.py / .mdl）の内容のハッシュ（サイズ・更新時刻が同じ間は再計算しない）"""
+    if not model_file or not Path(model_file).exists():
+        return None
+    st = Path(model_file).stat()
+    return _file_hash(str(Path(model_file).resolve()), st.st_size, st.st_mtime_ns)
+
+
+def forcing_hash(forcing: Dict[str, pd.Series] | pd.DataFrame | None) -> str | None:
+    """ forcing_params の辞書、または input.xlsx 形式の表のハッシュ """
+    if forcing is None:
+        return None
+    if isinstance(forcing, pd.DataFrame):
+        # 日付列は整数（ns）にしてから数値としてハッシュする
+        forcing = {str(c): (forcing[c].astype("int64") if pd.api.types.is_datetime64_any_dtype(forcing[c])
+                            else forcing[c]) for c in forcing.columns}
+    return hash_params(dict(forcing))
+
+
+# =========================
+# 書き込み
+# =========================
+def partition_dir(root: Path, partitions: Dict[str, Any]) -> Path:
+    # 値は URI エンコード（読込時に pyarrow.dataset の Hive パーティションが復号する）
+    return Path(root).joinpath(*(f"{k}={quote(str(v), safe='')}" for k, v in partitions.items()))
+
+
+def run_path(root: Path, partitions: Dict[str, Any], run_id: str) -> Path:
+    return partition_dir(root, partitions) / f"{run_id}.parquet"
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (np.generic,)):
+        return value.item()
+    if isinstance(value, pd.Series):
+        return {"__series__": forcing_hash({"_": value})}
+    return str(value)
+
+
+def write_run(
+    root: Path,
+    res: pd.DataFrame,
+    partitions: Dict[str, Any],
+    params: Dict[str, Any] | None = None,
+    forcing: Dict[str, pd.Series] | pd.DataFrame | None = None,
+    model_file: Path | str | None = MODEL_PY,
+    start_date: pd.Timestamp | str | None = None,
+    dates: Sequence | None = None,
+    run_id: str | None = None,
+    extra: Dict[str, Any] | None = None,
+) -> Path:
+    """
+    1 実行分の出力（index = モデル時刻）を書き込み、パスを返す。
+    日付は dates（行ごと）か start_date（+ time 日）で付ける。run_id を省略するとメタデータのハッシュ。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    t = np.asarray(res.index, dtype=float)
+    df = res.reset_index(drop=True).apply(pd.to_numeric, errors="coerce").astype(float)
+    df.insert(0, "time", t)
+    if dates is not None:
+        df.insert(0, "date", pd.DatetimeIndex(dates)[: len(df)])
+    elif start_date is not None:
+        df.insert(0, "date", pd.Timestamp(start_date) + pd.to_timedelta(t, unit="D"))
+
+    meta = {
+        "model_file": str(model_file) if model_file else None,
+        "model_hash": model_hash(model_file),
+        "params": {k: v for k, v in (params or {}).items() if not isinstance(v, pd.Series)},
+        "forcing_hash": forcing_hash(forcing),
+        "partitions": {k: str(v) for k, v in partitions.items()},
+        "columns": [c for c in df.columns if c not in ("date", "time")],
+        "time_range": [float(t.min()), float(t.max())] if len(t) else None,
+        "date_range": ([str(df["date"].iloc[0].date()), str(df["date"].iloc[-1].date())]
+                       if "date" in df.columns and len(df) else None),
+        **(extra or {}),
+    }
+    meta["run_id"] = run_id or hash_params(meta["params"], meta["model_hash"], meta["forcing_hash"],
+                                           meta["partitions"], meta["time_range"])
+    meta["created"] = datetime.now().isoformat(timespec="seconds")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.append_column("run_id", pa.array([meta["run_id"]] * len(df)).dictionary_encode())
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        META_KEY: json.dumps(meta, ensure_ascii=False, default=_json_default).encode("utf-8"),
+    })
+
+    path = run_path(root, partitions, meta["run_id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    pq.write_table(table, tmp, row_group_size=ROW_GROUP_DAYS)
+    os.replace(tmp, path)
+
+    # カタログは追記のみ（重複は読み込み時に後勝ち）
+    with (Path(root) / CATALOG).open("a", encoding="utf-8") as f:
+        f.write(json.dumps({**meta, "path": str(path.relative_to(root))}, ensure_ascii=False,
+                           default=_json_default) + "\n")
+    return path
+
+
+def import_csv(root: Path, csv_path: Path | str, partitions: Dict[str, Any], date_col: str = "date",
+               **kwargs) -> Path:
+    """
+    app のダウンロード CSV（index_label="date" の日別出力）を取り込む。
+    日付列が無ければ先頭列を時刻として扱う。
+    """
+    df = pd.read_csv(csv_path)
+    if date_col in df.columns:
+        dates = pd.to_datetime(df.pop(date_col))
+        df.index = pd.RangeIndex(len(df)).astype(float)
+        return write_run(root, df, partitions, dates=dates, extra={"source": str(csv_path)}, **kwargs)
+    df = df.set_index(df.columns[0])
+    return write_run(root, df, partitions, extra={"source": str(csv_path)}, **kwargs)
+
+
+# =========================
+# 読み込み・クエリ
+# =========================
+def read_catalog(root: Path = STORE_DIR) -> pd.DataFrame:
+    """ 実行カタログ（1 行 1 実行、ファイルが消えたものは除く）"""
+    path = Path(root) / CATALOG
+    recs: Dict[str, Dict[str, Any]] = {}
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で落ちた最終行は捨てる
+                recs[rec["path"]] = rec
+    rows = [
+        {**r.get("partitions", {}), **{k: v for k, v in r.items() if k != "partitions"}}
+        for p, r in recs.items() if (Path(root) / p).exists()
+    ]
+    return pd.DataFrame(rows)
+
+
+def rebuild_catalog(root: Path = STORE_DIR) -> int:
+    """ 各ファイルのスキーマのメタデータからカタログを作り直す（フッタだけを読む）"""
+    import pyarrow.parquet as pq
+
+    root = Path(root)
+    lines = []
+    for p in sorted(root.rglob("*.parquet")):
+        meta = (pq.read_schema(p).metadata or {}).get(META_KEY)
+        if meta is None:
+            continue
+        lines.append(json.dumps({**json.loads(meta), "path": str(p.relative_to(root))}, ensure_ascii=False))
+    tmp = root / f"{CATALOG}.{os.getpid()}.tmp"
+    tmp.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    os.replace(tmp, root / CATALOG)
+    return len(lines)
+
+
+class ResultStore:
+    """
+    ストアの読み取り口。filters は {パーティション/列: 値 または 値のリスト}、
+    time は (開始, 終了) のモデル時刻、dates は (開始日, 終了日)。どちらも両端を含む。
+    """
+
+    def __init__(self, root: Path | str = STORE_DIR):
+        self.root = Path(root)
+        self._dataset = None
+        self._keys: List[str] = []
+
+    # ---- データセット ----
+    def dataset(self):
+        """ 全実行を 1 つの pyarrow Dataset として開く（列の違う実行はスキーマを統合、無い列は null）"""
+        if self._dataset is None:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+            import pyarrow.fs as pafs
+
+            filesystem = pafs.LocalFileSystem(use_mmap=True)
+            self._keys = _partition_keys(self.root)
+            partitioning = ds.partitioning(pa.schema([(k, pa.string()) for k in self._keys]), flavor="hive")
+            probe = ds.dataset(str(self.root), format="parquet", partitioning=partitioning, filesystem=filesystem)
+            schemas = [f.physical_schema for f in probe.get_fragments()]
+            if not schemas:
+                raise FileNotFoundError(f"{self.root} に結果がありません")
+            schema = pa.unify_schemas([s.remove_metadata() for s in schemas] + [partitioning.schema],
+                                      promote_options="permissive")
+            self._dataset = ds.dataset(str(self.root), format="parquet", partitioning=partitioning,
+                                       filesystem=filesystem, schema=schema)
+        return self._dataset
+
+    def refresh(self) -> None:
+        self._dataset = None
+
+    def runs(self) -> pd.DataFrame:
+        return read_catalog(self.root)
+
+    # ---- 述語 ----
+    def _filter(self, filters: Dict[str, Any] | None, time: Tuple[float, float] | None,
+                dates: Tuple[Any, Any] | None):
+        import pyarrow.dataset as ds
+
+        self.dataset()
+        expr = None
+
+        def _and(e):
+            nonlocal expr
+            expr = e if expr is None else expr & e
+
+        for k, v in (filters or {}).items():
+            if isinstance(v, (list, tuple, set)):
+                _and(ds.field(k).isin([str(x) for x in v] if k in self._keys else list(v)))
+            else:
+                _and(ds.field(k) == (str(v) if k in self._keys else v))
+        if time is not None:
+            _and((ds.field("time") >= float(time[0])) & (ds.field("time") <= float(time[1])))
+        if dates is not None:
+            import pyarrow as pa
+            lo, hi = (pa.scalar(pd.Timestamp(d).to_datetime64(), type=self.dataset().schema.field("date").type)
+                      for d in dates)
+            _and((ds.field("date") >= lo) & (ds.field("date") <= hi))
+        return expr
+
+    def table(self, columns: Sequence[str] | None = None, filters: Dict[str, Any] | None = None,
+              time: Tuple[float, float] | None = None, dates: Tuple[Any, Any] | None = None):
+        """ 条件に合う行の Arrow Table（columns を省略すると全列）"""
+        return self.dataset().to_table(columns=list(columns) if columns is not None else None,
+                                       filter=self._filter(filters, time, dates))
+
+    def query(self, columns: Sequence[str] | None = None, filters: Dict[str, Any] | None = None,
+              time: Tuple[float, float] | None = None, dates: Tuple[Any, Any] | None = None) -> pd.DataFrame:
+        """ 列の部分集合・期間・パーティションで絞った長い形式の DataFrame """
+        return self.table(columns, filters, time, dates).to_pandas()
+
+    def read_run(self, run_id: str, columns: Sequence[str] | None = None) -> pd.DataFrame:
+        """ 1 実行分（index = date があれば日付、無ければ time）"""
+        names = self.dataset().schema.names
+        cols = None if columns is None else [c for c in ("date", "time") if c in names] + list(columns)
+        df = self.query(cols, filters={"run_id": run_id}).sort_values("time")
+        return df.set_index("date" if "date" in df.columns else "time")
+
+    # ---- 集計 ----
+    def aggregate(self, columns: Sequence[str], by: Sequence[str], how: str = "mean",
+                  filters: Dict[str, Any] | None = None, time: Tuple[float, float] | None = None,
+                  dates: Tuple[Any, Any] | None = None) -> pd.DataFrame:
+        """
+        実行横断の集計。by にはパーティション・time・date・run_id などを指定する
+        （例: by=["basin", "time"] で GCM を横断した日別の平均）。how は Arrow の集計関数名。
+        """
+        t = self.table([*by, *columns], filters, time, dates)
+        out = t.group_by(list(by)).aggregate([(c, how) for c in columns])
+        df = out.to_pandas().rename(columns={f"{c}_{how}": c for c in columns})
+        return df.sort_values(list(by)).reset_index(drop=True)
+
+    def annual(self, columns: Sequence[str], how: str = "sum", by: Sequence[str] = ("run_id",),
+               filters: Dict[str, Any] | None = None, dates: Tuple[Any, Any] | None = None) -> pd.DataFrame:
+        """ 日付の年ごとの集計（既定は実行ごとの年合計）。by にパーティションを足すと実行横断 """
+        import pyarrow.compute as pc
+
+        t = self.table(["date", *by, *columns], filters, None, dates)
+        t = t.append_column("year", pc.year(t["date"])).drop_columns(["date"])
+        out = t.group_by([*by, "year"]).aggregate([(c, how) for c in columns])
+        df = out.to_pandas().rename(columns={f"{c}_{how}": c for c in columns})
+        return df.sort_values([*by, "year"]).reset_index(drop=True)
+
+
+def _partition_keys(root: Path) -> List[str]:
+    """ カタログ（無ければディレクトリ名）からパーティションのキーを出現順に集める """
+    keys: List[str] = []
+    cat = read_catalog(root)
+    if not cat.empty and "path" in cat:
+        paths = cat["path"]
+    else:
+        paths = [str(p.relative_to(root)) for p in Path(root).rglob("*.parquet")]
+    for p in paths:
+        for part in Path(p).parts[:-1]:
+            if "=" in part:
+                k = part.split("=", 1)[0]
+                if k not in keys:
+                    keys.append(k)
+    return keys
+
+
+def _parse_kv(items: Sequence[str]) -> Dict[str, str]:
+    out = {}
+    for item in items or []:
+        k, _, v = item.partition("=")
+        out[k] = v
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="シミュレーション結果ストア（Parquet）の取り込み・一覧・集計")
+    parser.add_argument("--root", type=Path, default=STORE_DIR)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_imp = sub.add_parser("import", help="app の出力 CSV を取り込む")
+    p_imp.add_argument("csv", nargs="+", type=Path)
+    p_imp.add_argument("--partition", nargs="*", default=[], help="key=value（例: source=amedas ssp=245）")
+
+    sub.add_parser("runs", help="実行の一覧")
+    sub.add_parser("reindex", help="ファイルのメタデータからカタログを作り直す")
+
+    p_ann = sub.add_parser("annual", help="年別集計")
+    p_ann.add_argument("columns", nargs="+")
+    p_ann.add_argument("--by", nargs="*", default=["run_id"])
+    p_ann.add_argument("--how", default="sum")
+    p_ann.add_argument("--where", nargs="*", default=[], help="key=value で絞り込み")
+    p_ann.add_argument("--out", type=Path, default=None)
+    args = parser.parse_args()
+
+    if args.cmd == "import":
+        for csv in args.csv:
+            print(f"  -> {import_csv(args.root, csv, _parse_kv(args.partition))}")
+    elif args.cmd == "runs":
+        print(read_catalog(args.root).to_string(index=False))
+    elif args.cmd == "reindex":
+        print(f"{rebuild_catalog(args.root)} runs")
+    elif args.cmd == "annual":
+        df = ResultStore(args.root).annual(args.columns, args.how, args.by, _parse_kv(args.where))
+        if args.out:
+            df.to_csv(args.out, index=False, encoding="utf-8")
+            print(f"  -> {args.out}")
+        else:
+            print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# return_levels.py
+# -*- coding: utf-8 -*-
+"""
+日降水量の年最大値（AMS）から 50/100/200 年確率降水量（再現期間値）を推定する。
+
+- 分布: Gumbel / GEV、推定法: L モーメント / 最尤法（MLE）
+- SSP × GCM × 年窓ごとに推定し、ブートストラップ信頼区間を NumPy の一括計算で求める
+  （(窓, リサンプル, 年) の 3 次元配列に対して各推定法をまとめて適用する）
+- 結果は縦持ち（tidy）の Parquet に保存し、app はそれを読むだけで表示できる
+
+GEV の形状母数 ξ は Coles の記法（ξ>0 で裾が重い、ξ=0 が Gumbel）。
+"""
+from __future__ import annotations
+
+import argparse
+import math
+from pathlib import Path
+from typing import Callable, Dict, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from compute_nies_metrics import OUT_DIR, SSPS, VARS, YEARS, _choose_5_models, _load, annual_metrics
+
+try:
+    from scipy.special import gammaln
+    SCIPY_AVAILABLE = True
+except Exception:
+    SCIPY_AVAILABLE = False
+
+
+# ===== 設定 =====
+RETURN_LEVELS_PATH = OUT_DIR / "return_levels_pr.parquet"
+RETURN_PERIODS = [50, 100, 200]     # 再現期間 (年)
+WINDOW_YEARS = 30                   # 推定窓 (年)。10 年窓では GEV の 3 母数が不安定なため既定は 30 年
+WINDOW_STEP = 10                    # 窓の移動幅 (年)
+N_BOOT = 2000                       # ブートストラップ回数
+CI_LEVEL = 0.95
+XI_BOUNDS = (-0.5, 0.5)             # 最尤法での ξ の範囲（小標本で発散させないため）
+BOOT_CHUNK_ELEMS = 4_000_000        # 一度に展開する (窓×リサンプル×年) 要素数の上限
+
+EULER_GAMMA = 0.5772156649015329
+
+
+def _lgamma(x: np.ndarray) -> np.ndarray:
+    if SCIPY_AVAILABLE:
+        return gammaln(x)
+    return np.vectorize(math.lgamma, otypes=[float])(x)
+
+
+# =========================
+# L モーメント
+# =========================
+def lmoments(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    最後の軸に沿った標本 L モーメント (l1, l2, t3)。確率重み付きモーメント b0, b1, b2 から求める。
+    """
+    xs = np.sort(x, axis=-1)
+    n = xs.shape[-1]
+    j = np.arange(n, dtype=float)
+    w1 = j / (n - 1)
+    w2 = j * (j - 1) / ((n - 1) * (n - 2))
+    b0 = xs.mean(axis=-1)
+    b1 = (xs * w1).mean(axis=-1)
+    b2 = (xs * w2).mean(axis=-1)
+    l1 = b0
+    l2 = 2 * b1 - b0
+    l3 = 6 * b2 - 6 * b1 + b0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t3 = l3 / l2
+    return l1, l2, t3
+
+
+# =========================
+# 推定法（戻り値は (loc, scale, shape)、いずれも x.shape[:-1]）
+# =========================
+def fit_gumbel_lmom(x: np.ndarray):
+    l1, l2, _ = lmoments(x)
+    scale = l2 / np.log(2.0)
+    return l1 - EULER_GAMMA * scale, scale, np.zeros_like(l1)
+
+
+def fit_gev_lmom(x: np.ndarray):
+    """ Hosking (1985) の近似式。k = -ξ """
+    l1, l2, t3 = lmoments(x)
+    c = 2.0 / (3.0 + t3) - np.log(2.0) / np.log(3.0)
+    k = 7.8590 * c + 2.9554 * c * c
+    k = np.where(np.abs(k) < 1e-6, 1e-6, k)
+    g = np.exp(_lgamma(1.0 + k))
+    scale = l2 * k / ((1.0 - 2.0 ** (-k)) * g)
+    loc = l1 - scale * (1.0 - g) / k
+    return loc, scale, -k
+
+
+def fit_gumbel_mle(x: np.ndarray, n_iter: int = 50):
+    """
+    尤度方程式 β = mean(x) - Σx·e^{-x/β} / Σe^{-x/β} を β についてニュートン法で一括に解く。
+    """
+    _, beta, _ = fit_gumbel_lmom(x)
+    xmin = x.min(axis=-1, keepdims=True)
+    d = x - xmin
+    mean_d = d.mean(axis=-1)
+    for _ in range(n_iter):
+        w = np.exp(-d / beta[..., None])
+        sw = w.sum(axis=-1)
+        m1 = (d * w).sum(axis=-1) / sw
+        m2 = (d * d * w).sum(axis=-1) / sw
+        f = beta - mean_d + m1
+        fp = 1.0 + (m2 - m1 * m1) / beta ** 2
+        step = f / fp
+        beta = np.maximum(beta - step, 1e-3 * beta)
+        if np.all(np.abs(step) <= 1e-10 * beta):
+            break
+    loc = xmin[..., 0] - beta * np.log(np.exp(-d / beta[..., None]).mean(axis=-1))
+    return loc, beta, np.zeros_like(beta)
+
+
+def _gev_loglik_grad(x: np.ndarray, theta: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    θ = (μ, log σ, ξ) の対数尤度と勾配（(B,) と (B, 3)）。台の外に出る点があれば -inf。
+    """
+    mu, lsig, xi = theta[:, 0:1], theta[:, 1:2], theta[:, 2:3]
+    xi = np.where(np.abs(xi) < 1e-8, 1e-8, xi)
+    with np.errstate(all="ignore"):   # 重複だらけのリサンプル等で発散した試行点は -inf として棄却する
+        sig = np.exp(lsig)
+        z = (x - mu) / sig
+        t = 1.0 + xi * z
+        ok = (t > 0).all(axis=1)
+        t = np.where(t > 0, t, 1.0)
+        log_t = np.log(t)
+        y = np.exp(-log_t / xi)
+        n = x.shape[1]
+        ll = -n * lsig[:, 0] - ((1.0 + 1.0 / xi) * log_t + y).sum(axis=1)
+        a = (1.0 + xi) - y
+        g_mu = (a / (sig * t)).sum(axis=1)
+        g_ls = (-1.0 + a * z / t).sum(axis=1)
+        g_xi = ((1.0 - y) * log_t / xi ** 2 - (z / t) * (1.0 + (1.0 - y) / xi)).sum(axis=1)
+    grad = np.stack([g_mu, g_ls, g_xi], axis=1)
+    ok &= np.isfinite(ll) & np.isfinite(grad).all(axis=1)
+    return np.where(ok, ll, -np.inf), np.where(ok[:, None], grad, 0.0)
+
+
+def fit_gev_mle(x: np.ndarray, n_iter: int = 60):
+    """
+    GEV の最尤推定。L モーメント推定を初期値に、減衰付きニュートン法（ヘシアンは解析勾配の差分）で一括に解く。
+    """
+    shape = x.shape[:-1]
+    xb = x.reshape(-1, x.shape[-1])
+    B = xb.shape[0]
+    loc, scale, xi = fit_gev_lmom(xb)
+    theta = np.stack([loc, np.log(scale), np.clip(xi, *XI_BOUNDS)], axis=1)
+    ll, grad = _gev_loglik_grad(xb, theta)
+    # L モーメント推定が台の外に出る場合は Gumbel 相当から始める
+    bad = ~np.isfinite(ll)
+    if bad.any():
+        gl, gs, _ = fit_gumbel_lmom(xb[bad])
+        theta[bad] = np.stack([gl, np.log(gs), np.full(bad.sum(), 1e-3)], axis=1)
+        ll[bad], grad[bad] = _gev_loglik_grad(xb[bad], theta[bad])
+
+    lam = np.full(B, 1e-3)
+    eye = np.eye(3)
+    h = 1e-5
+    active = np.isfinite(ll)
+    for _ in range(n_iter):
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        th, g = theta[idx], grad[idx]
+        hess = np.empty((len(idx), 3, 3))
+        for j in range(3):
+            _, gj = _gev_loglik_grad(xb[idx], th + h * eye[j])
+            hess[:, :, j] = (gj - g) / h
+        hess = 0.5 * (hess + hess.transpose(0, 2, 1))
+        neg = -hess
+        damp = lam[idx, None, None] * (np.abs(np.diagonal(neg, axis1=1, axis2=2))[:, :, None] * eye + 1e-8 * eye)
+        try:
+            step = np.linalg.solve(neg + damp, g[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = g * 1e-3
+        new = th + step
+        new[:, 2] = np.clip(new[:, 2], *XI_BOUNDS)
+        ll_new, g_new = _gev_loglik_grad(xb[idx], new)
+        better = ll_new >= ll[idx]
+        acc = idx[better]
+        theta[acc], grad[acc] = new[better], g_new[better]
+        converged = better & (np.abs(ll_new - ll[idx]) < 1e-9 * (1.0 + np.abs(ll_new)))
+        ll[acc] = ll_new[better]
+        lam[idx] = np.where(better, lam[idx] / 10.0, lam[idx] * 10.0)
+        active[idx[converged | (lam[idx] > 1e8)]] = False
+
+    return (theta[:, 0].reshape(shape), np.exp(theta[:, 1]).reshape(shape), theta[:, 2].reshape(shape))
+
+
+FITTERS: Dict[Tuple[str, str], Callable[[np.ndarray], tuple]] = {
+    ("gumbel", "lmom"): fit_gumbel_lmom,
+    ("gumbel", "mle"): fit_gumbel_mle,
+    ("gev", "lmom"): fit_gev_lmom,
+    ("gev", "mle"): fit_gev_mle,
+}
+
+
+def return_level(loc, scale, shape, periods: Sequence[float]) -> np.ndarray:
+    """ 再現期間 T 年の値 x_T（最後の軸が periods） """
+    yp = -np.log(1.0 - 1.0 / np.asarray(periods, dtype=float))
+    loc, scale, shape = (np.asarray(a, dtype=float)[..., None] for a in (loc, scale, shape))
+    small = np.abs(shape) < 1e-6
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gev = loc + scale / shape * (yp ** (-shape) - 1.0)
+    return np.where(small, loc - scale * np.log(yp), gev)
+
+
+# =========================
+# ブートストラップ
+# =========================
+def bootstrap_return_levels(
+    samples: np.ndarray,
+    fitter: Callable[[np.ndarray], tuple],
+    periods: Sequence[float] = RETURN_PERIODS,
+    n_boot: int = N_BOOT,
+    ci: float = CI_LEVEL,
+    seed: int = 42,
+) -> Dict[str, np.ndarray]:
+    """
+    (G, n) の標本（G 個の窓）に対し、点推定と百分位ブートストラップ信頼区間を返す。
+    リサンプルは (G, n_boot, n) にまとめて推定し、メモリ上限を超える分は窓方向に分割する。
+    """
+    rng = np.random.default_rng(seed)
+    G, n = samples.shape
+    loc, scale, shape = fitter(samples)
+    point = return_level(loc, scale, shape, periods)                    # (G, n_T)
+    lo = np.empty_like(point)
+    hi = np.empty_like(point)
+    q = [(1.0 - ci) / 2.0, 1.0 - (1.0 - ci) / 2.0]
+    chunk = max(1, int(BOOT_CHUNK_ELEMS // (n_boot * n)))
+    for s in range(0, G, chunk):
+        x = samples[s:s + chunk]
+        idx = rng.integers(0, n, size=(len(x), n_boot, n))
+        boot = np.take_along_axis(x[:, None, :], idx, axis=2)           # (g, n_boot, n)
+        rl = return_level(*fitter(boot), periods)                       # (g, n_boot, n_T)
+        lo[s:s + chunk], hi[s:s + chunk] = np.nanquantile(rl, q, axis=1)
+    return {"loc": loc, "scale": scale, "shape": shape, "point": point, "ci_low": lo, "ci_high": hi}
+
+
+# =========================
+# NIES の AMS → 窓
+# =========================
+def ams_windows(ssp: str, window: int = WINDOW_YEARS, step: int = WINDOW_STEP) -> pd.DataFrame:
+    """
+    5 GCM の年最大日降水量を年窓に切り出す（窓はデータのある年を並べて数える。compute_nies_metrics と同じ）。
+    戻り値: 1 行 1 窓（ssp, model, window_start, window_end, n_years, ams）
+    """
+    cubes = {v: _load(v, ssp) for v in VARS}
+    models = _choose_5_models(ssp)
+    res = annual_metrics(cubes, models, YEARS)
+    rows = []
+    for i, model in enumerate(models):
+        ys = np.asarray(YEARS)[res["valid"][i]]
+        ams = res["ams"][i, res["valid"][i]]
+        for s in range(0, len(ys) - window + 1, step):
+            rows.append({"ssp": ssp, "model": model, "window_start": int(ys[s]),
+                         "window_end": int(ys[s + window - 1]), "n_years": window, "ams": ams[s:s + window]})
+    return pd.DataFrame(rows)
+
+
+def compute_return_levels(
+    ssps: Sequence[str] = SSPS,
+    window: int = WINDOW_YEARS,
+    step: int = WINDOW_STEP,
+    periods: Sequence[float] = RETURN_PERIODS,
+    n_boot: int = N_BOOT,
+    ci: float = CI_LEVEL,
+    seed: int = 42,
+) -> pd.DataFrame:
+    """
+    全 SSP・GCM・窓について 4 通り（Gumbel/GEV × L モーメント/MLE）の再現期間値と CI を縦持ちで返す。
+    """
+    win = pd.concat([ams_windows(s, window, step) for s in ssps], ignore_index=True)
+    if win.empty:
+        raise RuntimeError(f"{window} 年窓を作れるデータがありません")
+    samples = np.stack(win["ams"].to_numpy())
+    keys = win.drop(columns="ams")
+
+    frames = []
+    for (dist, method), fitter in FITTERS.items():
+        r = bootstrap_return_levels(samples, fitter, periods, n_boot, ci, seed)
+        for k, T in enumerate(periods):
+            frames.append(keys.assign(
+                distribution=dist, method=method, return_period=T,
+                return_level=r["point"][:, k], ci_low=r["ci_low"][:, k], ci_high=r["ci_high"][:, k],
+                loc=r["loc"], scale=r["scale"], shape=r["shape"],
+            ))
+    out = pd.concat(frames, ignore_index=True)
+    out.attrs.update({"n_boot": n_boot, "ci_level": ci})
+    return out.sort_values(["ssp", "model", "distribution", "method", "return_period", "window_start"],
+                           ignore_index=True)
+
+
+def load_return_levels(path: Path = RETURN_LEVELS_PATH) -> pd.DataFrame:
+    """ 保存済みの再現期間値テーブルを読む（app から再計算せずに使う）"""
+    return pd.read_parquet(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NIES 日降水量 AMS の再現期間値（Gumbel/GEV, L モーメント/MLE, ブートストラップ CI）")
+    parser.add_argument("--ssps", nargs="+", default=SSPS)
+    parser.add_argument("--window", type=int, default=WINDOW_YEARS, help="推定窓（年）")
+    parser.add_argument("--step", type=int, default=WINDOW_STEP, help="窓の移動幅（年）")
+    parser.add_argument("--periods", nargs="+", type=float, default=RETURN_PERIODS, help="再現期間（年）")
+    parser.add_argument("--n-boot", type=int, default=N_BOOT)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", type=Path, default=RETURN_LEVELS_PATH)
+    args = parser.parse_args()
+
+    df = compute_return_levels(args.ssps, args.window, args.step, args.periods, args.n_boot, seed=args.seed)
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(args.out, index=False)
+    summary = df[df["return_period"] == max(args.periods)].groupby(["ssp", "distribution", "method"])
+    print(summary[["return_level", "ci_low", "ci_high"]].median().to_string())
+    print(f"  -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
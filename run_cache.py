@@ -0,0 +1,177 @@
+# run_cache.py
+# -*- coding: utf-8 -*-
+"""
+シミュレーション 1 回分の結果キャッシュ（メモリの LRU ＋ ディスクの Parquet）。
+
+- キーは (モデルファイルのハッシュ, パラメータ全体, 取得列, 時刻, 入力テーブルのハッシュ)
+- メモリ側は OrderedDict の LRU（MEMORY_ENTRIES 件まで）
+- ディスク側は CACHE_DIR/<key>.parquet。DISK_MAX_MB を超えたら古い（最後に使った時刻の古い）ものから消す
+- app のセッション（スレッド）間で共有するのでロックで保護する
+"""
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Sequence
+
+import pandas as pd
+
+from pysd_ensemble import hash_params
+
+
+CACHE_DIR = Path(".cache/runs")
+MEMORY_ENTRIES = 32
+DISK_MAX_MB = 1024
+
+
+def run_key(
+    model_hash: str | None,
+    params: Dict[str, Any],
+    return_cols: Sequence[str],
+    timestamps: Sequence[float],
+    input_hash: str | None,
+) -> str:
+    """ 実行を一意に決めるキー。時刻は (先頭, 末尾, 件数) に縮める """
+    ts = [float(timestamps[0]), float(timestamps[-1]), len(timestamps)] if len(timestamps) else []
+    return hash_params(dict(params), model_hash, sorted(return_cols), ts, input_hash)
+
+
+class RunCache:
+    """
+    get / put / get_or_run を持つ 2 段キャッシュ。返す DataFrame はコピー（呼び出し側で書き換えてよい）。
+    """
+
+    def __init__(self, root: Path | str = CACHE_DIR, max_entries: int = MEMORY_ENTRIES,
+                 max_disk_mb: float = DISK_MAX_MB):
+        self.root = Path(root)
+        self.max_entries = max_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 ** 2)
+        self._mem: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.parquet"
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return self._mem[key].copy()
+        path = self._path(key)
+        if path.exists():
+            try:
+                res = pd.read_parquet(path)
+                os.utime(path)                      # LRU の順序はファイルの更新時刻で持つ
+            except (OSError, ValueError):
+                res = None
+            if res is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, res)
+                return res.copy()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def peek(self, key: str, columns: Sequence[str] | None = None) -> pd.DataFrame | None:
+        """
+        ヒット率に数えずに取り出す（表示やダウンロードで実行結果を読み直すとき用）。
+        columns を渡すとその列だけ（存在する列だけ）のコピーを返す。
+        """
+        with self._lock:
+            res = self._mem.get(key)
+        if res is None:
+            path = self._path(key)
+            if not path.exists():
+                return None
+            try:
+                res = pd.read_parquet(path)
+            except (OSError, ValueError):
+                return None
+            with self._lock:
+                self._remember(key, res)
+        if columns is not None:
+            res = res[[c for c in columns if c in res.columns]]
+        return res.copy()
+
+    def put(self, key: str, res: pd.DataFrame) -> None:
+        res = res.copy()
+        with self._lock:
+            self._remember(key, res)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            res.to_parquet(tmp)
+            os.replace(tmp, path)
+            self._evict_disk()
+        except OSError:
+            pass  # 書けない場所ならメモリ側だけで使う
+
+    def get_or_run(self, key: str, fn: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        res = self.get(key)
+        if res is None:
+            res = fn()
+            self.put(key, res)
+        return res
+
+    def _remember(self, key: str, res: pd.DataFrame) -> None:
+        self._mem[key] = res
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _disk_files(self):
+        if not self.root.exists():
+            return []
+        files = []
+        for p in self.root.glob("*.parquet"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        return sorted(files)
+
+    def _evict_disk(self) -> None:
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        for _, size, p in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                p.unlink()
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self.hits = self.disk_hits = self.misses = 0
+        for _, _, p in self._disk_files():
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, float]:
+        files = self._disk_files()
+        with self._lock:
+            n = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n if n else 0.0,
+                "memory_entries": len(self._mem),
+                "disk_entries": len(files),
+                "disk_mb": sum(size for _, size, _ in files) / 1024 ** 2,
+            }
@@ -1,6 +1,8 @@
 from pathlib import Path
 from pysd import read_vensim, load
 
+from vensim_artifacts import load_calibrated_params
+
 # ---- 入力ファイル設定 ----
 MODEL_MDL = Path("River_management_xls_to3.mdl")  # Vensim テキスト
 MODEL_PY = Path("River_management_xls_to3.py")    # 変換済み PySD モデル
@@ -17,8 +19,11 @@ else:
 time = list(range(0, 365, 1))
 
 # ---- パラメータ上書き（必要な場合のみ）----
-# opt_mode を切り替えると最適化済みパラメータを自動適用
+# opt_mode を切り替えると最適化済みパラメータ（Vensim の .out）を自動適用
 opt_mode = "opt_riv_dis_down"  # None or "opt_riv_dis_down"
+OPT_RESULTS = {
+    "opt_riv_dis_down": Path("chikugo_run_opt_flow_obs_NormHighTopflowSq_BF_100_heat26.out"),
+}
 
 params = {
     "daily_precipitation_future_ratio": 1,
@@ -26,21 +31,8 @@ params = {
     "dam_investment_amount": 0,
 }
 
-if opt_mode == "opt_riv_dis_down":
-    params.update(
-        {
-            "upstream_outflow_ratio": 0.0270484,
-            "downstream_outflow_ratio": 0.0446371,
-            "direct_discharge_ratio": 0.99,
-            "upstream_percolation_ratio": 0.303752,
-            "downstream_deep_percolation_ratio": 0.251362,
-            "upstream_middle_flow_ratio": 0.141604,
-            "downstream_percolation_ratio": 0.191405,
-            "downstream_middle_flow_ratio": 0.0620332,
-            "waterholding_capacity_of_forest": 157.484,
-            "upstream_deep_percolation_ratio": 0.922893,
-        }
-    )
+if opt_mode is not None:
+    params.update(load_calibrated_params(OPT_RESULTS[opt_mode], model))
 
 # ---- 取得したい出力（スネークケース）----
 return_cols = [
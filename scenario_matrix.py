@@ -0,0 +1,299 @@
+# scenario_matrix.py
+# -*- coding: utf-8 -*-
+"""
+SSP × GCM × 流域プリセット × 適応策 のシナリオ行列をヘッドレスで一括実行する。
+
+- 強制データは nies_cube.build_extdata_multi_year → forcing_params（Excel を書かない）
+- (強制データ, パラメータ) が同一のシナリオは 1 回だけ実行し、結果を各シナリオに書く
+- pysd_ensemble のウォームワーカーに投入し、完了順に進捗を表示。失敗は MAX_RETRIES まで再投入
+  （ワーカーが落ちてプールが壊れた場合はプールを作り直す）
+- 結果は result_store で SCENARIO_DIR/ssp=<>/gcm=<>/basin=<>/policy=<>/<run_id>.parquet に書く
+  （ResultStore(SCENARIO_DIR) でそのままクエリできる）
+- 書き込みは一時ファイル → os.replace なので、書けたシナリオは完了扱い。再実行すると残りだけを実行する
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from flood_risk import POLICIES
+from model_params import OPT_RESULT, PRESETS
+from nies_cube import NIES_DIR_CANDIDATES, build_extdata_multi_year, load_cube
+from pysd_ensemble import (
+    DEFAULT_WORKERS, MODEL_MDL, MODEL_PY, forcing_params, get_pool, hash_params, run_member, shutdown_pool,
+)
+from result_store import run_path, write_run
+
+
+# ---- 行列の既定値 ----
+SCENARIO_DIR = Path("out_scenarios")
+SSPS = ["119", "126", "245", "585"]
+N_GCMS = 5                            # app と同じく SSP ごとに先頭 5 GCM
+START_YEAR = 2015
+N_YEARS = 10
+NIES_VARS = ["pr", "tas", "tasmax", "tasmin", "rsds"]
+
+RETURN_COLS = [
+    "daily_total_gdp",
+    "dam_storage",
+    "downstream_storage",
+    "upstream_storage",
+    "river_discharge_downstream",
+    "houses_damaged_by_inundation",
+    "financial_damage_by_innundation",
+    "financial_damage_by_flood",
+    "daily_crop_production",
+    "biodiversity",
+    "co2_absorption",
+    "municipality_cost",
+]
+
+# ---- スケジューラ ----
+MAX_RETRIES = 2                       # 1 シナリオあたりの再投入回数
+IN_FLIGHT_PER_WORKER = 2              # 同時に投入しておくタスク数（ワーカーあたり）
+FAILED_LOG = "_failed.jsonl"
+MANIFEST = "_manifest.csv"
+
+
+# =========================
+# 行列の組み立て
+# =========================
+def expand_policy_grid(grid: Dict[str, Sequence[float]]) -> Dict[str, Dict[str, float]]:
+    """ {パラメータ: [値, ...]} の直積を {"grid000": {...}, ...} に展開する """
+    keys = sorted(grid)
+    return {
+        f"grid{i:03d}": dict(zip(keys, values))
+        for i, values in enumerate(itertools.product(*(grid[k] for k in keys)))
+    }
+
+
+def choose_gcms(ssp: str, n: int = N_GCMS, years: Sequence[int] | None = None,
+                dirs: Sequence[Path] = NIES_DIR_CANDIDATES) -> List[str]:
+    """ 5 変数すべて（years を渡せばその全年）に揃っている GCM を pr の並び順で先頭 n 本 """
+    cubes = [load_cube(v, ssp, dirs) for v in NIES_VARS]
+    common = set.intersection(*(set(c.models) for c in cubes))
+    models = [m for m in cubes[0].models if m in common]
+    if years is not None:
+        ok = np.logical_and.reduce([c.available(models, years).all(axis=1) for c in cubes])
+        models = [m for m, good in zip(models, ok) if good]
+    return models[:n]
+
+
+@lru_cache(maxsize=64)
+def _forcing(ssp: str, gcm: str, start_year: int, n_years: int) -> tuple:
+    table = build_extdata_multi_year(ssp, gcm, start_year, n_years)
+    return forcing_params(table), pd.DatetimeIndex(table["date"])
+
+
+def plan_scenarios(
+    ssps: Sequence[str],
+    gcms: Sequence[str] | None,
+    basins: Sequence[str],
+    policies: Dict[str, Dict[str, float]],
+    start_year: int = START_YEAR,
+    n_years: int = N_YEARS,
+    base_params: Dict[str, Any] | None = None,
+    out_dir: Path = SCENARIO_DIR,
+    n_gcms: int = N_GCMS,
+) -> List[Dict[str, Any]]:
+    """
+    シナリオ行列を展開する。各要素は ssp, gcm, basin, policy, key（重複排除用のハッシュ）, run_id, path。
+    gcms が None なら SSP ごとに choose_gcms。パラメータは base → 流域プリセット → 適応策 の順で上書き。
+    期間の一部でも欠けている (SSP, GCM) は警告を出して飛ばす。
+    """
+    timestamps = list(range(365 * n_years))
+    years = range(start_year, start_year + n_years)
+    scenarios = []
+    for ssp in ssps:
+        for gcm in (gcms if gcms is not None else choose_gcms(ssp, n_gcms, years)):
+            try:
+                forcing, _ = _forcing(ssp, gcm, start_year, n_years)
+            except (KeyError, FileNotFoundError) as e:
+                print(f"  skip ssp={ssp} gcm={gcm}: {e}")
+                continue
+            for basin in basins:
+                for policy, overrides in policies.items():
+                    params = {**(base_params or {}), **PRESETS[basin], **overrides}
+                    key = hash_params({**params, **forcing}, "scenario", RETURN_COLS, timestamps)
+                    parts = {"ssp": ssp, "gcm": gcm, "basin": basin, "policy": policy}
+                    run_id = hash_params(parts, key)
+                    scenarios.append({
+                        **parts, "start_year": start_year, "n_years": n_years,
+                        "params": params, "key": key, "run_id": run_id,
+                        "path": run_path(out_dir, parts, run_id),
+                    })
+    return scenarios
+
+
+# =========================
+# 実行
+# =========================
+def _run_scenario(task: tuple) -> pd.DataFrame:
+    # ワーカー側（pickle 可能なトップレベル関数）
+    params, return_cols, timestamps, model_py, model_mdl = task
+    return run_member(params, return_cols, timestamps, model_py, model_mdl)
+
+
+def _task(sc: Dict[str, Any], model_py, model_mdl) -> tuple:
+    forcing, _ = _forcing(sc["ssp"], sc["gcm"], sc["start_year"], sc["n_years"])
+    timestamps = list(range(365 * sc["n_years"]))
+    return ({**sc["params"], **forcing}, RETURN_COLS, timestamps, model_py, model_mdl)
+
+
+def write_part(sc: Dict[str, Any], res: pd.DataFrame, model_py: Path | str | None = MODEL_PY,
+               out_dir: Path = SCENARIO_DIR) -> Path:
+    """ 1 シナリオ分を結果ストアに書く """
+    forcing, dates = _forcing(sc["ssp"], sc["gcm"], sc["start_year"], sc["n_years"])
+    parts = {k: sc[k] for k in ("ssp", "gcm", "basin", "policy")}
+    return write_run(out_dir, res, parts, params=sc["params"], forcing=forcing, model_file=model_py,
+                     dates=dates, run_id=sc["run_id"], extra={"key": sc["key"]})
+
+
+def run_matrix(
+    scenarios: List[Dict[str, Any]],
+    workers: int | None = None,
+    retries: int = MAX_RETRIES,
+    model_py: Path | str | None = MODEL_PY,
+    model_mdl: Path | str | None = MODEL_MDL,
+    out_dir: Path = SCENARIO_DIR,
+) -> Dict[str, int]:
+    """
+    未完了のシナリオだけを実行する。戻り値は実行数 runs と、シナリオ単位の done / skipped / failed の件数。
+    """
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for sc in scenarios:
+        groups.setdefault(sc["key"], []).append(sc)
+    todo = [k for k, scs in groups.items() if not all(Path(sc["path"]).exists() for sc in scs)]
+    n_skipped = len(scenarios) - sum(len(groups[k]) for k in todo)
+    print(f"scenarios {len(scenarios)} / unique runs {len(groups)} / to run {len(todo)} (already done {n_skipped})")
+
+    stats = {"runs": 0, "done": 0, "skipped": n_skipped, "failed": 0}
+    failed_log = Path(out_dir) / FAILED_LOG
+    t0 = time.perf_counter()
+
+    def _finish(key: str, res: pd.DataFrame) -> None:
+        for sc in groups[key]:
+            if not Path(sc["path"]).exists():
+                write_part(sc, res, model_py or model_mdl, out_dir)
+            stats["done"] += 1
+        stats["runs"] += 1
+        elapsed = time.perf_counter() - t0
+        eta = elapsed / stats["runs"] * (len(todo) - stats["runs"])
+        sc = groups[key][0]
+        print(f"  [{stats['runs']}/{len(todo)}] ssp={sc['ssp']} gcm={sc['gcm']} basin={sc['basin']} "
+              f"policy={sc['policy']} (+{len(groups[key]) - 1} dup) elapsed {elapsed:.0f}s eta {eta:.0f}s")
+
+    def _fail(key: str, err: BaseException) -> None:
+        stats["failed"] += len(groups[key])
+        failed_log.parent.mkdir(parents=True, exist_ok=True)
+        with failed_log.open("a", encoding="utf-8") as f:
+            for sc in groups[key]:
+                rec = {k: sc[k] for k in ("ssp", "gcm", "basin", "policy", "key")}
+                f.write(json.dumps({**rec, "error": repr(err)}, ensure_ascii=False) + "\n")
+        print(f"  FAILED {groups[key][0]['ssp']}/{groups[key][0]['gcm']}/{groups[key][0]['basin']}/"
+              f"{groups[key][0]['policy']}: {err!r}")
+
+    workers = int(workers or DEFAULT_WORKERS)
+    if workers <= 1:
+        for key in todo:
+            for attempt in range(retries + 1):
+                try:
+                    _finish(key, _run_scenario(_task(groups[key][0], model_py, model_mdl)))
+                    break
+                except Exception as e:
+                    if attempt == retries:
+                        _fail(key, e)
+        return stats
+
+    queue = [(key, 0) for key in todo]
+    queue.reverse()                        # pop() で先頭から取り出す
+    pending: Dict[Any, tuple] = {}
+    pool = get_pool(workers, model_py, model_mdl)
+    while queue or pending:
+        while queue and len(pending) < workers * IN_FLIGHT_PER_WORKER:
+            key, attempt = queue.pop()
+            pending[pool.submit(_run_scenario, _task(groups[key][0], model_py, model_mdl))] = (key, attempt)
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        broken = False
+        for fut in done:
+            key, attempt = pending.pop(fut)
+            try:
+                _finish(key, fut.result())
+            except Exception as e:
+                broken |= isinstance(e, BrokenProcessPool)
+                if attempt < retries:
+                    queue.append((key, attempt + 1))
+                else:
+                    _fail(key, e)
+        if broken:
+            # 壊れたプールの残りのタスクも再投入し、プールを作り直す
+            for fut, (key, attempt) in pending.items():
+                queue.append((key, attempt))
+            pending.clear()
+            shutdown_pool()
+            pool = get_pool(workers, model_py, model_mdl)
+    return stats
+
+
+def write_manifest(scenarios: List[Dict[str, Any]], out_dir: Path = SCENARIO_DIR) -> Path:
+    rows = [{**{k: sc[k] for k in ("ssp", "gcm", "basin", "policy", "start_year", "n_years", "key", "run_id")},
+             "params": json.dumps(sc["params"], ensure_ascii=False, default=float),
+             "path": str(sc["path"])} for sc in scenarios]
+    path = Path(out_dir) / MANIFEST
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(rows).to_csv(path, index=False, encoding="utf-8")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSP × GCM × 流域プリセット × 適応策 のシナリオ行列を一括実行")
+    parser.add_argument("--ssps", nargs="+", default=SSPS)
+    parser.add_argument("--gcms", nargs="+", default=None, help="既定は SSP ごとに先頭 --n-gcms 本")
+    parser.add_argument("--n-gcms", type=int, default=N_GCMS)
+    parser.add_argument("--basins", nargs="+", default=list(PRESETS), choices=list(PRESETS))
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), choices=list(POLICIES),
+                        help="flood_risk.POLICIES の適応策（--grid を指定した場合は無視）")
+    parser.add_argument("--grid", type=Path, default=None, help='適応策グリッドの JSON（例: {"levee_investment_amount": [0, 1e8]}）')
+    parser.add_argument("--start-year", type=int, default=START_YEAR)
+    parser.add_argument("--n-years", type=int, default=N_YEARS)
+    parser.add_argument("--params", type=Path, default=OPT_RESULT, help="水文パラメータ（Vensim 成果物、無ければ既定値）")
+    parser.add_argument("--out", type=Path, default=SCENARIO_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES)
+    parser.add_argument("--dry-run", action="store_true", help="行列と重複排除の結果だけ表示する")
+    args = parser.parse_args()
+
+    if args.grid is not None:
+        policies = expand_policy_grid(json.loads(args.grid.read_text(encoding="utf-8")))
+    else:
+        policies = {p: POLICIES[p] for p in args.policies}
+
+    base = {}
+    if args.params and args.params.exists():
+        from pysd_ensemble import get_model
+        from vensim_artifacts import load_calibrated_params
+        base = load_calibrated_params(args.params, get_model())
+
+    scenarios = plan_scenarios(args.ssps, args.gcms, args.basins, policies, args.start_year, args.n_years,
+                               base, args.out, args.n_gcms)
+    print(f"  -> {write_manifest(scenarios, args.out)}")
+    if args.dry_run:
+        print(f"scenarios {len(scenarios)} / unique runs {len({sc['key'] for sc in scenarios})}")
+        return
+
+    stats = run_matrix(scenarios, workers=args.workers, retries=args.retries, out_dir=args.out)
+    print(f"Done. {stats}")
+
+
+if __name__ == "__main__":
+    main()
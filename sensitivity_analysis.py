@@ -0,0 +1,236 @@
+# sensitivity_analysis.py
+# -*- coding: utf-8 -*-
+"""
+大域的感度分析（Sobol/Saltelli と Morris スクリーニング）。
+
+- 探索範囲は PARAM_SPECS（UI スライダー）/ ADAPTATION_BOUNDS（適応策）/ HYDRO_BOUNDS（水文）から選ぶ
+- 設計行列をまとめてアンサンブル実行し、出力ごとに一次・総合感度指数を計算する
+- 評価結果は JSON Lines キャッシュに逐次追記するので、途中で止めても続きから再開できる
+"""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from model_params import BASE_PARAMS, PARAM_SPECS
+from pysd_ensemble import HYDRO_BOUNDS, EvaluationCache, run_ensemble_cached
+
+try:
+    from scipy.stats import qmc
+    SCIPY_AVAILABLE = True
+except Exception:
+    SCIPY_AVAILABLE = False
+
+
+# ---- 出力先 ----
+OUT_DIR = Path("out_sensitivity")
+
+# ---- 集計する出力（名前 → (モデル変数, 集計方法)）----
+SA_OUTPUTS = {
+    "river_discharge_downstream_peak": ("river_discharge_downstream", "max"),
+    "financial_damage_by_flood": ("financial_damage_by_flood", "sum"),
+    "financial_damage_by_innundation": ("financial_damage_by_innundation", "sum"),
+    "houses_damaged_by_inundation_peak": ("houses_damaged_by_inundation", "max"),
+}
+
+
+def bounds_from_param_specs(specs: Dict[str, dict] = PARAM_SPECS) -> Dict[str, Tuple[float, float]]:
+    """ PARAM_SPECS の min/max を探索範囲にする（幅 0 の項目は除外）"""
+    return {
+        name: (float(spec["min"]), float(spec["max"]))
+        for name, spec in specs.items()
+        if float(spec["max"]) > float(spec["min"])
+    }
+
+
+def get_bounds(source: str) -> Dict[str, Tuple[float, float]]:
+    if source == "param_specs":
+        return bounds_from_param_specs()
+    if source == "adaptation":
+        # 最適化スクリプトはモデル読込を遅延しているので import しても重くない
+        from run_vensim_with_pysd_to3_opt import ADAPTATION_BOUNDS
+        return dict(ADAPTATION_BOUNDS)
+    if source == "hydro":
+        return dict(HYDRO_BOUNDS)
+    raise ValueError(f"Unknown bounds source: {source}")
+
+
+def summarize_outputs(res: pd.DataFrame, outputs: Dict[str, Tuple[str, str]] = SA_OUTPUTS) -> Dict[str, float]:
+    """
+    日次出力を感度分析用のスカラー指標へ集計する（ワーカー側で実行）。
+    """
+    out = {}
+    for name, (col, how) in outputs.items():
+        s = pd.to_numeric(res[col], errors="coerce")
+        out[name] = float(s.max() if how == "max" else s.mean() if how == "mean" else s.sum())
+    return out
+
+
+def _scale(u: np.ndarray, bounds: Dict[str, Tuple[float, float]]) -> np.ndarray:
+    lo = np.array([b[0] for b in bounds.values()], dtype=float)
+    hi = np.array([b[1] for b in bounds.values()], dtype=float)
+    return lo + u * (hi - lo)
+
+
+def _evaluate(x: np.ndarray, bounds: Dict[str, Tuple[float, float]], cache: EvaluationCache,
+              workers: int | None) -> pd.DataFrame:
+    """ 設計行列 x（物理単位）をキャッシュ付きで評価し、行ごとの出力表を返す """
+    names = list(bounds.keys())
+    param_sets = [dict(zip(names, map(float, row))) for row in x]
+    res = run_ensemble_cached(
+        param_sets,
+        return_cols=sorted({col for col, _ in SA_OUTPUTS.values()}),
+        reducer=summarize_outputs,
+        cache=cache,
+        tag="sa",
+        base_params=BASE_PARAMS,
+        workers=workers,
+        errors="ignore",
+    )
+    return pd.DataFrame([r if r is not None else {k: np.nan for k in SA_OUTPUTS} for r in res])
+
+
+# =========================
+# Sobol（Saltelli 設計 + Jansen 推定量）
+# =========================
+def saltelli_design(d: int, n: int, seed: int = 42) -> np.ndarray:
+    """
+    正規化空間の Saltelli 設計を返す。行の並びは [A, B, AB_1, ..., AB_d]（各 n 行）。
+    scipy があればスクランブル Sobol 列、無ければ一様乱数で A, B を作る。
+    """
+    if SCIPY_AVAILABLE:
+        base = qmc.Sobol(d=2 * d, scramble=True, seed=seed).random(n)
+    else:
+        base = np.random.default_rng(seed).random((n, 2 * d))
+    a, b = base[:, :d], base[:, d:]
+    ab = np.repeat(a[None], d, axis=0)
+    idx = np.arange(d)
+    ab[idx, :, idx] = b[:, idx].T  # AB_i は A の i 列目だけ B に置換
+    return np.vstack([a, b, ab.reshape(d * n, d)])
+
+
+def sobol_indices(y: np.ndarray, d: int, n_boot: int = 200, seed: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Saltelli 設計の出力 y から一次指数 S1 と総合指数 ST（と 95% ブートストラップ幅）を計算する。
+    """
+    n = len(y) // (d + 2)
+    fa, fb = y[:n], y[n:2 * n]
+    fab = y[2 * n:].reshape(d, n)
+
+    def _est(idx):
+        # idx: (n_rep, n) の再標本インデックス
+        a, b, ab = fa[idx], fb[idx], fab[:, idx]           # ab: (d, n_rep, n)
+        var = np.var(np.concatenate([a, b], axis=-1), axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s1 = np.mean(b * (ab - a), axis=-1) / var
+            st = 0.5 * np.mean((a - ab) ** 2, axis=-1) / var
+        return s1, st                                       # (d, n_rep)
+
+    s1, st = _est(np.arange(n)[None])
+    rng = np.random.default_rng(seed)
+    s1_b, st_b = _est(rng.integers(0, n, size=(n_boot, n)))
+    return {
+        "S1": s1[:, 0], "S1_conf": 1.96 * np.nanstd(s1_b, axis=1),
+        "ST": st[:, 0], "ST_conf": 1.96 * np.nanstd(st_b, axis=1),
+    }
+
+
+def run_sobol(bounds: Dict[str, Tuple[float, float]], n: int, cache: EvaluationCache,
+              workers: int | None = None, seed: int = 42) -> pd.DataFrame:
+    d = len(bounds)
+    x = _scale(saltelli_design(d, n, seed), bounds)
+    print(f"Sobol: d={d}, N={n} -> {len(x)} runs")
+    y = _evaluate(x, bounds, cache, workers)
+    rows = []
+    for out in SA_OUTPUTS:
+        idx = sobol_indices(y[out].to_numpy(float), d)
+        for i, name in enumerate(bounds):
+            rows.append({"output": out, "parameter": name,
+                         **{k: float(v[i]) for k, v in idx.items()}})
+    return pd.DataFrame(rows)
+
+
+# =========================
+# Morris（初等効果スクリーニング）
+# =========================
+def morris_design(d: int, r: int, levels: int = 4, seed: int = 42) -> np.ndarray:
+    """
+    r 本の軌跡（各 d+1 点）を正規化空間で生成する。戻り値: (r*(d+1), d)
+    """
+    rng = np.random.default_rng(seed)
+    delta = levels / (2.0 * (levels - 1))
+    grid = np.arange(levels // 2) / (levels - 1)            # x* + delta が 1 を超えない格子
+    b = np.tril(np.ones((d + 1, d)), -1)                    # 下三角（1 次元ずつ動かす）
+    traj = []
+    for _ in range(r):
+        x0 = rng.choice(grid, size=d)
+        signs = rng.choice([-1.0, 1.0], size=d)
+        perm = rng.permutation(d)
+        steps = (2.0 * b - 1.0) * signs + 1.0               # 0 or 2（符号付き移動）
+        pts = x0 + (delta / 2.0) * steps
+        traj.append(pts[:, perm])
+    return np.vstack(traj)
+
+
+def morris_indices(u: np.ndarray, y: np.ndarray, d: int) -> Dict[str, np.ndarray]:
+    """ 軌跡上の隣接点差から初等効果を求め、mu, mu*, sigma を返す """
+    u = u.reshape(-1, d + 1, d)
+    y = y.reshape(-1, d + 1)
+    du = np.diff(u, axis=1)                                  # (r, d, d) 各ステップで 1 次元だけ非ゼロ
+    dy = np.diff(y, axis=1)                                  # (r, d)
+    moved = np.argmax(np.abs(du), axis=2)                    # (r, d)
+    step = np.take_along_axis(du, moved[..., None], axis=2)[..., 0]
+    ee = np.full((u.shape[0], d), np.nan)
+    np.put_along_axis(ee, moved, dy / step, axis=1)
+    return {
+        "mu": np.nanmean(ee, axis=0),
+        "mu_star": np.nanmean(np.abs(ee), axis=0),
+        "sigma": np.nanstd(ee, axis=0, ddof=1),
+    }
+
+
+def run_morris(bounds: Dict[str, Tuple[float, float]], r: int, cache: EvaluationCache,
+               workers: int | None = None, seed: int = 42) -> pd.DataFrame:
+    d = len(bounds)
+    u = morris_design(d, r, seed=seed)
+    print(f"Morris: d={d}, r={r} -> {len(u)} runs")
+    y = _evaluate(_scale(u, bounds), bounds, cache, workers)
+    rows = []
+    for out in SA_OUTPUTS:
+        idx = morris_indices(u, y[out].to_numpy(float), d)
+        for i, name in enumerate(bounds):
+            rows.append({"output": out, "parameter": name,
+                         **{k: float(v[i]) for k, v in idx.items()}})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sobol / Morris による大域的感度分析")
+    parser.add_argument("method", choices=["sobol", "morris"])
+    parser.add_argument("--bounds", choices=["param_specs", "adaptation", "hydro"], default="param_specs",
+                        help="探索範囲の取得元（既定 param_specs）")
+    parser.add_argument("-n", type=int, default=256, help="Sobol の基本標本数 N / Morris の軌跡数 r")
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    bounds = get_bounds(args.bounds)
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    cache = EvaluationCache(OUT_DIR / f"cache_{args.bounds}.jsonl")
+
+    if args.method == "sobol":
+        df = run_sobol(bounds, args.n, cache, args.workers, args.seed)
+    else:
+        df = run_morris(bounds, args.n, cache, args.workers, args.seed)
+
+    out = OUT_DIR / f"{args.method}_{args.bounds}_n{args.n}.csv"
+    df.to_csv(out, index=False, encoding="utf-8")
+    print(f"  -> {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+# sim_service.py
+# -*- coding: utf-8 -*-
+"""
+PySD モデルのシミュレーションサービス（Streamlit を使わずプログラムから呼ぶ用の HTTP サーバー）。
+
+エンドポイント（本体はすべて JSON）
+- POST /run       {"params", "return_cols", "n_days" | "timestamps", "forcing"}       → 1 回分の結果
+- POST /ensemble  {"param_sets", "base_params", "return_cols", "n_days" | "timestamps"} → 終わったメンバーから順に返す
+- POST /optimize  {"x0", "method", "maxiter"}                                          → fd_gradient.polish の結果（JSON）
+- GET  /health                                                                         → 状態と統計
+
+- forcing は {キー: 日ごとの値のリスト}。キーは input.xlsx の列名（precipitation, temperature, tasmax,
+  tasmin, rsds）か、対応する PySD の構成要素名（daily_precip, daily_ave_temp, daily_max_temp,
+  daily_min_temp, solar_radiation_time）。どちらも 0, 1, 2, ... 日の時系列として params に入る
+
+- 結果は Arrow IPC ストリーム（chunked 転送）。"format": "json" なら JSON（records）
+- 本体の不備（不明な forcing のキー、数値にできない n_days など）は 400、
+  最初の結果の前に実行が失敗したら 500（どちらも JSON で理由）。送信途中で失敗したら終端を書かずに接続を切る
+  （SimClient は途中で切れたストリームを例外にする。一部のメンバーが欠けた結果を正常扱いしない）
+- 同時に来た /run は BATCH_WINDOW_MS だけ待ってまとめ、同じ条件のものは 1 回だけ実行して
+  1 回の run_ensemble としてウォームワーカー（pysd_ensemble のプール）へ流す
+  （PySD は各コンポーネントがスカラー計算なので、「まとめて 1 ステップ」はワーカー間の一括分配になる）
+- LocalService: ループバックでサーバーを立て、SimClient を返す（テスト・ベンチマーク用）
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Any, Dict, List, Sequence, Tuple
+
+import pandas as pd
+
+from pysd_ensemble import (
+    DEFAULT_TIMESTAMPS,
+    DEFAULT_WORKERS,
+    FORCING_COMPONENTS,
+    MODEL_MDL,
+    MODEL_PY,
+    forcing_params,
+    get_pool,
+    hash_params,
+    run_ensemble,
+    submit_ensemble,
+)
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+BATCH_WINDOW_MS = 20          # /run をまとめるために待つ時間
+MAX_BATCH = 64                # 1 回の run_ensemble に入れる最大件数
+BATCH_THREADS = 2             # 同時に流すバッチ数（集めている間も前のバッチを実行できるように）
+ARROW_MIME = "application/vnd.apache.arrow.stream"
+DEFAULT_RETURN_COLS = ["river_discharge_downstream"]
+
+
+# =========================
+# リクエストの解釈
+# =========================
+class BadRequest(ValueError):
+    """ リクエスト本体の不備（400 で返す）"""
+
+
+@contextlib.contextmanager
+def _bad_request():
+    """ 本体の解釈中の KeyError / TypeError / ValueError を BadRequest にする """
+    try:
+        yield
+    except BadRequest:
+        raise
+    except (KeyError, TypeError, ValueError) as e:
+        raise BadRequest(str(e)) from e
+
+
+def _timestamps(body: Dict[str, Any]) -> List[float]:
+    if body.get("timestamps") is not None:
+        return [float(t) for t in body["timestamps"]]
+    if body.get("n_days") is not None:
+        return list(range(int(body["n_days"])))
+    return list(DEFAULT_TIMESTAMPS)
+
+
+def _params(body: Dict[str, Any], key: str = "params") -> Dict[str, Any]:
+    """
+    params に forcing（日ごとの値のリスト）を時系列として足す。
+    キーは input.xlsx の列名（precipitation など、forcing_params で変換）か PySD の構成要素名（daily_precip など）。
+    """
+    params = dict(body.get(key) or {})
+    forcing = dict(body.get("forcing") or {})
+    unknown = [k for k in forcing if k not in FORCING_COMPONENTS and k not in FORCING_COMPONENTS.values()]
+    if unknown:
+        raise ValueError(f"forcing のキーが不明です: {unknown}（列名 {list(FORCING_COMPONENTS)} "
+                         f"または構成要素名 {list(FORCING_COMPONENTS.values())}）")
+    table = {k: v for k, v in forcing.items() if k in FORCING_COMPONENTS}
+    if table:
+        params.update(forcing_params(pd.DataFrame(table)))
+    for comp, values in forcing.items():
+        if comp not in FORCING_COMPONENTS:
+            params[comp] = pd.Series([float(v) for v in values], index=range(len(values)), dtype=float)
+    return params
+
+
+def _frame(res: pd.DataFrame, **labels: Any) -> pd.DataFrame:
+    out = res.reset_index().rename(columns={res.index.name or "index": "time"})
+    for k, v in labels.items():
+        out.insert(0, k, v)
+    return out
+
+
+# =========================
+# /run のマイクロバッチ
+# =========================
+class MicroBatcher:
+    """
+    submit した 1 回分の実行を短時間ためてまとめ、(取得列, 時刻) が同じものを 1 回の run_ensemble で実行する。
+    まったく同じ条件の要求は 1 回だけ実行して結果を共有する。
+    """
+
+    def __init__(
+        self,
+        window_ms: float = BATCH_WINDOW_MS,
+        max_batch: int = MAX_BATCH,
+        workers: int | None = None,
+        model_py: Path | str | None = MODEL_PY,
+        model_mdl: Path | str | None = MODEL_MDL,
+    ):
+        self.window = window_ms / 1000.0
+        self.max_batch = int(max_batch)
+        self.workers = int(workers or DEFAULT_WORKERS)
+        self.model_py, self.model_mdl = model_py, model_mdl
+        self._queue: "Queue[Tuple[Dict[str, Any], List[str], List[float], Future]]" = Queue()
+        self._runner = ThreadPoolExecutor(max_workers=BATCH_THREADS, thread_name_prefix="batch")
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "batches": 0, "runs": 0, "deduplicated": 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, params: Dict[str, Any], return_cols: Sequence[str], timestamps: Sequence[float]) -> Future:
+        fut: Future = Future()
+        self._queue.put((params, list(return_cols), list(timestamps), fut))
+        return fut
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except Empty:
+                continue
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            groups: Dict[Tuple, List] = {}
+            for item in batch:
+                _, cols, ts, _ = item
+                groups.setdefault((tuple(cols), ts[0] if ts else 0, ts[-1] if ts else 0, len(ts)), []).append(item)
+            for items in groups.values():
+                self._runner.submit(self._run_group, items)
+
+    def _run_group(self, items: List) -> None:
+        # 同じ条件の要求は 1 回だけ実行する
+        unique: Dict[str, Dict[str, Any]] = {}
+        waiting: Dict[str, List[Future]] = {}
+        for params, _, _, fut in items:
+            key = hash_params(params)
+            unique.setdefault(key, params)
+            waiting.setdefault(key, []).append(fut)
+        _, cols, ts, _ = items[0]
+        with self._lock:
+            self.stats["requests"] += len(items)
+            self.stats["batches"] += 1
+            self.stats["runs"] += len(unique)
+            self.stats["deduplicated"] += len(items) - len(unique)
+        try:
+            results = run_ensemble(list(unique.values()), cols, ts, workers=self.workers,
+                                   model_py=self.model_py, model_mdl=self.model_mdl, errors="ignore")
+        except Exception as e:
+            for futs in waiting.values():
+                for fut in futs:
+                    fut.set_exception(e)
+            return
+        for key, res in zip(unique, results):
+            for fut in waiting[key]:
+                if res is None:
+                    fut.set_exception(RuntimeError("シミュレーションに失敗しました（パラメータ名・値を確認してください）"))
+                else:
+                    fut.set_result(res)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=2)
+        self._runner.shutdown(wait=False, cancel_futures=True)
+
+
+# =========================
+# HTTP サーバー
+# =========================
+class _ChunkedWriter:
+    """ HTTP/1.1 の chunked 転送で書き出すファイル風オブジェクト（Arrow の IPC ストリーム用）"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        if data and not self.closed:
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        self.wfile.flush()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            self.closed = True
+
+    def abort(self) -> None:
+        """ 終端チャンクを書かずに以後の書き込みを捨てる（受け手は途中で切れたとわかる）"""
+        self.closed = True
+
+
+class SimService(ThreadingHTTPServer):
+    """ モデルを読み込んだワーカープールと MicroBatcher を持つサーバー """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], workers: int | None = None,
+                 model_py: Path | str | None = MODEL_PY, model_mdl: Path | str | None = MODEL_MDL,
+                 window_ms: float = BATCH_WINDOW_MS):
+        super().__init__(address, _Handler)
+        self.workers = int(workers or DEFAULT_WORKERS)
+        self.model_py, self.model_mdl = model_py, model_mdl
+        self.batcher = MicroBatcher(window_ms, MAX_BATCH, self.workers, model_py, model_mdl)
+        self.optimize_lock = threading.Lock()
+        self.started = time.time()
+        if self.workers > 1:
+            get_pool(self.workers, model_py, model_mdl)     # 起動時にワーカーへモデルを読み込ませる
+
+    def server_close(self) -> None:
+        self.batcher.close()
+        super().server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: SimService
+    _streaming = False
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        pass  # アクセスログは出さない
+
+    # ---- 入出力 ----
+    def _body(self) -> Dict[str, Any]:
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n) or b"{}")
+
+    def _send_json(self, obj: Any, status: int = 200) -> None:
+        data = json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_frames(self, frames, fmt: str) -> None:
+        """ DataFrame を順に返す（Arrow はできたものから chunked で送る）"""
+        if fmt == "json":
+            parts = list(frames)
+            df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+            self._send_json(json.loads(df.to_json(orient="records")))
+            return
+        import pyarrow as pa
+
+        # 最初の結果はヘッダーの前に待つ（ここで失敗すれば 500 で理由を返せる）
+        frames = iter(frames)
+        first = next(frames, None)
+        self.send_response(200)
+        self.send_header("Content-Type", ARROW_MIME)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._streaming = True
+        out = _ChunkedWriter(self.wfile)
+        writer, schema = None, None
+        try:
+            for df in itertools.chain([] if first is None else [first], frames):
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_stream(out, schema)
+                writer.write_table(table.cast(schema))
+        except BaseException:
+            # EOS も終端チャンクも書かない（正常に終わったストリームに見せない）
+            out.abort()
+            raise
+        if writer is not None:
+            writer.close()
+        out.close()
+
+    # ---- ルーティング ----
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/health":
+            self._send_json({"status": "ok", "workers": self.server.workers,
+                             "uptime_sec": time.time() - self.server.started, **self.server.batcher.stats})
+        else:
+            self._send_json({"error": f"not found: {self.path}"}, 404)
+
+    def do_POST(self) -> None:
+        route = {"/run": self._run, "/ensemble": self._ensemble, "/optimize": self._optimize}.get(self.path.rstrip("/"))
+        if route is None:
+            self._send_json({"error": f"not found: {self.path}"}, 404)
+            return
+        try:
+            body = self._body()
+        except ValueError as e:
+            self._send_json({"error": f"JSON を読めません: {e}"}, 400)
+            return
+        try:
+            route(body)
+        except BadRequest as e:
+            self._send_json({"error": str(e)}, 400)
+        except Exception as e:
+            if self._streaming:
+                self.close_connection = True    # 送信途中のストリームは切って終わる
+            else:
+                self._send_json({"error": repr(e)}, 500)
+
+    def _run(self, body: Dict[str, Any]) -> None:
+        with _bad_request():
+            cols = list(body.get("return_cols") or DEFAULT_RETURN_COLS)
+            params, timestamps = _params(body), _timestamps(body)
+        res = self.server.batcher.submit(params, cols, timestamps).result()
+        self._send_frames([_frame(res)], body.get("format", "arrow"))
+
+    def _ensemble(self, body: Dict[str, Any]) -> None:
+        with _bad_request():
+            cols = list(body.get("return_cols") or DEFAULT_RETURN_COLS)
+            base = _params(body, "base_params")
+            param_sets = [dict(p) for p in body.get("param_sets") or []]
+            timestamps = _timestamps(body)
+        futs = submit_ensemble(param_sets, cols, timestamps, base_params=base,
+                               workers=self.server.workers,
+                               model_py=self.server.model_py, model_mdl=self.server.model_mdl)
+        members = {fut: i for i, fut in enumerate(futs)}
+
+        def frames():
+            for fut in as_completed(futs):
+                yield _frame(fut.result(), member=members[fut])
+
+        self._send_frames(frames(), body.get("format", "arrow"))
+
+    def _optimize(self, body: Dict[str, Any]) -> None:
+        import numpy as np
+        from fd_gradient import polish
+        from pysd_ensemble import HYDRO_BOUNDS
+
+        with _bad_request():
+            x0 = body.get("x0") or {}
+            x = np.array([float(x0.get(k, 0.5 * (lo + hi))) for k, (lo, hi) in HYDRO_BOUNDS.items()])
+            maxiter = int(body.get("maxiter", 50))
+        with self.server.optimize_lock:      # 最適化はワーカーを使い切るので 1 件ずつ
+            res = polish(x, method=body.get("method", "forward"), maxiter=maxiter,
+                         workers=self.server.workers)
+        self._send_json({"payoff": -float(res.fun), "nit": int(res.nit), "success": bool(res.success),
+                         "message": str(res.message), "x": dict(zip(HYDRO_BOUNDS, map(float, res.x)))})
+
+
+# =========================
+# クライアント
+# =========================
+class SimClient:
+    """ SimService のクライアント（urllib のみ。Arrow の結果は pyarrow で DataFrame に戻す）"""
+
+    def __init__(self, base_url: str = f"http://{HOST}:{PORT}", timeout: float = 3600.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _post(self, path: str, body: Dict[str, Any]):
+        req = urllib.request.Request(
+            self.base_url + path, data=json.dumps(body, default=_json_default).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST",
+        )
+        try:
+            return urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                detail = json.loads(e.read()).get("error", "")
+            except ValueError:
+                detail = ""
+            raise RuntimeError(f"{path} が失敗しました（HTTP {e.code}）: {detail}") from e
+
+    def _frames(self, path: str, body: Dict[str, Any]) -> pd.DataFrame:
+        with self._post(path, body) as resp:
+            try:
+                data = resp.read()
+            except http.client.IncompleteRead as e:
+                raise RuntimeError(f"{path} の結果が途中で切れました（サーバー側で実行に失敗）") from e
+            if resp.headers.get_content_type() != ARROW_MIME:
+                return pd.DataFrame(json.loads(data))
+            if not data:
+                return pd.DataFrame()
+            import pyarrow as pa
+            return pa.ipc.open_stream(pa.BufferReader(data)).read_all().to_pandas()
+
+    def run(self, params: Dict[str, Any] | None = None, return_cols: Sequence[str] | None = None,
+            n_days: int | None = None, forcing: Dict[str, Sequence[float]] | None = None,
+            fmt: str = "arrow") -> pd.DataFrame:
+        """ forcing のキーは input.xlsx の列名（precipitation など）か PySD の構成要素名（daily_precip など）"""
+        return self._frames("/run", {"params": params or {}, "return_cols": list(return_cols or DEFAULT_RETURN_COLS),
+                                     "n_days": n_days, "forcing": forcing, "format": fmt})
+
+    def ensemble(self, param_sets: Sequence[Dict[str, Any]], return_cols: Sequence[str] | None = None,
+                 base_params: Dict[str, Any] | None = None, n_days: int | None = None,
+                 fmt: str = "arrow") -> pd.DataFrame:
+        """ 結果はメンバーの終わった順に並ぶ（member 列で元の順番がわかる）"""
+        return self._frames("/ensemble", {"param_sets": list(param_sets), "base_params": base_params or {},
+                                          "return_cols": list(return_cols or DEFAULT_RETURN_COLS),
+                                          "n_days": n_days, "format": fmt})
+
+    def optimize(self, x0: Dict[str, float] | None = None, method: str = "forward", maxiter: int = 50) -> Dict[str, Any]:
+        with self._post("/optimize", {"x0": x0 or {}, "method": method, "maxiter": maxiter}) as resp:
+            return json.loads(resp.read())
+
+    def health(self) -> Dict[str, Any]:
+        with urllib.request.urlopen(self.base_url + "/health", timeout=self.timeout) as resp:
+            return json.loads(resp.read())
+
+
+def _json_default(obj: Any) -> Any:
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"JSON にできない値です: {type(obj)}")
+
+
+class LocalService:
+    """
+    ループバック（空きポート）でサーバーを別スレッドに立てる。with で SimClient を受け取る。
+        with LocalService(workers=4) as client:
+            df = client.run({"levee_investment_amount": 1e9})
+    """
+
+    def __init__(self, workers: int | None = None, model_py: Path | str | None = MODEL_PY,
+                 model_mdl: Path | str | None = MODEL_MDL, window_ms: float = BATCH_WINDOW_MS):
+        self.server = SimService((HOST, 0), workers, model_py, model_mdl, window_ms)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> SimClient:
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        return SimClient(f"http://{host}:{port}")
+
+    def __exit__(self, *exc: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# =========================
+# CLI
+# =========================
+def bench(client: SimClient, n_clients: int, n_requests: int, n_days: int | None) -> Dict[str, float]:
+    """ n_clients スレッドから合計 n_requests 件の /run を同時に投げてスループットを測る """
+    def one(i: int) -> int:
+        return len(client.run({"daily_precipitation_future_ratio": 1.0 + 0.01 * (i % 16)}, n_days=n_days))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as ex:
+        rows = sum(ex.map(one, range(n_requests)))
+    sec = time.perf_counter() - t0
+    return {"requests": n_requests, "seconds": sec, "requests_per_sec": n_requests / sec, "rows": rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PySD シミュレーションの HTTP サービス（/run /ensemble /optimize）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("serve", help="サーバーを起動")
+    p.add_argument("--host", default=HOST)
+    p.add_argument("--port", type=int, default=PORT)
+    p.add_argument("--workers", type=int, default=None, help="ワーカー数（既定はコア数）")
+    p.add_argument("--window-ms", type=float, default=BATCH_WINDOW_MS, help="/run をまとめる待ち時間")
+    p = sub.add_parser("bench", help="ループバックのサーバーに同時に /run を投げてスループットを測る")
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--n-days", type=int, default=None)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--url", default=None, help="起動済みサーバーの URL（省略時はループバックで起動）")
+    args = parser.parse_args()
+
+    if args.cmd == "serve":
+        server = SimService((args.host, args.port), args.workers, window_ms=args.window_ms)
+        print(f"Serving on http://{args.host}:{args.port} (workers={server.workers})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    if args.url:
+        stats = bench(SimClient(args.url), args.clients, args.requests, args.n_days)
+    else:
+        with LocalService(args.workers) as client:
+            stats = bench(client, args.clients, args.requests, args.n_days)
+            stats.update({k: v for k, v in client.health().items() if k in ("batches", "runs", "deduplicated")})
+    for k, v in stats.items():
+        print(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,19 @@ from dateutil.relativedelta import relativedelta
 import urllib.request
 from bs4 import BeautifulSoup
 import time
+import sys
+from pathlib import Path
+
+# 月ページはリポジトリ直下の .http_cache/ に保存する（確定した月は再取得しない、当月は条件付きGET）。
+# 既存の data/<地点コード>_<地点>.csv で値がそろっていて確定済みの月は取得しない
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+try:
+    from http_cache import HttpCache, is_provisional, settle_date, urllib_fetch
+except ImportError:
+    HttpCache = None
+    print("[WARN] http_cache を読み込めません。キャッシュなしで全月を取得します。", file=sys.stderr)
 
 obs_stations = pd.read_excel("data/obs_stations.xlsx")
 obs_stations = obs_stations.query('ed_y == 9999')
@@ -23,14 +36,40 @@ while date < end_date:
     Temp_data.loc[date] = -100.0
     date += relativedelta(days=1)
 
+def fetch_month_page(cache, url, station_code, month_start):
+    """ 月ページの HTML と、キャッシュから返したか（通信していないか）"""
+    if cache is None:
+        return urllib.request.urlopen(url).read(), False
+    res = cache.get(url, ("jma_daily", "%04d" % station_code, month_start.strftime("%Y-%m")), urllib_fetch(),
+                    settled_after=settle_date(month_start + relativedelta(months=1) - relativedelta(days=1)),
+                    accept=lambda b: b"data2_s" in b)
+    return res.body, res.from_cache
+
+def month_is_settled(table, month_start):
+    """ 既存の表でこの月の値がそろっていて（-100 が無い）、暫定期間も過ぎているか """
+    if HttpCache is None:
+        return False
+    month_end = min(month_start + relativedelta(months=1), end_date) - relativedelta(days=1)
+    days = [d for d in table.index if month_start <= d <= month_end]
+    if len(days) < (month_end - month_start).days + 1:
+        return False
+    return bool((table.loc[days].astype(float) != -100.0).all().all()) and not is_provisional(month_end)
+
 def str2float(weather_data):
     try:
         return float(weather_data)
     except:
         return -100
 
+cache = HttpCache(REPO_ROOT / ".http_cache") if HttpCache is not None else None
+
 for i in obs_stations.index:
     Temp_data_s = Temp_data.copy()
+    out_csv = "data/%d_%s.csv"%(obs_stations['地点コード'].loc[i],obs_stations['地点'].loc[i])
+    if Path(out_csv).exists():
+        prev = pd.read_csv(out_csv, index_col=0, parse_dates=True)
+        prev.index = prev.index.date
+        Temp_data_s.update(prev[[c for c in Temp_data_s.columns if c in prev.columns]])
 
     url_y = "https://www.data.jma.go.jp/obd/stats/etrn/view/annually_%s.php?" \
             "prec_no=%d&block_no=%04d&year=&month=&day=&view=" \
@@ -49,11 +88,14 @@ for i in obs_stations.index:
     date = start_date
     # date = datetime.date(max(int(tds[0].string),1872), 1, 1)
     while date < end_date:
+        if month_is_settled(Temp_data_s, date):
+            date += relativedelta(months=1)
+            continue
         url_m = "https://www.data.jma.go.jp/obd/stats/etrn/view/daily_%s1.php?" \
                 "prec_no=%s&block_no=%04d&year=%d&month=%d&day=&view=" \
                     %(str.lower(obs_stations['区分'].loc[i]), obs_stations['府県番号'].loc[i], obs_stations['地点コード'].loc[i], date.year, date.month)
 
-        html = urllib.request.urlopen(url_m).read()
+        html, from_cache = fetch_month_page(cache, url_m, obs_stations['地点コード'].loc[i], date)
         soup = BeautifulSoup(html)
         trs = soup.find("table", { "class" : "data2_s" })
 
@@ -97,7 +139,8 @@ for i in obs_stations.index:
 
         date += relativedelta(months=1)
 
-        time.sleep(3)
+        if not from_cache:
+            time.sleep(3)
 
-    Temp_data_s.to_csv("data/%d_%s.csv"%(obs_stations['地点コード'].loc[i],obs_stations['地点'].loc[i]))
+    Temp_data_s.to_csv(out_csv)
 
@@ -2,7 +2,6 @@ import numpy as np
 import pandas as pd
 
 # 設定
-np.random.seed(42)
 start_year = 2000
 end_year = 2100
 dates = pd.date_range(start=f"{start_year}-01-01", end=f"{end_year}-12-31")
@@ -19,33 +18,24 @@ gamma_scale = {1: 1, 2: 1.5, 3: 2, 4: 2.5, 5: 3, 6: 3.5,
                7: 3, 8: 2.5, 9: 2, 10: 1.5, 11: 1, 12: 1.2}
 
 # 月情報
-months = dates.month
-years = dates.year
+months = dates.month.to_numpy()
+years = dates.year.to_numpy()
 
-# データ生成
-rain_data = []
-for date in dates:
-    month = date.month
-    year = date.year
+# 気候変動の影響を反映（全日分をまとめて計算）
+climate_change_factor = (years - start_year) / (end_year - start_year)  # 0 (2000) → 1 (2100)
 
-    # 気候変動の影響を反映
-    climate_change_factor = (year - start_year) / (end_year - start_year)  # 0 (2000) → 1 (2100)
+# 降水確率の増加
+adjusted_rain_prob = np.vectorize(rain_prob.get)(months) + 0.2 * climate_change_factor  # 最大+20%
 
-    # 降水確率の増加
-    adjusted_rain_prob = rain_prob[month] + 0.2 * climate_change_factor  # 最大+20%
+# ガンマ分布パラメータの調整（極端な雨の発生）
+adjusted_shape = np.vectorize(gamma_shape.get)(months) * (1 - 0.5 * climate_change_factor)  # 形状パラメータを減少させる
+adjusted_scale = np.vectorize(gamma_scale.get)(months) * (1 + 1.0 * climate_change_factor)  # 尺度パラメータを増加させる
 
-    # ガンマ分布パラメータの調整（極端な雨の発生）
-    adjusted_shape = gamma_shape[month] * (1 - 0.5 * climate_change_factor)  # 形状パラメータを減少させる
-    adjusted_scale = gamma_scale[month] * (1 + 1.0 * climate_change_factor)  # 尺度パラメータを増加させる
-
-    # 降水の有無を判定
-    if np.random.rand() < adjusted_rain_prob:
-        # ガンマ分布から降水量を生成
-        rain_amount = round(np.random.gamma(adjusted_shape, adjusted_scale),1)
-    else:
-        rain_amount = 0
-
-    rain_data.append(rain_amount)
+# データ生成（降水の有無を判定し、ガンマ分布から降水量を生成）
+# 月別マルコフ連鎖・観測からの較正・多数実現の生成は weather_generator.py を使う
+rng = np.random.default_rng(42)
+is_rain = rng.random(days) < adjusted_rain_prob
+rain_data = np.where(is_rain, np.round(rng.gamma(adjusted_shape, adjusted_scale), 1), 0)
 
 # DataFrameに変換
 df = pd.DataFrame({'Date': dates, 'Rainfall': rain_data})
@@ -0,0 +1,289 @@
+# vensim_artifacts.py
+# -*- coding: utf-8 -*-
+"""
+Vensim の最適化・感度分析の成果物（.cin / .out / .voc / .rep / _startpoint.dat / _endpoint.dat）を読み、
+PySD のスネークケース名のパラメータセットに変換する。
+
+- 表示名（"Current high-water discharge" など）は PySD と同じ規則で識別子化し、
+  モデルを渡した場合は model.namespace で照合して存在しない変数を落とす
+- 複数ファイルを 1 回のアンサンブル実行でまとめて流せる
+- 較正済みの点を MCMC や局所最適化の初期集団に使える
+"""
+from __future__ import annotations
+
+import argparse
+import re
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# ---- 既定の成果物（筑後川・流量キャリブレーション）----
+ARTIFACT_PREFIX = "chikugo_run_opt_flow_obs_NormHighTopflowSq_BF_100_heat26"
+
+# モデル制御変数（パラメータ上書きではなく run の設定なので分けて扱う）
+CONTROL_NAMES = {"initial_time", "final_time", "time_step", "saveper"}
+
+_NUM = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_BOUND_LINE = re.compile(
+    rf"^\s*(?P<lo>{_NUM})\s*<=\s*(?P<name>.+?)\s*=\s*(?P<val>{_NUM})\s*<=\s*(?P<hi>{_NUM})\s*$"
+)
+_ASSIGN_LINE = re.compile(rf"^\s*(?P<name>[^=#:]+?)\s*=\s*(?P<val>{_NUM})\s*$")
+
+
+def to_python_name(name: str) -> str:
+    """
+    Vensim の表示名を PySD の識別子に変換する（PySD の make_python_identifier と同じ規則）。
+    例: '"Current high-water discharge"' -> 'current_highwater_discharge'
+    """
+    s = unicodedata.normalize("NFKC", name).strip().strip('"').lower()
+    s = re.sub(r"[\s_]+", "_", s)
+    s = re.sub(r"[^\w]", "", s)
+    s = s.strip("_")
+    if s and s[0].isdigit():
+        s = "_" + s
+    return s
+
+
+def model_name_map(model) -> Dict[str, str]:
+    """ model.namespace（表示名 → 識別子）を照合しやすいキーで引けるようにする """
+    return {to_python_name(k): v for k, v in model.namespace.items()}
+
+
+def map_names(values: Dict[str, float], name_map: Dict[str, str] | None = None) -> Dict[str, float]:
+    """
+    表示名キーの辞書をスネークケースに変換する。name_map があればモデルに存在する変数だけ残す。
+    """
+    out = {}
+    for name, v in values.items():
+        key = to_python_name(name)
+        if name_map is not None:
+            if key not in name_map:
+                continue
+            key = name_map[key]
+        out[key] = v
+    return out
+
+
+# =========================
+# 各形式のパーサ
+# =========================
+def read_cin(path: Path) -> Dict[str, float]:
+    """
+    .cin（'Name = value' 行）を読む。ルックアップ定義（#名前#( ... )）は読み飛ばす。
+    """
+    values: Dict[str, float] = {}
+    in_lookup = False
+    for line in Path(path).read_text(encoding="utf-8", errors="replace").splitlines():
+        s = line.strip()
+        if not s:
+            continue
+        if s.startswith("#"):
+            in_lookup = not s.endswith(")")
+            continue
+        if in_lookup:
+            in_lookup = not s.endswith(")")
+            continue
+        m = _ASSIGN_LINE.match(s)
+        if m:
+            values[m.group("name")] = float(m.group("val"))
+    return values
+
+
+def read_out(path: Path) -> Tuple[Dict[str, float], Dict[str, Tuple[float, float]]]:
+    """
+    最適化結果 .out（'lo <= Name = value <= hi' 行）を読み、(最適値, 探索範囲) を返す。
+    """
+    values: Dict[str, float] = {}
+    bounds: Dict[str, Tuple[float, float]] = {}
+    for line in Path(path).read_text(encoding="utf-8", errors="replace").splitlines():
+        m = _BOUND_LINE.match(line)
+        if m:
+            name = m.group("name")
+            values[name] = float(m.group("val"))
+            bounds[name] = (float(m.group("lo")), float(m.group("hi")))
+    return values, bounds
+
+
+def read_voc(path: Path) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, Tuple[float, float]]]:
+    """
+    最適化設定 .voc を読み、(':KEY=value' 設定, 開始値, 探索範囲) を返す。
+    '&' で始まる行は Vensim 上で無効化されたパラメータなので除外する。
+    """
+    settings: Dict[str, float] = {}
+    values: Dict[str, float] = {}
+    bounds: Dict[str, Tuple[float, float]] = {}
+    for line in Path(path).read_text(encoding="utf-8", errors="replace").splitlines():
+        s = line.strip()
+        if s.startswith(":") and "=" in s:
+            key, val = s[1:].split("=", 1)
+            try:
+                settings[key] = float(val)
+            except ValueError:
+                pass
+            continue
+        if s.startswith("&"):
+            continue
+        m = _BOUND_LINE.match(s)
+        if m:
+            name = m.group("name")
+            values[name] = float(m.group("val"))
+            bounds[name] = (float(m.group("lo")), float(m.group("hi")))
+    return settings, values, bounds
+
+
+def read_dat(path: Path) -> Dict[str, float]:
+    """
+    _startpoint.dat / _endpoint.dat（変数名の行 + 'time value' 行）を読み、各変数の最終値を返す。
+    """
+    values: Dict[str, float] = {}
+    name = None
+    for line in Path(path).read_text(encoding="utf-8", errors="replace").splitlines():
+        s = line.strip()
+        if not s:
+            continue
+        parts = s.split()
+        if len(parts) == 2 and all(re.fullmatch(_NUM, p) for p in parts):
+            if name is not None:
+                values[name] = float(parts[1])
+        else:
+            name = s
+    return values
+
+
+def read_rep(path: Path) -> Dict[str, Any]:
+    """
+    ペイオフレポート .rep を読み、総ペイオフと構成要素（DataFrame）を返す。
+    """
+    lines = Path(path).read_text(encoding="utf-8", errors="replace").splitlines()
+    total = np.nan
+    rows = []
+    header = None
+    for line in lines:
+        parts = line.split("\t")
+        if line.startswith("The total payoff is"):
+            total = float(parts[-1])
+        elif parts[0] == "Type" and "Component" in parts:
+            header = parts
+        elif header is not None and len(parts) >= 3 and parts[0].startswith("*"):
+            rows.append(dict(zip(header, parts)))
+        elif header is not None and not line.strip():
+            header = None
+    comps = pd.DataFrame(rows)
+    for c in ("Contribution", "Percent", "Values"):
+        if c in comps.columns:
+            comps[c] = pd.to_numeric(comps[c], errors="coerce")
+    return {"total_payoff": total, "components": comps}
+
+
+def read_artifact(path: Path | str) -> Dict[str, float]:
+    """
+    拡張子から形式を判定して、表示名キーのパラメータ辞書を返す。
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".cin":
+        return read_cin(path)
+    if suffix == ".out":
+        return read_out(path)[0]
+    if suffix == ".voc":
+        return read_voc(path)[1]
+    if suffix == ".dat":
+        return read_dat(path)
+    raise ValueError(f"未対応の成果物です: {path}")
+
+
+def discover_artifacts(prefix: str = ARTIFACT_PREFIX, root: Path = Path(".")) -> List[Path]:
+    """
+    同じ実行名の成果物（.out, _startpoint.dat, _endpoint.dat, _fp_err_N.cin）を列挙する。
+    """
+    found = [root / f"{prefix}.out", root / f"{prefix}_startpoint.dat", root / f"{prefix}_endpoint.dat"]
+    found = [p for p in found if p.exists()]
+    cins = sorted(root.glob(f"{prefix}*.cin"), key=lambda p: [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", p.name)])
+    return found + cins
+
+
+def load_param_sets(
+    paths: Sequence[Path | str],
+    model=None,
+    include_control: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    """
+    成果物群をスネークケースのパラメータセット（ラベル → 辞書）に変換する。
+    model を渡すとモデルに存在しない変数を除外する。
+    """
+    name_map = model_name_map(model) if model is not None else None
+    out = {}
+    for p in paths:
+        params = map_names(read_artifact(p), name_map)
+        if not include_control:
+            params = {k: v for k, v in params.items() if k not in CONTROL_NAMES}
+        out[Path(p).name] = params
+    return out
+
+
+def load_calibrated_params(path: Path | str, model=None) -> Dict[str, float]:
+    """ 1 つの成果物から較正済みパラメータを読む（.out の最適値など）"""
+    return next(iter(load_param_sets([path], model).values()))
+
+
+def initial_population(
+    paths: Sequence[Path | str],
+    bounds: Dict[str, Tuple[float, float]],
+) -> np.ndarray:
+    """
+    成果物群から (n_points, d) の初期集団を作る（列順は bounds のキー順）。
+    成果物に無い次元は範囲の中央値で埋め、範囲外の値は範囲内に丸める。
+    """
+    names = list(bounds.keys())
+    lo = np.array([bounds[k][0] for k in names], dtype=float)
+    hi = np.array([bounds[k][1] for k in names], dtype=float)
+    rows = []
+    for params in load_param_sets(paths).values():
+        rows.append([params.get(k, np.nan) for k in names])
+    x = np.array(rows, dtype=float).reshape(-1, len(names))
+    x = np.where(np.isnan(x), (lo + hi) / 2.0, x)
+    return np.clip(x, lo, hi)
+
+
+def run_artifacts(
+    paths: Sequence[Path | str],
+    return_cols: Sequence[str],
+    timestamps=None,
+    workers: int | None = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    成果物ごとのパラメータセットを 1 回のアンサンブル実行でまとめて評価する。
+    """
+    from pysd_ensemble import get_model, run_ensemble
+
+    sets = load_param_sets(paths, model=get_model())
+    res = run_ensemble(list(sets.values()), return_cols, timestamps=timestamps, workers=workers)
+    return dict(zip(sets.keys(), res))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vensim 成果物のパラメータで PySD モデルを一括実行")
+    parser.add_argument("paths", nargs="*", type=Path,
+                        help="成果物ファイル（省略時は ARTIFACT_PREFIX の .out/.dat/.cin 一式）")
+    parser.add_argument("--cols", nargs="+", default=["river_discharge_downstream"], help="取得する出力")
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--out", type=Path, default=Path("data/artifact_runs.csv"), help="出力CSV（縦持ち）")
+    args = parser.parse_args()
+
+    paths = args.paths or discover_artifacts()
+    print("Artifacts:", ", ".join(p.name for p in paths))
+    results = run_artifacts(paths, args.cols, workers=args.workers)
+
+    frames = [df.assign(artifact=name) for name, df in results.items()]
+    out = pd.concat(frames).rename_axis("day").reset_index()
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    out.to_csv(args.out, index=False, encoding="utf-8")
+    print(f"  -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# weather_generator.py
+# -*- coding: utf-8 -*-
+"""
+確率的気象発生器（モンテカルロ洪水リスク用）。
+
+- 降水の有無: 月別の 1 次マルコフ連鎖（p01 = 前日無降水→降水, p11 = 前日降水→降水）
+- 降水量: 月別のガンマ分布（Thom の近似最尤）または混合指数分布（EM）
+- 気温（平均・最高・最低）と日射: 降水の有無で平均を変えた標準化偏差を多変量 AR(1) で生成（Richardson 型）
+- 較正データ: data/weather_data_2008_2018.csv（+ 日射 CSV）または NIES キューブ
+- (実現数 × 日数) の配列を一度に作り、forcing_params 経由でそのままアンサンブル実行に流す
+- 1 実現 = 1 年として、年被害額（financial_damage_by_flood の年合計）の年超過確率（AEP）を求める
+  （各年はモデルの初期状態からの独立な 365 日実行。投資なしの BASE_PARAMS なので建設期間は関係しない。
+  timestamps を伸ばせば複数年も連続で回せるので、堤防・ダムの効果を見るときは flood_risk の sim_years を使う）
+
+src/sample_data_creation.py（日ごとの Python ループ・1 系列のみ）の置き換え。
+"""
+from __future__ import annotations
+
+import argparse
+import pickle
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from model_params import BASE_PARAMS, OPT_RESULT
+from pysd_ensemble import EvaluationCache, forcing_params, run_ensemble_cached
+
+
+# ---- 較正データ ----
+WEATHER_CSV = Path("data/weather_data_2008_2018.csv")
+SOLAR_CSV = Path("data/solar_radiation_2008_2018.csv")
+WEATHER_COLUMNS = {"降水量": "precipitation", "平均気温": "temperature", "最高気温": "tasmax", "最低気温": "tasmin"}
+SOLAR_COLUMNS = {"全天日射量": "rsds"}
+
+WET_THRESHOLD = 0.5                  # 降水日の判定 (mm/day)。AMeDAS の分解能に合わせる
+CONT_VARS = ["temperature", "tasmax", "tasmin", "rsds"]
+N_DAYS = 365
+
+# ---- リスク計算 ----
+RISK_DIR = Path("out_risk")
+GENERATOR_PATH = RISK_DIR / "weather_generator.pkl"
+DAMAGE_COL = "financial_damage_by_flood"
+DISCHARGE_COL = "river_discharge_downstream"
+SIM_BLOCK = 1000                     # 1 回の run_ensemble_cached に渡す実現数
+AEP_LEVELS = [0.5, 0.2, 0.1, 0.05, 0.02, 0.01, 0.005, 0.002, 0.001]
+
+
+# =========================
+# 較正データの読み込み
+# =========================
+def month_of_day(n_days: int = N_DAYS) -> np.ndarray:
+    """ 365 日暦（閏日なし）で日 → 月（0..11）。n_days が 365 を超えたら繰り返す """
+    months = pd.date_range("2001-01-01", periods=365).month.to_numpy() - 1
+    return np.resize(months, n_days)
+
+
+def load_observed(weather_csv: Path = WEATHER_CSV, solar_csv: Path | None = SOLAR_CSV) -> pd.DataFrame:
+    """ 観測 CSV を precipitation, temperature, tasmax, tasmin(, rsds), month の表にする """
+    df = pd.read_csv(weather_csv, parse_dates=["Date"]).rename(columns=WEATHER_COLUMNS)
+    if solar_csv is not None and Path(solar_csv).exists():
+        sol = pd.read_csv(solar_csv, parse_dates=["Date"]).rename(columns=SOLAR_COLUMNS)
+        df = df.merge(sol[["Date", "rsds"]], on="Date", how="left")
+    df = df.sort_values("Date").reset_index(drop=True)
+    for c in ["precipitation", *CONT_VARS]:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    df["month"] = df["Date"].dt.month - 1
+    return df
+
+
+def load_nies(ssp_code: str | int, model: str, years: Sequence[int]) -> pd.DataFrame:
+    """ NIES キューブの 1 GCM・複数年を、2/29 を除いた日別の表にする """
+    from nies_cube import load_cubes
+
+    names = {"pr": "precipitation", "tas": "temperature", "tasmax": "tasmax", "tasmin": "tasmin", "rsds": "rsds"}
+    cubes = load_cubes(list(names), ssp_code)
+    cols = {names[v]: c.days365([model], years)[0].reshape(-1) for v, c in cubes.items()}
+    return pd.DataFrame({**cols, "month": np.tile(month_of_day(), len(years))})
+
+
+# =========================
+# 降水量分布の推定
+# =========================
+def fit_gamma(x: np.ndarray) -> Tuple[float, float]:
+    """ Thom (1958) の近似最尤推定。戻り値 (shape, scale) """
+    m = x.mean()
+    a = np.log(m) - np.log(x).mean()
+    shape = (1.0 + np.sqrt(1.0 + 4.0 * a / 3.0)) / (4.0 * a) if a > 0 else 1.0
+    return float(shape), float(m / shape)
+
+
+def fit_mixed_exponential(y: np.ndarray, n_iter: int = 200) -> Tuple[float, float, float]:
+    """ 混合指数分布 α·Exp(μ1) + (1-α)·Exp(μ2) の EM 推定。戻り値 (α, μ1, μ2)、μ1 <= μ2 """
+    m = max(y.mean(), 1e-6)
+    alpha, mu1, mu2 = 0.5, 0.5 * m, 2.0 * m
+    for _ in range(n_iter):
+        f1 = alpha / mu1 * np.exp(-y / mu1)
+        f2 = (1.0 - alpha) / mu2 * np.exp(-y / mu2)
+        r = f1 / np.maximum(f1 + f2, 1e-300)
+        alpha = float(np.clip(r.mean(), 1e-3, 1 - 1e-3))
+        mu1 = float(max((r * y).sum() / max(r.sum(), 1e-12), 1e-3))
+        mu2 = float(max(((1 - r) * y).sum() / max((1 - r).sum(), 1e-12), mu1))
+    return alpha, mu1, mu2
+
+
+# =========================
+# 気象発生器
+# =========================
+class WeatherGenerator:
+    """
+    月別パラメータを持つ気象発生器。generate() で (n_real, n_days) の配列を一度に作る。
+    """
+
+    def __init__(self, params: Dict[str, np.ndarray], variables: List[str], amount: str,
+                 wet_threshold: float = WET_THRESHOLD):
+        self.params = params
+        self.variables = variables
+        self.amount = amount
+        self.wet_threshold = wet_threshold
+
+    @classmethod
+    def fit(cls, table: pd.DataFrame, amount: str = "gamma",
+            wet_threshold: float = WET_THRESHOLD) -> "WeatherGenerator":
+        """ precipitation, (temperature, tasmax, tasmin, rsds), month の日別表から推定する """
+        if amount not in ("gamma", "mixexp"):
+            raise ValueError(f"Unknown amount model: {amount}")
+        month = table["month"].to_numpy(int)
+        pr = table["precipitation"].to_numpy(float)
+        ok = np.isfinite(pr)
+        wet = pr >= wet_threshold
+
+        # マルコフ連鎖の遷移確率（前日・当日とも欠測でない日の組）
+        pair = ok[1:] & ok[:-1]
+        m1, prev, cur = month[1:][pair], wet[:-1][pair], wet[1:][pair]
+        n_dry = np.bincount(m1[~prev], minlength=12)
+        n_wet = np.bincount(m1[prev], minlength=12)
+        p01 = np.bincount(m1[~prev & cur], minlength=12) / np.maximum(n_dry, 1)
+        p11 = np.bincount(m1[prev & cur], minlength=12) / np.maximum(n_wet, 1)
+        params: Dict[str, np.ndarray] = {"p01": p01, "p11": p11}
+
+        # 降水量（月別）
+        amt = np.zeros((12, 3))
+        for m in range(12):
+            x = pr[ok & wet & (month == m)]
+            if len(x) < 5:
+                x = pr[ok & wet]
+            if amount == "gamma":
+                amt[m, :2] = fit_gamma(x)
+            else:
+                amt[m] = fit_mixed_exponential(x - wet_threshold)
+        params["amount"] = amt
+
+        # 連続変数: 降水の有無別の月平均、月別標準偏差、標準化偏差の多変量 AR(1)
+        variables = [v for v in CONT_VARS if v in table.columns and table[v].notna().any()]
+        X = table[variables].to_numpy(float)
+        mean = np.zeros((2, 12, len(variables)))
+        std = np.ones((12, len(variables)))
+        for m in range(12):
+            for w in (0, 1):
+                sel = (month == m) & (wet == bool(w)) & ok
+                mean[w, m] = np.nanmean(X[sel], axis=0) if sel.any() else np.nanmean(X[month == m], axis=0)
+            resid = X[month == m] - mean[wet[month == m].astype(int), m]
+            std[m] = np.where(np.nanstd(resid, axis=0) > 0, np.nanstd(resid, axis=0), 1.0)
+        z = (X - mean[wet.astype(int), month]) / std[month]
+        good = np.isfinite(z).all(axis=1)
+        both = good[1:] & good[:-1]
+        z0, z1 = z[1:][both], z[:-1][both]
+        M0 = z0.T @ z0 / len(z0)
+        M1 = z0.T @ z1 / len(z0)
+        A = M1 @ np.linalg.inv(M0)
+        C = M0 - A @ M1.T
+        w_, V = np.linalg.eigh(0.5 * (C + C.T))
+        B = V @ np.diag(np.sqrt(np.clip(w_, 0.0, None)))
+        params.update({"mean": mean, "std": std, "A": A, "B": B, "M0": M0})
+        return cls(params, variables, amount, wet_threshold)
+
+    def generate(self, n_real: int, n_days: int = N_DAYS, seed: int | None = None) -> Dict[str, np.ndarray]:
+        """
+        (n_real, n_days) の precipitation と連続変数を生成する。
+        時間方向は遷移の漸化式なので日ごとに進めるが、各日の計算は全実現をまとめて行う。
+        """
+        p = self.params
+        rng = np.random.default_rng(seed)
+        month = month_of_day(n_days)
+
+        # 降水の有無（初日は定常確率から）
+        p01, p11 = p["p01"][month], p["p11"][month]
+        u = rng.random((n_real, n_days))
+        wet = np.empty((n_real, n_days), dtype=bool)
+        pi0 = p01[0] / max(1.0 + p01[0] - p11[0], 1e-12)
+        wet[:, 0] = u[:, 0] < pi0
+        for d in range(1, n_days):
+            wet[:, d] = u[:, d] < np.where(wet[:, d - 1], p11[d], p01[d])
+
+        # 降水量
+        amt = p["amount"][month]
+        if self.amount == "gamma":
+            x = np.maximum(rng.gamma(amt[:, 0], amt[:, 1], size=(n_real, n_days)), self.wet_threshold)
+        else:
+            first = rng.random((n_real, n_days)) < amt[:, 0]
+            x = self.wet_threshold + rng.exponential(np.where(first, amt[:, 1], amt[:, 2]))
+        out = {"precipitation": np.where(wet, x, 0.0)}
+
+        # 連続変数（多変量 AR(1)）
+        k = len(self.variables)
+        eps = rng.standard_normal((n_real, n_days, k))
+        z = np.empty((n_real, n_days, k))
+        L0 = np.linalg.cholesky(p["M0"] + 1e-9 * np.eye(k))
+        z[:, 0] = eps[:, 0] @ L0.T
+        At, Bt = p["A"].T, p["B"].T
+        for d in range(1, n_days):
+            z[:, d] = z[:, d - 1] @ At + eps[:, d] @ Bt
+        vals = p["mean"][wet.astype(int), month] + p["std"][month] * z
+        for j, v in enumerate(self.variables):
+            out[v] = vals[..., j]
+        if "temperature" in out:
+            if "tasmax" in out:
+                out["tasmax"] = np.maximum(out["tasmax"], out["temperature"])
+            if "tasmin" in out:
+                out["tasmin"] = np.minimum(out["tasmin"], out["temperature"])
+        if "rsds" in out:
+            out["rsds"] = np.maximum(out["rsds"], 0.0)
+        return out
+
+    def save(self, path: Path = GENERATOR_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: Path = GENERATOR_PATH) -> "WeatherGenerator":
+        with Path(path).open("rb") as f:
+            return pickle.load(f)
+
+
+def validation_table(gen: WeatherGenerator, table: pd.DataFrame, n_real: int = 1000, seed: int = 0) -> pd.DataFrame:
+    """ 観測と生成系列の月別統計（降水日率・平均降水量・月最大の平均・平均気温）を並べる """
+    sim = gen.generate(n_real, seed=seed)
+    month = month_of_day()
+    rows = []
+    for m in range(12):
+        obs = table[table["month"] == m]
+        s_pr = sim["precipitation"][:, month == m]
+        rows.append({
+            "month": m + 1,
+            "wet_frac_obs": float((obs["precipitation"] >= gen.wet_threshold).mean()),
+            "wet_frac_sim": float((s_pr >= gen.wet_threshold).mean()),
+            "pr_mean_obs": float(obs["precipitation"].mean()),
+            "pr_mean_sim": float(s_pr.mean()),
+            "tas_mean_obs": float(obs["temperature"].mean()) if "temperature" in obs else np.nan,
+            "tas_mean_sim": float(sim["temperature"][:, month == m].mean()) if "temperature" in sim else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+
+# =========================
+# アンサンブル実行・年超過確率
+# =========================
+def member_params(sim: Dict[str, np.ndarray], i: int) -> Dict[str, pd.Series]:
+    """ 生成配列の i 番目の実現を run(params=...) 用の外部データに変換する """
+    return forcing_params(pd.DataFrame({k: v[i] for k, v in sim.items()}))
+
+
+def annual_summary(res: pd.DataFrame) -> List[float]:
+    # ワーカー側で年被害額と年最大流量だけにする（pickle 可能なトップレベル関数）
+    return [float(pd.to_numeric(res[DAMAGE_COL], errors="coerce").sum()),
+            float(pd.to_numeric(res[DISCHARGE_COL], errors="coerce").max())]
+
+
+def simulate_years(
+    gen: WeatherGenerator,
+    n_years: int,
+    params: Dict[str, float] | None = None,
+    seed: int = 42,
+    workers: int | None = None,
+    cache_path: Path | None = None,
+) -> pd.DataFrame:
+    """
+    合成年を SIM_BLOCK ずつ生成してアンサンブル実行し、年ごとの (被害額, 最大流量) を返す。
+    キャッシュ（JSON Lines）を使うので、同じ seed なら中断後に続きから再開できる。
+    """
+    cache = EvaluationCache(cache_path or RISK_DIR / f"cache_weather_gen_seed{seed}.jsonl")
+    base = {**BASE_PARAMS, **(params or {})}
+    rows = []
+    for b, s in enumerate(range(0, n_years, SIM_BLOCK)):
+        n = min(SIM_BLOCK, n_years - s)
+        sim = gen.generate(n, N_DAYS, seed=seed + b)
+        sets = [member_params(sim, i) for i in range(n)]
+        res = run_ensemble_cached(sets, [DAMAGE_COL, DISCHARGE_COL], annual_summary, cache,
+                                  tag="weather_gen", base_params=base, timestamps=list(range(N_DAYS)),
+                                  workers=workers, errors="ignore")
+        for i, r in enumerate(res):
+            rows.append({"year": s + i,
+                         "annual_precip_mm": float(sim["precipitation"][i].sum()),
+                         "max_daily_precip_mm": float(sim["precipitation"][i].max()),
+                         DAMAGE_COL: np.nan if r is None else r[0],
+                         "max_discharge": np.nan if r is None else r[1]})
+    return pd.DataFrame(rows)
+
+
+def exceedance_table(values: np.ndarray, levels: Sequence[float] = AEP_LEVELS) -> pd.DataFrame:
+    """
+    年値の経験的な年超過確率。AEP ごとの値（再現期間 = 1/AEP）を返す。
+    プロット位置は Weibull（順位 / (N+1)）。
+    """
+    v = np.sort(np.asarray(values, dtype=float)[np.isfinite(values)])[::-1]
+    n = len(v)
+    aep = np.arange(1, n + 1) / (n + 1.0)
+    levels = np.asarray(levels, dtype=float)
+    value = np.interp(levels, aep, v, left=v[0], right=v[-1])
+    return pd.DataFrame({"aep": levels, "return_period": 1.0 / levels, "value": value,
+                         "reliable": levels >= 1.0 / (n + 1.0)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="確率的気象発生器による合成年のモンテカルロ洪水リスク")
+    parser.add_argument("--source", choices=["observed", "nies"], default="observed", help="較正データ")
+    parser.add_argument("--ssp", default="245", help="--source nies の SSP")
+    parser.add_argument("--gcm", default="MIROC6", help="--source nies の GCM")
+    parser.add_argument("--years", nargs=2, type=int, default=[2015, 2044], help="--source nies の期間（開始 終了）")
+    parser.add_argument("--amount", choices=["gamma", "mixexp"], default="gamma", help="降水量の分布")
+    parser.add_argument("--n-years", type=int, default=10000, help="合成年数（= アンサンブルのメンバー数）")
+    parser.add_argument("--params", type=Path, default=OPT_RESULT, help="水文パラメータ（Vensim 成果物、無ければ既定値）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None, help="並列ワーカー数（既定はコア数）")
+    parser.add_argument("--fit-only", action="store_true", help="較正と検証表の出力だけ行う")
+    args = parser.parse_args()
+
+    if args.source == "observed":
+        table, tag = load_observed(), "observed"
+    else:
+        table = load_nies(args.ssp, args.gcm, range(args.years[0], args.years[1] + 1))
+        tag = f"nies_ssp{args.ssp}_{args.gcm}_{args.years[0]}-{args.years[1]}"
+    gen = WeatherGenerator.fit(table, amount=args.amount)
+    gen.save(RISK_DIR / f"weather_generator_{tag}_{args.amount}.pkl")
+    print(validation_table(gen, table).round(3).to_string(index=False))
+    if args.fit_only:
+        return
+
+    params = {}
+    if args.params and args.params.exists():
+        from pysd_ensemble import get_model
+        from vensim_artifacts import load_calibrated_params
+        params = load_calibrated_params(args.params, get_model())
+
+    years = simulate_years(gen, args.n_years, params, seed=args.seed, workers=args.workers,
+                           cache_path=RISK_DIR / f"cache_{tag}_{args.amount}_seed{args.seed}.jsonl")
+    aep = exceedance_table(years[DAMAGE_COL].to_numpy())
+    p_damage = float((years[DAMAGE_COL] > 0).mean())
+    print(f"P(annual flood damage > 0) = {p_damage:.4f}")
+    print(aep.to_string(index=False))
+
+    RISK_DIR.mkdir(parents=True, exist_ok=True)
+    years.to_csv(RISK_DIR / f"synthetic_years_{tag}_{args.amount}.csv", index=False, encoding="utf-8")
+    aep.to_csv(RISK_DIR / f"damage_aep_{tag}_{args.amount}.csv", index=False, encoding="utf-8")
+    print(f"  -> {RISK_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,579 @@
+# wis_downloader.py
+# -*- coding: utf-8 -*-
+"""
+WIS（水文水質データベース）日流量の並列ダウンローダ。
+
+- requests.Session を共有して keep-alive（接続プールの大きさは同時実行数に合わせる）
+- トークンバケットで全スレッド合計のリクエスト頻度を制限する（既定 RATE 回/秒、BURST 回まで連続可）
+- (観測所, 月) の取得をスレッドプールで並列に行う（同時実行は MAX_WORKERS まで）
+- 接続エラー・タイムアウト・429・5xx は指数バックオフで再試行（Retry-After があればそれに従う）
+- WIS_BASES は最後に成功したものから試す（毎回すべてを順に試さない）
+- 月の CSV が 1 件も取れない観測所は、get_suimon_database と同じく年表ページ（.dat リンク / 表）から取得
+- bases を差し替えればローカルの代替サーバーに向けて試せる
+- cache（http_cache.HttpCache）を渡すと (エンドポイント, 観測所, 期間) ごとに応答をディスクに保存し、
+  確定済みの月は通信せず、暫定の月は ETag / Last-Modified の条件付き GET で取り直す
+- sync: 手元の日流量表に無い月・まだ暫定の月だけを取得して差し替える（定例の更新では最新月だけ）
+- LocalWis: ループバックの代替 WIS（503 + Retry-After・メンテナンス中のミラー・ETag）。
+  python wis_downloader.py selfcheck で再試行・レート制限・ミラー切替・キャッシュを確かめる
+"""
+from __future__ import annotations
+
+import argparse
+import calendar
+import hashlib
+import random
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from get_suimon_database import (
+    UA,
+    WIS_BASES,
+    _decode,
+    _fetch_csv_text,
+    _fetch_year_page,
+    _iter_months,
+    _parse_daily_csv_lines,
+    _parse_daily_from_year_table,
+    _parse_dat_link_to_df,
+)
+from http_cache import SETTLE_DAYS, HttpCache, is_provisional, settle_date
+
+
+RATE = 2.0                   # 1 秒あたりのリクエスト数（全スレッド合計）
+BURST = 2                    # 連続して送ってよい回数
+MAX_WORKERS = 4
+RETRIES = 4
+BACKOFF_SEC = 1.0            # 再試行の待ち時間の基準（1, 2, 4, ... 秒 + ゆらぎ）
+MAX_BACKOFF_SEC = 60.0
+TIMEOUT_SEC = 25
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# キャッシュに残してよい本文（_fetch_csv_text / _follow_frames / 年表の処理が受け付けるもの）
+_CSV_ROW = re.compile(rb"^\s*\d{4}/\d{1,2}/\d{1,2}\s*,", re.M)
+_FRAME = re.compile(rb"<i?frame\b|http-equiv\s*=\s*[\"']?refresh", re.I)
+_YEAR_PAGE = re.compile(rb"\.dat\b|1\xe6\x97\xa5", re.I)    # .dat リンク または「1日」（UTF-8）
+
+
+def _csv_page(body: bytes) -> bool:
+    return bool(_CSV_ROW.search(body) or _FRAME.search(body))
+
+
+def _year_page(body: bytes) -> bool:
+    return bool(_CSV_ROW.search(body) or _FRAME.search(body) or _YEAR_PAGE.search(body))
+
+
+class TokenBucket:
+    """ rate 回/秒で補充され、最大 burst 個までためられるトークン。acquire は 1 個取れるまで待つ """
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WisDownloader:
+    """
+    WIS から日流量をまとめて取る。
+        with WisDownloader(workers=4, rate=2.0) as dl:
+            flows = dl.download(["305091285502190"], date(2008, 1, 1), date(2018, 12, 31))
+    """
+
+    def __init__(
+        self,
+        bases: Sequence[str] = WIS_BASES,
+        rate: float = RATE,
+        burst: int = BURST,
+        workers: int = MAX_WORKERS,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF_SEC,
+        timeout: float = TIMEOUT_SEC,
+        session: requests.Session | None = None,
+        cache: HttpCache | None = None,
+        settle_days: int = SETTLE_DAYS,
+    ):
+        self.bases = [b.rstrip("/") for b in bases]
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = max(1, int(workers))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.session.headers.update(UA)
+        adapter = HTTPAdapter(pool_connections=max(1, len(self.bases)), pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache = cache
+        self.settle_days = settle_days
+        self._preferred = 0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0}
+
+    def __enter__(self) -> "WisDownloader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    # ---- HTTP ----
+    def _request(self, url: str, headers: Mapping[str, str] | None = None) -> requests.Response:
+        """ レート制限・再試行つきの GET（304 はそのまま返す）"""
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            with self._lock:
+                self.stats["requests"] += 1
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                self._sleep_backoff(attempt, None)
+                continue
+            if r.status_code in RETRY_STATUS and attempt < self.retries:
+                self._sleep_backoff(attempt, r.headers.get("Retry-After"))
+                continue
+            r.raise_for_status()
+            return r
+        raise RuntimeError(f"再試行の上限に達しました: {url}")
+
+    def _fetch(self, url: str, extra: Dict[str, str]) -> Tuple[int, bytes, Mapping[str, str]]:
+        """ HttpCache 用。本文は文字コードを判定して UTF-8 にそろえて渡す """
+        r = self._request(url, extra)
+        if r.status_code == 304:
+            return 304, b"", r.headers
+        headers = dict(r.headers)
+        headers["Content-Type"] = "text/plain; charset=utf-8"
+        return r.status_code, _decode(r).encode("utf-8"), headers
+
+    def get_text(
+        self,
+        url: str,
+        key: Tuple[str, str, str] | None = None,
+        settled_after: date | None = None,
+        accept: Callable[[bytes], bool] | None = None,
+    ) -> str:
+        """
+        get_suimon_database の _http_get と同じく文字コードを判定して返す。
+        cache があり key = (エンドポイント, 観測所, 期間) が渡されればキャッシュを通す（accept を満たす本文だけ保存）。
+        """
+        if self.cache is None or key is None:
+            return _decode(self._request(url))
+        return self.cache.get(url, key, self._fetch, settled_after, accept).body.decode("utf-8")
+
+    def _sleep_backoff(self, attempt: int, retry_after: str | None) -> None:
+        with self._lock:
+            self.stats["retries"] += 1
+        try:
+            wait = float(retry_after) if retry_after else None
+        except ValueError:
+            wait = None
+        if wait is None:
+            wait = self.backoff * (2 ** attempt) * (1.0 + 0.5 * random.random())
+        time.sleep(min(wait, MAX_BACKOFF_SEC))
+
+    def _ordered_bases(self) -> List[str]:
+        i = self._preferred
+        return self.bases[i:] + self.bases[:i]
+
+    def _remember_base(self, url: str | None) -> None:
+        for i, base in enumerate(self.bases):
+            if url and url.startswith(base):
+                self._preferred = i
+                return
+
+    # ---- 取得単位 ----
+    def _cached_get(
+        self, endpoint: str, station_id: str, period: str, period_end: date, accept: Callable[[bytes], bool]
+    ) -> Callable[[str], str]:
+        key = (endpoint, station_id, period)
+        settled = settle_date(period_end, self.settle_days)
+        return lambda url: self.get_text(url, key, settled, accept)
+
+    def fetch_month(self, station_id: str, bgn: date, end: date) -> pd.DataFrame:
+        http_get = self._cached_get("wis_csv", station_id, f"{bgn:%Y%m%d}-{end:%Y%m%d}", end, _csv_page)
+        txt, url = _fetch_csv_text(station_id, bgn, end, http_get=http_get, bases=self._ordered_bases())
+        self._remember_base(url)
+        return _parse_daily_csv_lines(txt) if txt else pd.DataFrame()
+
+    def fetch_year_fallback(self, station_id: str, year: int) -> pd.DataFrame:
+        """ 年表ページの .dat リンク、なければ表から 1 年分を取る """
+        http_get = self._cached_get("wis_year", station_id, str(year), date(year, 12, 31), _year_page)
+        page, url = _fetch_year_page(station_id, year, http_get=http_get, bases=self._ordered_bases())
+        self._remember_base(url)
+        df = _parse_dat_link_to_df(page, url, http_get=http_get)
+        return df if not df.empty else _parse_daily_from_year_table(page, year)
+
+    def _run_all(self, tasks: List[Tuple], fn: Callable, progress: Callable[[int, int], None] | None) -> Dict:
+        out: Dict[Tuple, pd.DataFrame] = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="wis") as ex:
+            futs = {ex.submit(fn, *t): t for t in tasks}
+            for n, fut in enumerate(as_completed(futs), 1):
+                try:
+                    out[futs[fut]] = fut.result()
+                except Exception as e:
+                    print(f"[WARN] {futs[fut]}: {e}")
+                    out[futs[fut]] = pd.DataFrame()
+                if progress is not None:
+                    progress(n, len(tasks))
+        return out
+
+    def download(
+        self,
+        station_ids: Sequence[str],
+        start: date,
+        end: date,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        観測所ごとの日流量（date, flow）を返す。全観測所の全月をまとめて並列に取得する。
+        月の CSV が 1 件も取れなかった (観測所, 年) は年表ページから取り直す（従来の年ごとの取得と同じ）。
+        どちらでも取れなければ空の表。
+        """
+        if end < start:
+            raise ValueError("end は start 以降の日付を指定してください。")
+        tasks = [(sid, max(m0, start), min(m1, end)) for sid in station_ids for m0, m1 in _iter_months(start, end)]
+        months = self._run_all(tasks, self.fetch_month, progress)
+
+        frames: Dict[str, List[pd.DataFrame]] = {sid: [] for sid in station_ids}
+        got = set()
+        for (sid, m0, _), df in months.items():
+            if not df.empty:
+                frames[sid].append(df)
+                got.add((sid, m0.year))
+
+        missing = [(sid, y) for sid in station_ids for y in range(start.year, end.year + 1) if (sid, y) not in got]
+        if missing:
+            years = self._run_all(missing, self.fetch_year_fallback, progress)
+            for (sid, _), df in years.items():
+                if not df.empty:
+                    frames[sid].append(df)
+
+        return {sid: _finish(f, start, end) if f else pd.DataFrame(columns=["date", "flow"])
+                for sid, f in frames.items()}
+
+    def sync(
+        self,
+        station_id: str,
+        local: pd.DataFrame,
+        start: date,
+        end: date,
+        today: date | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> pd.DataFrame:
+        """
+        手元の日流量表 local（date, flow）を [start, end] について最新にした表を返す。
+        取得するのは months_to_sync の月だけ。CSV が取れなかった月は年表ページから取り、
+        それでも取れなかった月は手元の値をそのまま残す。
+        """
+        months = months_to_sync(local, start, end, today, self.settle_days)
+        if not months:
+            return _sorted(local)
+        fetched = self._run_all([(station_id, m0, m1) for m0, m1 in months], self.fetch_month, progress)
+        # CSV が取れなかった月は、その年の年表ページから切り出す
+        empty_years = sorted({m0.year for (_, m0, _), df in fetched.items() if df.empty})
+        if empty_years:
+            years = self._run_all([(station_id, y) for y in empty_years], self.fetch_year_fallback, progress)
+            for key, df in list(fetched.items()):
+                year_df = years.get((station_id, key[1].year))
+                if df.empty and year_df is not None and not year_df.empty:
+                    fetched[key] = year_df
+        keep = local
+        frames = []
+        for (_, m0, m1), df in fetched.items():
+            part = df[(df["date"] >= m0) & (df["date"] <= m1)] if not df.empty else df
+            if part.empty:
+                continue
+            keep = keep[(keep["date"] < m0) | (keep["date"] > m1)]
+            frames.append(part[["date", "flow"]])
+        return _sorted(pd.concat([keep, *frames], ignore_index=True))
+
+
+def months_to_sync(
+    local: pd.DataFrame,
+    start: date,
+    end: date,
+    today: date | None = None,
+    settle_days: int = SETTLE_DAYS,
+) -> List[Tuple[date, date]]:
+    """
+    取得が必要な月（[start, end] で切った期間）の一覧。
+    - 手元に日の行がそろっていない月、値が 1 つも無い月
+    - 月末から settle_days 日以内（暫定値）の月
+    今日より後は対象にしない。確定済みで行がそろっていれば欠測（NaN）が残っていても取り直さない。
+    """
+    today = today or date.today()
+    end = min(end, today)
+    if end < start:
+        return []
+    dates = pd.to_datetime(local["date"])
+    flow = pd.to_numeric(local["flow"], errors="coerce")
+    per_month = pd.DataFrame({"m": dates.dt.to_period("M"), "day": dates.dt.day, "ok": flow.notna()})
+    days = per_month.groupby("m")["day"].nunique()
+    has_value = per_month.groupby("m")["ok"].any()
+
+    out = []
+    for m0, m1 in _iter_months(start, end):
+        b, e = max(m0, start), min(m1, end)
+        p = pd.Period(b, "M")
+        complete = days.get(p, 0) >= (e - b).days + 1 and bool(has_value.get(p, False))
+        if not complete or is_provisional(m1, today, settle_days):
+            out.append((b, e))
+    return out
+
+
+# ====== 手元の日流量表（data/ の CSV）======
+
+def is_wis_table(path: Path) -> bool:
+    """ WIS の年表をそのまま保存した形式（行 = 月、列 = 1日〜31日）か """
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        head = f.read(4096)
+    return "1日" in head and re.search(r"^\s*\d{1,2}月,", head, flags=re.M) is not None
+
+
+def read_local_flow(path: str | Path) -> pd.DataFrame:
+    """
+    手元の日流量を (date, flow) で読む。
+    - date,flow（date は 2008/1/1・2008-01-01 どちらでも）
+    - WIS 年表形式（data/Arase_Flow_2023-2023.csv のような 月 × 日 の表。最終列が年）
+    """
+    path = Path(path)
+    if is_wis_table(path):
+        raw = pd.read_csv(path, header=None, dtype=str, encoding="utf-8-sig")
+        rows = []
+        for _, r in raw.iterrows():
+            m = re.fullmatch(r"\s*(\d{1,2})月\s*", str(r.iloc[0]))
+            if not m:
+                continue
+            month, year = int(m.group(1)), int(r.iloc[-1])
+            for day in range(1, calendar.monthrange(year, month)[1] + 1):
+                v = pd.to_numeric(str(r.iloc[day]).replace(",", ""), errors="coerce")
+                rows.append({"date": date(year, month, day), "flow": v})
+        return pd.DataFrame(rows, columns=["date", "flow"])
+    df = pd.read_csv(path, encoding="utf-8-sig")
+    out = pd.DataFrame({
+        "date": pd.to_datetime(df["date"]).dt.date,
+        "flow": pd.to_numeric(df["flow"], errors="coerce"),
+    })
+    return _sorted(out)
+
+
+def write_local_flow(df: pd.DataFrame, path: str | Path, slash_dates: bool = False) -> None:
+    """ date,flow の CSV で保存する。slash_dates=True なら 2008/1/1 形式（data/ の既存ファイルと同じ）"""
+    out = df[["date", "flow"]].copy()
+    if slash_dates:
+        out["date"] = [f"{d.year}/{d.month}/{d.day}" for d in out["date"]]
+    out.to_csv(path, index=False, encoding="utf-8")
+
+
+def uses_slash_dates(path: str | Path) -> bool:
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        f.readline()
+        return "/" in f.readline().split(",")[0]
+
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame(columns=["date", "flow"])
+    return df.drop_duplicates("date", keep="last").sort_values("date").reset_index(drop=True)[["date", "flow"]]
+
+
+def _finish(frames: List[pd.DataFrame], start: date, end: date) -> pd.DataFrame:
+    df = pd.concat(frames, ignore_index=True)
+    df = df[(df["date"] >= start) & (df["date"] <= end)].sort_values("date").reset_index(drop=True)
+    return df[["date", "flow"]]
+
+
+# ====== ループバックの代替 WIS（動作確認用）======
+
+def stub_flow(station_id: str, d: date) -> float:
+    """ 代替 WIS が返す日流量（観測所と日付から決まる値）"""
+    return ((d.toordinal() * 7 + int(station_id[-3:])) % 1000) / 10
+
+
+class _WisStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: Mapping[str, str] | None = None) -> None:
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        stub: LocalWis = self.server.stub
+        mirror = self.server.mirror
+        n = stub._record(mirror, self.path)
+        if mirror in stub.maintenance:
+            # 200 で返るメンテナンス画面（キャッシュに残してはいけない本文）
+            page = "<html><body>ただいまメンテナンス中です</body></html>".encode("utf-8")
+            return self._send(200, page, {"Content-Type": "text/html; charset=utf-8"})
+        if n <= stub.fail_first:
+            return self._send(503, headers={"Retry-After": f"{stub.retry_after:g}"})
+        parts = urlsplit(self.path)
+        q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if not parts.path.endswith("/DspWaterData.exe") or q.get("CSV") != "1":
+            return self._send(404)
+        bgn = datetime.strptime(q["BGNDATE"], "%Y%m%d").date()
+        end = datetime.strptime(q["ENDDATE"], "%Y%m%d").date()
+        days = pd.date_range(bgn, end, freq="D").date
+        body = "\n".join(f"{d:%Y/%m/%d},{stub_flow(q['ID'], d):.2f}" for d in days).encode("utf-8")
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        self._send(200, body, {"Content-Type": "text/plain; charset=utf-8", "ETag": etag})
+
+
+class LocalWis:
+    """
+    ループバック（空きポート）にミラーの数だけ代替 WIS を立てる（月の CSV だけ）。
+        with LocalWis(mirrors=2, maintenance=(0,)) as stub:
+            with WisDownloader(bases=stub.bases) as dl: ...
+    - maintenance のミラーは常に 200 のメンテナンス画面を返す
+    - それ以外は URL ごとに最初の fail_first 回を 503（Retry-After: retry_after 秒）にする
+    - CSV には ETag を付け、If-None-Match が一致すれば 304
+    requests にミラーごとの (受信時刻, パス) が残る。
+    """
+
+    def __init__(self, mirrors: int = 1, maintenance: Sequence[int] = (), fail_first: int = 0,
+                 retry_after: float = 0.0):
+        self.maintenance = set(maintenance)
+        self.fail_first = int(fail_first)
+        self.retry_after = float(retry_after)
+        self.requests: Dict[int, List[Tuple[float, str]]] = {i: [] for i in range(mirrors)}
+        self._lock = threading.Lock()
+        self.servers = []
+        for i in range(mirrors):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), _WisStubHandler)
+            server.stub, server.mirror = self, i
+            self.servers.append(server)
+        self.bases = [f"http://127.0.0.1:{s.server_address[1]}/cgi-bin" for s in self.servers]
+
+    def _record(self, mirror: int, path: str) -> int:
+        """ 受信を記録し、このミラーで同じパスを受けた回数を返す """
+        with self._lock:
+            self.requests[mirror].append((time.monotonic(), path))
+            return sum(p == path for _, p in self.requests[mirror])
+
+    def times(self) -> List[float]:
+        with self._lock:
+            return sorted(t for reqs in self.requests.values() for t, _ in reqs)
+
+    def __enter__(self) -> "LocalWis":
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def selfcheck(rate: float = 4.0, burst: int = 2, retry_after: float = 0.3) -> None:
+    """
+    代替 WIS に対して次を確かめる（満たさなければ AssertionError）。
+    - 503 は再試行され、次の試行は Retry-After の秒数の後（バックオフの基準値ではない）
+    - 全スレッド合計のリクエスト頻度がトークンバケットの rate / burst を超えない
+    - メンテナンス中のミラーで失敗した後は、よい方のミラーを先に試す
+    - キャッシュあり・なしで同じ結果。確定した月は通信せず、暫定の月は 304 で済む
+    """
+    sid = "305091285502190"
+    start, end = date(2020, 1, 1), date(2020, 6, 30)
+    n_months = len(list(_iter_months(start, end)))
+    expected = [stub_flow(sid, d) for d in pd.date_range(start, end, freq="D").date]
+
+    def check_values(df: pd.DataFrame) -> None:
+        assert len(df) == len(expected), f"行数 {len(df)} != {len(expected)}"
+        assert [round(float(v), 2) for v in df["flow"]] == expected, "日流量が一致しません"
+
+    # 再試行・Retry-After・レート制限（backoff を大きくして、Retry-After に従っていなければ分かるようにする）
+    with LocalWis(fail_first=1, retry_after=retry_after) as stub, \
+            WisDownloader(bases=stub.bases, rate=rate, burst=burst, workers=4, backoff=30.0) as dl:
+        check_values(dl.download([sid], start, end)[sid])
+    assert dl.stats["retries"] == n_months, f"再試行 {dl.stats['retries']} 回（期待 {n_months} 回）"
+    for path in {p for _, p in stub.requests[0]}:
+        t = [ts for ts, p in stub.requests[0] if p == path]
+        assert len(t) == 2, f"{path}: {len(t)} 回"
+        assert retry_after * 0.9 <= t[1] - t[0] < retry_after + 5.0, f"再試行の間隔 {t[1] - t[0]:.2f} 秒"
+    times = stub.times()
+    # k 回目以降（k > burst）のリクエストは最初から (k - burst) / rate 秒以上後
+    for k, t in enumerate(times, 1):
+        assert t - times[0] >= (k - burst) / rate - 0.05, f"{k} 回目が早すぎます（{t - times[0]:.2f} 秒）"
+    print(f"[OK] retry / Retry-After / token bucket: requests={len(times)} "
+          f"elapsed={times[-1] - times[0]:.2f}s (>= {(len(times) - burst) / rate:.2f}s)")
+
+    # ミラー: 先頭のミラーはメンテナンス中。1 回失敗したら以降はよい方から試す
+    with LocalWis(mirrors=2, maintenance=(0,)) as stub, \
+            WisDownloader(bases=stub.bases, rate=0, workers=1) as dl:
+        check_values(dl.download([sid], start, end)[sid])
+    hits = [len(stub.requests[0]), len(stub.requests[1])]
+    assert hits == [1, n_months], f"ミラーごとの受信 {hits}（期待 [1, {n_months}]）"
+    print(f"[OK] mirror preference: requests per mirror={hits}")
+
+    # キャッシュ: 1 回目は取得、確定済みなら 2 回目は通信しない、暫定扱いなら 304
+    with tempfile.TemporaryDirectory() as tmp, LocalWis(mirrors=2, maintenance=(0,)) as stub:
+        cache = HttpCache(tmp)
+        for settle_days in (SETTLE_DAYS, SETTLE_DAYS, 10 ** 6):
+            before = [len(stub.requests[0]), len(stub.requests[1])]
+            with WisDownloader(bases=stub.bases, rate=0, workers=1, cache=cache, settle_days=settle_days) as dl:
+                check_values(dl.download([sid], start, end)[sid])
+            after = [len(stub.requests[0]), len(stub.requests[1])]
+            print(f"     settle_days={settle_days}: requests per mirror={[a - b for a, b in zip(after, before)]} "
+                  f"cache={cache.stats}")
+    assert cache.stats["rejected"] == 3, "メンテナンス画面がキャッシュに残っています"
+    assert cache.stats["fetched"] == n_months + 3, cache.stats
+    assert cache.stats["hits"] == n_months, cache.stats
+    assert cache.stats["revalidated"] == n_months, cache.stats
+    print("[OK] cache: same values with and without the cache")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WIS 日流量の並列ダウンローダ（動作確認）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("selfcheck", help="ループバックの代替 WIS で再試行・レート制限・ミラー切替・キャッシュを確かめる")
+    p.add_argument("--rate", type=float, default=4.0)
+    p.add_argument("--burst", type=int, default=2)
+    p.add_argument("--retry-after", type=float, default=0.3)
+    args = parser.parse_args()
+
+    if args.cmd == "selfcheck":
+        selfcheck(args.rate, args.burst, args.retry_after)
+
+
+if __name__ == "__main__":
+    main()